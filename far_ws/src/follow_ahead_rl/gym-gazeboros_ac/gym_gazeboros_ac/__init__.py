@@ -4,3 +4,8 @@ register(
     id='gazeborosAC-v0',
     entry_point='gym_gazeboros_ac.envs.gym_gazeboros_ac:GazeborosEnv',
 )
+
+register(
+    id='gazeborosSim-v0',
+    entry_point='gym_gazeboros_ac.envs.gym_gazeboros_sim:GazeborosSimEnv',
+)
@@ -1 +1,6 @@
-from gym_gazeboros_ac.envs.gym_gazeboros_ac import GazeborosEnv
+from gym_gazeboros_ac.envs.gym_gazeboros_sim import GazeborosSimEnv, VectorGazeborosEnv
+try:
+    from gym_gazeboros_ac.envs.gym_gazeboros_ac import GazeborosEnv
+except ImportError:
+    # ROS is not installed, only the headless simulator is available
+    pass
@@ -0,0 +1,341 @@
+"""
+Parameters and math shared by the Gazebo env (gym_gazeboros_ac) and the headless simulator (gym_gazeboros_sim).
+Nothing in here depends on ROS so the simulator can run without it.
+"""
+
+import math
+import random
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Environment Parameters
+class EnvConfig:
+    # Boolean to make robots spawn at constant locations
+    USE_TESTING = False
+
+    # Set to move obstacles out of the way in case they exist but you don't want them in the way
+    USE_OBSTACLES = False
+
+    # Pattern to init obstacles
+    # 0: Places obstacles between robot and person
+    # 1: Places obstacles randomly within circle
+    OBSTACLE_MODE = 1
+
+    # Radius(meters) away from person robot for random placement(mode 1) of objects
+    OBSTACLE_RADIUS_AWAY = 3
+
+    # Obstacle size
+    OBSTACLE_SIZE = 0.5
+
+    # Allows/Denies Robot TEB Local Planner to avoid obstacles
+    SEND_TEB_OBSTACLES = True
+
+    # Gets person robot to use move base
+    PERSON_USE_MB = True
+
+    # Episode Length
+    EPISODE_LEN = 15
+
+    # Returns Human State only in get_observations if True
+    RETURN_HINN_STATE = True
+
+    # Size to reduce laser scan to
+    SCAN_REDUCTION_SIZE = 20
+
+    # How the ranges of each reduced laser scan bin are combined
+    # "mean": Average of the valid ranges
+    # "min": Closest valid range, safer for obstacle avoidance
+    # "percentile": SCAN_REDUCER_PERCENTILE percentile of the valid ranges
+    SCAN_REDUCER = "mean"
+    SCAN_REDUCER_PERCENTILE = 10
+
+    # Rate(Hz) at which /gazebo/model_states messages update the robot states, None to use every message
+    # History only keeps samples at its save_rate (10Hz) so faster updates are mostly discarded
+    STATE_UPDATE_RATE = 10
+
+    # Rate(Hz) at which obstacles are published to the TEB local planners, None to publish on every message
+    OBSTACLE_PUBLISH_RATE = 10
+
+    # If True, reads the agent state from the compact topic of model_states_demux instead of /gazebo/model_states
+    # The demux node has to be running: python -m gym_gazeboros_ac.envs.model_states_demux _num_agents:=N
+    USE_MODEL_STATES_DEMUX = False
+
+    # How step() waits for the control period after sending the action
+    # "sleep": rospy.sleep(CONTROL_PERIOD), the state read afterwards can be up to one state update old
+    # "clock": returns as soon as the robot states of the end of the period arrived, run with /use_sim_time
+    #          so the period is simulated time and throughput scales with the real_time_factor of Gazebo
+    # "lockstep": like "clock" but Gazebo physics is paused between steps and on reset, the simulation only
+    #             advances while the env waits. Pausing stops the whole world, use it with one agent per world
+    STEP_MODE = "sleep"
+
+    # Control period(seconds of ROS time) of step()
+    CONTROL_PERIOD = 0.1
+
+    # Wall clock timeout(seconds) of the "clock" and "lockstep" waits before step() continues with the last state
+    STEP_TIMEOUT = 2.0
+
+    # If True, step() records the wall clock time of each of its stages, see GazeborosEnv.get_timing_stats()
+    STEP_TIMING = False
+    # Number of last durations of every stage the timing statistics are computed over
+    STEP_TIMING_WINDOW = 1000
+
+    # If True, records duration, arrival jitter, header stamp lag and dropped messages (header seq gaps) of the
+    # model states and scan callbacks, see GazeborosEnv.get_callback_stats(). /gazebo/model_states has no header
+    CALLBACK_PROFILING = False
+    # Period(seconds of ROS time) at which the callback statistics are published on /diagnostics, None to not publish
+    CALLBACK_DIAGNOSTICS_PERIOD = 10.0
+
+    # How reset() moves the robot, the person and the obstacles
+    # "service": /gazebo/set_model_state service calls over persistent connections, SET_MODEL_STATE_CONCURRENCY at once
+    # "topic": publishes all the states on the /gazebo/set_model_state topic, no round trip but no confirmation either
+    SET_MODEL_STATE_MODE = "service"
+    # Number of concurrent set_model_state calls of a reset, 1 calls them one after the other
+    SET_MODEL_STATE_CONCURRENCY = 4
+
+    # If True, reset() waits for the move_base goals to be cancelled, for the robot and person to report their
+    # teleported pose and then for their histories to be primed (a whole observation window of states of the new
+    # episode), instead of sleeping a fixed 0.5s before and 2s after the teleport
+    RESET_CONVERGENCE = True
+    # Distance(meters) to the teleported position within which a robot counts as reset
+    RESET_POSE_TOLERANCE = 0.3
+    # Wall clock timeout(seconds) of every reset wait, the reset continues with a warning after it
+    RESET_TIMEOUT = 3.0
+
+    # If True, calls init_simulator() on set_agent() call
+    INIT_SIM_ON_AGENT = False
+
+    # If True, moves jackal bot out of the way and puts obstacles around person
+    TRAIN_HINN = False
+
+    # Headless simulator (gym_gazeboros_sim) only
+    # Number of obstacles per agent, the Gazebo env uses the obstacles of the world instead (6 in spawn_obstacles.launch)
+    SIM_NUM_OBSTACLES = 6
+    # Integration time step(seconds) of the kinematic model
+    SIM_TIME_STEP = 0.02
+    # Number of laser rays cast over 360 degree for the person scan before it is reduced to SCAN_REDUCTION_SIZE
+    # The person laser in Gazebo has 720, fewer rays only average less ranges per bin and are much cheaper
+    SIM_SCAN_RAYS = 180
+
+
+def wrap_angle(angle):
+    """
+    Vectorized wrap_pi_to_pi, angle can be a scalar or a numpy array
+    """
+    return (np.asarray(angle) + math.pi) % (2 * math.pi) - math.pi
+
+
+def to_frame(points, center_pos, center_orientation):
+    """
+    Transforms global points into the frame of center in one operation.
+    points: array like of shape [..., 2], e.g. [N, 2] or a single point of shape [2]
+    center_pos: (x, y) of the frame origin, shape [..., 2] broadcastable against points
+    center_orientation: heading of the frame in radian, broadcastable against points[..., 0]
+    returns numpy array with the same shape as points
+    """
+    points = np.asarray(points, dtype=np.float64)
+    center_pos = np.asarray(center_pos, dtype=np.float64)
+    cos_o = np.cos(center_orientation)
+    sin_o = np.sin(center_orientation)
+    dx = points[..., 0] - center_pos[..., 0]
+    dy = points[..., 1] - center_pos[..., 1]
+    relative = np.empty(np.broadcast(dx, cos_o).shape + (2,), dtype=np.float64)
+    relative[..., 0] = dx * cos_o + dy * sin_o
+    relative[..., 1] = dy * cos_o - dx * sin_o
+    return relative
+
+
+def from_frame(points, center_pos, center_orientation):
+    """
+    Inverse of to_frame, transforms points given in the frame of center to global points
+    """
+    points = np.asarray(points, dtype=np.float64)
+    center_pos = np.asarray(center_pos, dtype=np.float64)
+    cos_o = np.cos(center_orientation)
+    sin_o = np.sin(center_orientation)
+    global_pos = np.empty(np.broadcast(points[..., 0], cos_o).shape + (2,), dtype=np.float64)
+    global_pos[..., 0] = points[..., 0] * cos_o - points[..., 1] * sin_o + center_pos[..., 0]
+    global_pos[..., 1] = points[..., 0] * sin_o + points[..., 1] * cos_o + center_pos[..., 1]
+    return global_pos
+
+
+def reduce_scan(ranges, reduced_size, reducer="mean", percentile=10, max_range=20, large_n=1000.0):
+    """
+    Reduces laser ranges to reduced_size bins of consecutive ranges.
+    Ranges outside of (0, max_range) are ignored, bins without any valid range are set to large_n.
+    ranges: numpy array of the laser ranges, shape [..., num_ranges] to reduce several scans at once
+    reducer: "mean", "min" or "percentile"
+    """
+    ranges = np.asarray(ranges)
+    div = ranges.shape[-1] // reduced_size
+    bins = ranges[..., :div * reduced_size].astype(np.float64).reshape(ranges.shape[:-1] + (reduced_size, div))
+    valid = (bins > 0) & (bins < max_range)
+    bins = np.where(valid, bins, np.nan)
+    bins[~valid.any(axis=-1)] = large_n
+
+    if reducer == "mean":
+        return np.nanmean(bins, axis=-1)
+    elif reducer == "min":
+        return np.nanmin(bins, axis=-1)
+    elif reducer == "percentile":
+        return np.nanpercentile(bins, percentile, axis=-1)
+    raise ValueError("unknown scan reducer {}".format(reducer))
+
+
+def follow_ahead_reward(distance, angle_robot_person, collided, best_distance):
+    """
+    Reward of the follow ahead task, works on scalars or numpy arrays of envs.
+    distance: distance between robot and person
+    angle_robot_person: angle(degree) of the robot in the frame of the person
+    collided: True if the robot collided
+    """
+    distance = np.asarray(distance, dtype=np.float64)
+    abs_angle = np.abs(angle_robot_person)
+    distance_error = np.abs(distance - best_distance)
+
+    reward = np.where(collided, -1.0, 0.0)
+    reward = np.select(
+        [distance < 0.5,
+         distance_error < 0.5,
+         distance >= best_distance + 0.5,
+         distance < best_distance - 0.5],
+        [-1.3,
+         reward + 0.5 * (0.5 - distance_error),
+         reward - 0.25 * (distance - (best_distance + 0.5)),
+         reward - (best_distance - 0.5 - distance) / (best_distance - 0.5)],
+        reward)
+    # Negative reward for being behind the person
+    reward = reward + np.where(abs_angle < 25, 0.5 * (25 - abs_angle) / 25, -0.25 * abs_angle / 180)
+    reward = reward + np.where((distance_error < 0.5) & (abs_angle < 25), 0.25, 0)
+    return np.clip(reward, -1, 1)
+
+
+def build_observation(pos_his_robot, pos_his_person, heading_robot, heading_person, robot_vel, person_vel,
+                      center_pos, center_orientation, prev_action, person_scan, max_angular_vel,
+                      use_orientation=True, noise_rng=None):
+    """
+    Observation of a batch of envs, every argument has a leading env dimension K.
+    pos_his_robot, pos_his_person: [K, window_size, 2] position histories, latest first
+    heading_robot, heading_person: [K]
+    robot_vel, person_vel: [K, 2] (linear, angular)
+    center_pos, center_orientation: [K, 2], [K] pose of the frame of the relative positions
+    prev_action: [K, 2]
+    person_scan: [K, SCAN_REDUCTION_SIZE]
+    noise_rng: numpy random generator (or np.random) to add observation noise, None for no noise
+    returns [K, observation_dimensions]
+    """
+    num_envs = len(heading_robot)
+    poses = np.concatenate((pos_his_robot, pos_his_person), axis=1)
+    if noise_rng is not None:
+        poses = poses + noise_rng.normal(loc=0, scale=0.1, size=poses.shape)
+        heading_robot = heading_robot + noise_rng.normal(loc=0, scale=0.2, size=num_envs)
+        heading_person = heading_person + noise_rng.normal(loc=0, scale=0.2, size=num_envs)
+        robot_vel = robot_vel + noise_rng.normal(loc=0, scale=0.1, size=robot_vel.shape)
+        person_vel = person_vel + noise_rng.normal(loc=0, scale=0.1, size=person_vel.shape)
+
+    if EnvConfig.RETURN_HINN_STATE:
+        return np.concatenate((person_vel, np.reshape(heading_person, (num_envs, 1)),
+                               np.reshape(pos_his_person, (num_envs, -1)), person_scan), axis=1)
+
+    heading_relative = wrap_angle(heading_robot - heading_person) / math.pi
+    pos_rel = to_frame(poses, np.asarray(center_pos)[:, None, :], np.asarray(center_orientation)[:, None])
+    pos_history = pos_rel.reshape(num_envs, -1) / 6.0
+
+    velocities = np.concatenate((person_vel, robot_vel), axis=1) / max_angular_vel
+    if use_orientation:
+        velocities = np.concatenate((velocities, np.reshape(heading_relative, (num_envs, 1))), axis=1)
+    return np.concatenate((pos_history, velocities, prev_action), axis=1)
+
+
+def find_random_point_in_circle(radious, min_distance, around_point, rng=random):
+    r = (radious - min_distance) * math.sqrt(rng.random()) + min_distance
+    theta = rng.random() * 2 * math.pi
+    x = around_point[0] + r * math.cos(theta)
+    y = around_point[1] + r * math.sin(theta)
+    return (x, y)
+
+
+# Prevent point b from overlapping point a
+def prevent_overlap(point_a, point_b, min_distance):
+    x = point_b[0]
+    y = point_b[1]
+
+    if abs(point_b[0] - point_a[0]) < min_distance:
+        x += min_distance
+    if abs(point_b[1] - point_a[1]) < min_distance:
+        y += min_distance
+
+    return (x, y)
+
+
+def get_obstacle_init_pos(num_obstacles, init_pos_robot, init_pos_person, use_obstacles, obstacle_mode, rng=random):
+    """
+    rng: random.Random instance used for the random placement, the global random module by default
+    """
+    out_of_the_way_pose = {"pos": (15,15), "orientation":0}
+
+    if not use_obstacles:
+        return [out_of_the_way_pose for i in range(num_obstacles)]
+    elif obstacle_mode == 0:
+        # Place obstacles between robot and person
+
+        # Calculate distance between robots, subtract some buffer room
+        x_range = abs(init_pos_robot["pos"][0] - init_pos_person["pos"][0])
+        y_range = abs(init_pos_robot["pos"][1] - init_pos_person["pos"][1])
+
+        if x_range != 0:
+            x_range -= EnvConfig.OBSTACLE_SIZE
+        if y_range != 0:
+            y_range -= EnvConfig.OBSTACLE_SIZE
+
+        # Check if we have enough space for obstacles between robots
+        x_buffer_space = y_buffer_space = -1
+        num_obs_to_place = num_obstacles + 1
+        while x_buffer_space < 0 and y_buffer_space < 0:
+            num_obs_to_place -= 1
+            x_buffer_space = x_range - (EnvConfig.OBSTACLE_SIZE * num_obs_to_place)
+            y_buffer_space = y_range - ((EnvConfig.OBSTACLE_SIZE * num_obs_to_place))
+
+        if num_obs_to_place == 0:
+            # No space for obstacles so put them away
+            logger.warning("Not enough space for obstacles between robots.")
+            return [out_of_the_way_pose for i in range(num_obstacles)]
+
+        x_spacing = x_range / num_obs_to_place
+        y_spacing = y_range / num_obs_to_place
+
+        if init_pos_robot["pos"][0] < init_pos_person["pos"][0]:
+            base_x = init_pos_robot["pos"][0]
+        else:
+            base_x = init_pos_person["pos"][0]
+
+        if init_pos_robot["pos"][1] < init_pos_person["pos"][1]:
+            base_y = init_pos_robot["pos"][1]
+        else:
+            base_y = init_pos_person["pos"][1]
+
+        # Place obstacles on line between robot and person
+        obstacle_positions = []
+        for i in range(num_obs_to_place):
+            base_x += x_spacing
+            base_y += y_spacing
+            obstacle_positions.append({"pos": (base_x, base_y), "orientation":0})
+        obstacle_positions.extend([out_of_the_way_pose for i in range(num_obstacles - num_obs_to_place)])
+
+        return obstacle_positions
+
+    elif obstacle_mode == 1:
+        # Put obstacles randomly within area
+        obstacle_radius = EnvConfig.OBSTACLE_RADIUS_AWAY
+        min_distance_away_from_robot = EnvConfig.OBSTACLE_SIZE
+
+        obstacle_positions = []
+        for obs_idx in range(num_obstacles):
+            random_point = find_random_point_in_circle(obstacle_radius, min_distance_away_from_robot, init_pos_robot["pos"], rng)
+
+            random_point = prevent_overlap(init_pos_person["pos"], random_point, min_distance_away_from_robot)
+
+            obstacle_positions.append({"pos": random_point, "orientation":0})
+        return obstacle_positions
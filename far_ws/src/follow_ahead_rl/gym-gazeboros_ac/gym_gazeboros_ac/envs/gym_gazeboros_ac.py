@@ -18,6 +18,7 @@ import numpy as np
 import cv2 as cv
 
 import rospy
+from rospy.numpy_msg import numpy_msg
 # Brings in the SimpleActionClient
 import actionlib
 # Brings in the .action file and messages used by the move base action
@@ -36,10 +37,14 @@ from costmap_converter.msg import ObstacleArrayMsg
 from costmap_converter.msg import ObstacleMsg
 from gazebo_msgs.msg import ModelStates
 from geometry_msgs.msg import Twist
+from std_msgs.msg import Float64MultiArray
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 
 from gazebo_msgs.srv import SetModelState
+from std_srvs.srv import Empty
 from gym.utils import seeding
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import _thread
 
@@ -49,107 +54,119 @@ from simple_pid import PID
 import pickle
 import logging
 
-logger = logging.getLogger(__name__)
-
-# Environment Parameters
-class EnvConfig:
-    # Boolean to make robots spawn at constant locations
-    USE_TESTING = False
-
-    # Set to move obstacles out of the way in case they exist but you don't want them in the way
-    USE_OBSTACLES = False
-
-    # Pattern to init obstacles
-    # 0: Places obstacles between robot and person
-    # 1: Places obstacles randomly within circle
-    OBSTACLE_MODE = 1
-
-    # Radius(meters) away from person robot for random placement(mode 1) of objects
-    OBSTACLE_RADIUS_AWAY = 3
-
-    # Obstacle size
-    OBSTACLE_SIZE = 0.5
-
-    # Allows/Denies Robot TEB Local Planner to avoid obstacles
-    SEND_TEB_OBSTACLES = True
+from gym_gazeboros_ac.envs.model_states_demux import COMPACT_MODEL_STATES_TOPIC, MODEL_FIELDS, ROBOT_ROW, PERSON_ROW, OBSTACLE_FIRST_ROW
+from gym_gazeboros_ac.envs.common import EnvConfig, to_frame, reduce_scan, follow_ahead_reward, build_observation
+from gym_gazeboros_ac.envs.common import find_random_point_in_circle, get_obstacle_init_pos
+from gym_gazeboros_ac.envs.timing import StepTimer, CallbackProfiler
 
-    # Gets person robot to use move base
-    PERSON_USE_MB = True
-
-    # Episode Length
-    EPISODE_LEN = 15
-
-    # Returns Human State only in get_observations if True
-    RETURN_HINN_STATE = True
-
-    # Size to reduce laser scan to
-    SCAN_REDUCTION_SIZE = 20
-
-    # If True, calls init_simulator() on set_agent() call
-    INIT_SIM_ON_AGENT = False
-
-    # If True, moves jackal bot out of the way and puts obstacles around person
-    TRAIN_HINN = False
+logger = logging.getLogger(__name__)
 
 class History():
+    """
+    Ring buffer of the samples of one state channel (position, orientation, velocity).
+    Storage is a preallocated numpy array with one row per sample, the add times are kept
+    in a parallel float64 array. The array is allocated on the first add_element since the
+    shape of an element is only known then.
+    """
+    # Number of samples used to estimate avg_frame_rate
+    FRAME_RATE_SAMPLES = 51
+
     def __init__(self, window_size, update_rate, save_rate=10):
         self.idx = 0
         self.update_rate = update_rate
         self.save_rate = save_rate
         self.lock = threading.Lock()
         self.memory_size = int(math.ceil(save_rate/update_rate*window_size)+1)
-        self.data = [None for x in range(self.memory_size)]
+        self.data = None
+        self.time_data_ = np.zeros(self.memory_size, dtype=np.float64)
         self.prev_add_time = rospy.Time.now().to_sec() - 1
         self.window_size = window_size
         self.avg_frame_rate = None
-        self.time_data_= []
-
-    def add_element(self, element):
+        # set once avg_frame_rate is known, get_elemets waits on it
+        self.ready_ = threading.Event()
+        self.first_add_time_ = None
+        self.num_added_ = 0
+        # window indices are cached per skip_frames, see get_elemets
+        self.skip_frames_ = None
+        self.window_offsets_ = None
+        self.window_indices_ = np.zeros(self.window_size, dtype=np.int64)
+
+    def add_element(self, element, add_time=None):
         """
         element: the data that we put inside the history data array
+        add_time: time of the element in seconds, rospy time now if None
         """
-
-        if abs(rospy.Time.now().to_sec() - self.prev_add_time) < 1./self.save_rate:
+        now = rospy.Time.now().to_sec() if add_time is None else add_time
+        if abs(now - self.prev_add_time) < 1./self.save_rate:
             return
         with self.lock:
-            self.idx = (self.idx + 1) % self.window_size
-            self.prev_add_time = rospy.Time.now().to_sec()
-            if self.data[self.idx] is None:
-                for idx in range(self.memory_size):
-                    self.data[idx] = element
+            self.prev_add_time = now
+            if self.data is None:
+                self.data = np.empty((self.memory_size,) + np.shape(element), dtype=np.float64)
+                # fill the whole memory with the first element so a window is available right away
+                self.data[:] = element
+                self.time_data_.fill(now)
+            self.idx = (self.idx + 1) % self.memory_size
             self.data[self.idx] = element
-            if not len(self.time_data_) > 50:
-                self.time_data_.append(self.prev_add_time)
-                if len(self.time_data_) > 3:
-                    prev_t = self.time_data_[0]
-                    time_intervals = []
-                    for t in self.time_data_[1:]:
-                        time_intervals.append(t - prev_t)
-                        prev_t = t
-                    self.avg_frame_rate = 1.0 / np.average(time_intervals)
-
-    def get_elemets(self):
-        return_data = []
-        while self.avg_frame_rate is None:
-            time.sleep(0.1)
-        skip_frames = -int(math.ceil(self.avg_frame_rate / self.update_rate))
-        with self.lock:
-            index = self.idx #(self.idx - 1)% self.window_size
-            if self.window_size * abs(skip_frames) >= self.memory_size:
-                rospy.logerr("error in get element memory not enough update rate{} avg_frame_rate{} mem_size {} skipf: {}".format(self.update_rate, self.avg_frame_rate, self.memory_size, skip_frames))
-            for i in range (self.window_size):
-                return_data.append(self.data[index])
-                index = (index + skip_frames) % self.window_size
+            self.time_data_[self.idx] = now
 
-        return return_data
+            if self.first_add_time_ is None:
+                self.first_add_time_ = now
+            self.num_added_ += 1
+            if 3 < self.num_added_ <= self.FRAME_RATE_SAMPLES and now > self.first_add_time_:
+                # equal to 1 / average of the intervals between the samples
+                self.avg_frame_rate = (self.num_added_ - 1) / (now - self.first_add_time_)
+                self.ready_.set()
+
+    def window_span(self, frame_rate):
+        """
+        Number of consecutive samples a window of get_elemets covers at frame_rate
+        """
+        skip_frames = int(math.ceil(frame_rate / self.update_rate))
+        return min((self.window_size - 1) * skip_frames + 1, self.memory_size)
+
+    def is_primed(self):
+        """
+        True once every sample of the window of get_elemets was added, none is the padding of the first element
+        """
+        return self.avg_frame_rate is not None and self.num_added_ >= self.window_span(self.avg_frame_rate)
+
+    def window_duration(self):
+        """
+        Approximate seconds of samples a window of get_elemets covers, i.e. how long priming takes
+        """
+        return self.window_size / self.update_rate
+
+    def get_elemets(self, out=None):
+        """
+        Returns the window_size samples spaced to match update_rate, latest sample first.
+        The result is a single fancy indexed copy of the memory, or written into out if given.
+        """
+        while not self.ready_.wait(1.0):
+            rospy.logwarn("waiting for the history to have a frame rate")
+        skip_frames = int(math.ceil(self.avg_frame_rate / self.update_rate))
+        with self.lock:
+            if skip_frames != self.skip_frames_:
+                if self.window_size * skip_frames >= self.memory_size:
+                    rospy.logerr("error in get element memory not enough update rate{} avg_frame_rate{} mem_size {} skipf: {}".format(self.update_rate, self.avg_frame_rate, self.memory_size, -skip_frames))
+                self.skip_frames_ = skip_frames
+                self.window_offsets_ = np.arange(self.window_size, dtype=np.int64) * skip_frames
+            np.subtract(self.idx, self.window_offsets_, out=self.window_indices_)
+            np.mod(self.window_indices_, self.memory_size, out=self.window_indices_)
+            return np.take(self.data, self.window_indices_, axis=0, out=out)
 
     def get_latest(self):
         with self.lock:
-            return self.data[self.idx]
+            if self.data is None:
+                return None
+            return self.data[self.idx].copy()
 
 
 class Robot():
     def __init__(self, name, max_angular_speed=1, max_linear_speed=1, relative=None, agent_num=None, use_goal=False, use_movebase=False, use_jackal=False, window_size=10, is_testing=False):
+        # notified on set_state, new goal and reset, see wait_for
+        self.state_cond_ = threading.Condition()
+        self.reset_ = False
         self.name = name
         self.use_jackal = use_jackal
         self.init_node = False
@@ -206,6 +223,37 @@ class Robot():
         self.reset = False
         self.scan_image = None
 
+    @property
+    def reset(self):
+        return self.reset_
+
+    @reset.setter
+    def reset(self, value):
+        self.reset_ = value
+        # wake the waiters so they can return on reset
+        self.notify_state()
+
+    def notify_state(self):
+        with self.state_cond_:
+            self.state_cond_.notify_all()
+
+    def wait_for(self, predicate, timeout=None):
+        """
+        Blocks until predicate() is True or the robot is reset, without polling
+        returns False if it timed out
+        """
+        with self.state_cond_:
+            return self.state_cond_.wait_for(lambda: self.reset or predicate(), timeout)
+
+    def wait_current_state(self, log_msg):
+        """
+        Waits for the first state, logs log_msg every second while waiting
+        returns False if the robot was reset before it had a state
+        """
+        while not self.wait_for(self.is_current_state_ready, 1.0):
+            rospy.logwarn(log_msg)
+        return self.is_current_state_ready()
+
     def calculate_ahead(self, distance):
         x = self.state_['position'][0] + math.cos(self.state_["orientation"]) * distance
         y = self.state_['position'][1] + math.sin(self.state_["orientation"]) * distance
@@ -216,6 +264,15 @@ class Robot():
         self.action_client_.cancel_all_goals()
         self.stop_robot()
 
+    def wait_goal_cancelled(self, timeout):
+        """
+        Waits for move_base to confirm that the last goal ended, e.g. after movebase_cancel_goals
+        returns False if it timed out
+        """
+        if self.action_client_ is None or self.action_client_.simple_state == actionlib.SimpleGoalState.DONE:
+            return True
+        return self.action_client_.wait_for_result(rospy.Duration(timeout))
+
     def movebase_client_goal(self, goal_pos, goal_orientation):
        # Creates a new goal with the MoveBaseGoal constructor
         move_base_goal = MoveBaseGoal()
@@ -242,40 +299,42 @@ class Robot():
         #     return self.action_client_.get_result()
 
     def get_pos(self):
-        counter_problem = 0
-        while self.state_['position'] is None:
-            if self.reset:
-                return (None, None)
-            if counter_problem > 20:
-                rospy.logdebug("waiting for pos to be available {}/{}".format(counter_problem/10, 20))
-            time.sleep(0.001)
-            counter_problem += 1
-            if counter_problem > 200:
-                raise Exception('Probable shared memory issue happend')
-
+        if not self.wait_for(lambda: self.state_['position'] is not None, 0.2):
+            raise Exception('Probable shared memory issue happend')
+        if self.state_['position'] is None:
+            return (None, None)
         return self.state_['position']
 
     def get_orientation(self):
-        counter_problem = 0
-        while self.state_['orientation'] is None:
-            if self.reset:
-                return None
-            if counter_problem > 20:
-                rospy.logdebug("waiting for pos to be available {}/{}".format(counter_problem/10, 20))
-            time.sleep(0.001)
-            counter_problem += 1
-            if counter_problem > 200:
-                raise Exception('Probable shared memory issue happend')
+        if not self.wait_for(lambda: self.state_['orientation'] is not None, 0.2):
+            raise Exception('Probable shared memory issue happend')
         return self.state_['orientation']
 
     def is_current_state_ready(self):
         return (self.state_['position'][0] is not None)
 
+    def is_at(self, pos, tolerance):
+        position = self.state_['position']
+        return position[0] is not None and math.hypot(position[0] - pos[0], position[1] - pos[1]) <= tolerance
+
     def is_observation_ready(self):
         return (self.pos_history.avg_frame_rate is not None and\
                 self.orientation_history.avg_frame_rate is not None and\
                 self.velocity_history.avg_frame_rate is not None)
 
+    def is_history_primed(self):
+        return (self.pos_history.is_primed() and\
+                self.orientation_history.is_primed() and\
+                self.velocity_history.is_primed())
+
+    def wait_at(self, pos, tolerance, timeout):
+        """
+        Waits for a state within tolerance of pos, unlike wait_for it also waits while the robot is reset
+        returns False if it timed out
+        """
+        with self.state_cond_:
+            return self.state_cond_.wait_for(lambda: self.is_at(pos, tolerance), timeout)
+
     def update(self, init_pose):
         self.alive = True
         self.goal = {"pos": None, "orientation": None}
@@ -306,17 +365,22 @@ class Robot():
     def remove(self):
         self.reset = True
 
-    def set_state(self, state):
-        self.state_["position"] = state["position"]
-        self.state_["orientation"] = state["orientation"]
-        self.state_["velocity"] = state["velocity"]
-
-        self.orientation_history.add_element(state["orientation"])
-        self.pos_history.add_element(state["position"])
-        self.velocity_history.add_element(state["velocity"])
-        if self.is_testing and abs (rospy.Time.now().to_sec()- self.last_time_added) > 0.01:
-            self.all_pose_.append(self.state_.copy())
-            self.last_time_added = rospy.Time.now().to_sec()
+    def set_state(self, state, stamp=None):
+        """
+        stamp: time of the state in seconds, used for the histories. rospy time now if None
+        """
+        with self.state_cond_:
+            self.state_["position"] = state["position"]
+            self.state_["orientation"] = state["orientation"]
+            self.state_["velocity"] = state["velocity"]
+
+            self.orientation_history.add_element(state["orientation"], stamp)
+            self.pos_history.add_element(state["position"], stamp)
+            self.velocity_history.add_element(state["velocity"], stamp)
+            if self.is_testing and abs (rospy.Time.now().to_sec()- self.last_time_added) > 0.01:
+                self.all_pose_.append(self.state_.copy())
+                self.last_time_added = rospy.Time.now().to_sec()
+            self.state_cond_.notify_all()
 
     def get_state(self):
         return self.state_
@@ -349,6 +413,7 @@ class Robot():
                 self.goal["orientation"] = self.get_orientation()
 
             self.goal["pos"] = pos_global
+            self.notify_state()
 
             if self.use_movebase:
                 self.movebase_client_goal(pos_global, self.goal["orientation"])
@@ -423,9 +488,9 @@ class Robot():
         while True:
             if self.reset:
                 return
-            while self.goal["pos"] is None:
-                time.sleep(0.1)
-                continue
+            self.wait_for(lambda: self.goal["pos"] is not None)
+            if self.reset:
+                return
             diff_angle, distance = self.angle_distance_to_point(self.goal["pos"])
             time_prev = rospy.Time.now().to_sec()
             while not distance < 0.1 and abs(rospy.Time.now().to_sec() - time_prev) < 5:
@@ -486,16 +551,10 @@ class Robot():
             self.stop_robot()
 
     def get_goal(self):
-        counter_problem = 0
-        while self.goal["pos"] is None:
-            if self.reset:
-                return (None, None)
-            if counter_problem > 20:
-                rospy.logwarn("waiting for goal to be available {}/{}".format(counter_problem/10, 20))
-            time.sleep(0.01)
-            counter_problem += 1
-            if counter_problem > 200:
-                raise Exception('Probable shared memory issue happend')
+        if not self.wait_for(lambda: self.goal["pos"] is not None, 2.0):
+            raise Exception('Probable shared memory issue happend')
+        if self.goal["pos"] is None:
+            return (None, None)
         # if not self.use_movebase:
         #     pos = GazeborosEnv.get_global_position(self.goal["pos"], self)
         #     goal = {"pos":pos, "orientation":None}
@@ -546,7 +605,7 @@ class GazeborosEnv(gym.Env):
         self.obstacle_mode = EnvConfig.OBSTACLE_MODE
         self.obstacle_names = []
         
-        self.person_scan = [1000.0 for i in range(EnvConfig.SCAN_REDUCTION_SIZE)]
+        self.person_scan = np.full(EnvConfig.SCAN_REDUCTION_SIZE, 1000.0)
         self.person_use_move_base = EnvConfig.PERSON_USE_MB
         self.person_mode = 0
         self.position_thread = None
@@ -605,6 +664,7 @@ class GazeborosEnv(gym.Env):
         else:
             self.max_numb_steps = 80
         self.reward_range = [-1, 1]
+        self.step_timer = StepTimer(EnvConfig.STEP_TIMING, EnvConfig.STEP_TIMING_WINDOW)
         self.reachabilit_value = None
         if self.use_reachability:
             with open('data/reachability.pkl', 'rb') as f:
@@ -654,7 +714,18 @@ class GazeborosEnv(gym.Env):
         except Exception as e:
             rospy.logerr("probably already init in another node {}".format(e))
         rospy.wait_for_service('/gazebo/set_model_state')
-        self.set_model_state_sp = rospy.ServiceProxy('/gazebo/set_model_state', SetModelState)
+        # one persistent set_model_state connection per thread, see get_set_model_state_sp
+        self.set_model_state_local_ = threading.local()
+        self.set_model_state_executor_ = None
+        if EnvConfig.SET_MODEL_STATE_MODE == "topic":
+            self.set_model_state_pub_ = rospy.Publisher('/gazebo/set_model_state', ModelState, queue_size=100)
+        elif EnvConfig.SET_MODEL_STATE_CONCURRENCY > 1:
+            self.set_model_state_executor_ = ThreadPoolExecutor(max_workers=EnvConfig.SET_MODEL_STATE_CONCURRENCY)
+        if EnvConfig.STEP_MODE == "lockstep":
+            rospy.wait_for_service('/gazebo/pause_physics')
+            rospy.wait_for_service('/gazebo/unpause_physics')
+            self.pause_physics_sp = rospy.ServiceProxy('/gazebo/pause_physics', Empty, persistent=True)
+            self.unpause_physics_sp = rospy.ServiceProxy('/gazebo/unpause_physics', Empty, persistent=True)
         date_time = datetime.now().strftime("%m_%d_%Y_%H_%M_%S")
         self.agent_num = agent_num
         self.obstacle_pub_ =  rospy.Publisher('/move_base_node_tb3_{}/TebLocalPlannerROS/obstacles'.format(self.agent_num), ObstacleArrayMsg, queue_size=1)
@@ -688,160 +759,354 @@ class GazeborosEnv(gym.Env):
         self.agent_num = agent_num
 
         self.state_cb_prev_time = None
-        self.model_states_sub = rospy.Subscriber("/gazebo/model_states", ModelStates, self.model_states_cb)
-        self.scan_sub = rospy.Subscriber("/person_{}/scan".format(self.agent_num), LaserScan, self.scan_cb)
+        self.model_names_ = None
+        self.prev_state_update_time_ = None
+        self.prev_obstacle_publish_time_ = None
+        self.state_update_period_ = 1.0 / EnvConfig.STATE_UPDATE_RATE if EnvConfig.STATE_UPDATE_RATE else 0
+        self.obstacle_publish_period_ = 1.0 / EnvConfig.OBSTACLE_PUBLISH_RATE if EnvConfig.OBSTACLE_PUBLISH_RATE else 0
+        self.num_compact_models_ = None
+        # ROS time of the last robot state update, step() waits on it in the "clock" and "lockstep" modes
+        self.last_state_time_ = None
+        self.state_cond_ = threading.Condition()
+        self.callback_profilers_ = {}
+        # dropped messages of every callback at the last diagnostics publish
+        self.prev_dropped_ = {}
+        if EnvConfig.USE_MODEL_STATES_DEMUX:
+            # the compact state has no model names, read them once from the full message
+            self.update_model_indices(rospy.wait_for_message("/gazebo/model_states", ModelStates).name)
+            self.model_states_sub = rospy.Subscriber(COMPACT_MODEL_STATES_TOPIC.format(self.agent_num), numpy_msg(Float64MultiArray),
+                                                     self.profiled_callback("model_states", self.compact_model_states_cb))
+        else:
+            self.model_states_sub = rospy.Subscriber("/gazebo/model_states", ModelStates,
+                                                     self.profiled_callback("model_states", self.model_states_cb))
+        self.scan_sub = rospy.Subscriber("/person_{}/scan".format(self.agent_num), numpy_msg(LaserScan),
+                                         self.profiled_callback("scan", self.scan_cb))
+        if EnvConfig.CALLBACK_PROFILING and EnvConfig.CALLBACK_DIAGNOSTICS_PERIOD:
+            self.diagnostics_pub_ = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size=1)
+            self.diagnostics_timer_ = rospy.Timer(rospy.Duration(EnvConfig.CALLBACK_DIAGNOSTICS_PERIOD), self.publish_callback_diagnostics)
 
         if EnvConfig.INIT_SIM_ON_AGENT:
             with self.lock:
                 self.init_simulator()
     
-    def scan_cb(self, msg):
-        reduced_size = EnvConfig.SCAN_REDUCTION_SIZE
-        large_n = 1000.0
-
-        div = int(len(msg.ranges)/reduced_size)
-        reduced_scan = []
-
-        count = 0
-        a_size = 0
-        avg = 0
-
-        # Reduce from 720 to reduced size
-        for r in msg.ranges:
-            if r > 0 and r < 20:
-                avg += r
-                a_size += 1
-            
-            count += 1
-            if count == div:
-                if a_size != 0:
-                    avg /= a_size
-                else:
-                    avg = large_n
-
-                reduced_scan.append(avg)
+    def profiled_callback(self, name, callback):
+        """
+        Returns callback wrapped to record its statistics under name if EnvConfig.CALLBACK_PROFILING, callback itself otherwise
+        """
+        if not EnvConfig.CALLBACK_PROFILING:
+            return callback
+        profiler = self.callback_profilers_[name] = CallbackProfiler(EnvConfig.STEP_TIMING_WINDOW)
+
+        def profiled(msg):
+            arrival = time.monotonic()
+            lag = seq = None
+            header = getattr(msg, "header", None)
+            if header is not None:
+                seq = header.seq
+                if not header.stamp.is_zero():
+                    lag = rospy.get_time() - header.stamp.to_sec()
+            callback(msg)
+            profiler.record(arrival, time.monotonic() - arrival, lag, seq)
+        return profiled
+
+    def get_callback_stats(self):
+        """
+        Statistics of the model states and scan callbacks, see CallbackProfiler.get_stats. Empty unless EnvConfig.CALLBACK_PROFILING
+        """
+        return {name: profiler.get_stats() for name, profiler in self.callback_profilers_.items()}
 
-                count = 0
-                a_size = 0
-                avg = 0
-                
+    def publish_callback_diagnostics(self, event=None):
+        """
+        Publishes the callback statistics on /diagnostics, a callback that dropped messages since the last publish is a warning
+        """
+        diagnostics = DiagnosticArray()
+        diagnostics.header.stamp = rospy.Time.now()
+        for name, stats in self.get_callback_stats().items():
+            status = DiagnosticStatus()
+            status.name = "gym_gazeboros_{}/{}_cb".format(self.agent_num, name)
+            status.hardware_id = "agent_{}".format(self.agent_num)
+            dropped = stats["dropped"] - self.prev_dropped_.get(name, 0)
+            self.prev_dropped_[name] = stats["dropped"]
+            if dropped > 0:
+                status.level = DiagnosticStatus.WARN
+                status.message = "dropped {} messages".format(dropped)
+            else:
+                status.level = DiagnosticStatus.OK
+                status.message = "OK"
+            status.values = [KeyValue(key, "{:.3f}".format(value) if isinstance(value, float) else str(value))
+                             for key, value in stats.items()]
+            diagnostics.status.append(status)
+        self.diagnostics_pub_.publish(diagnostics)
 
-        self.person_scan = reduced_scan
-        pass
+    def scan_cb(self, msg):
+        # msg.ranges is a numpy view on the message buffer as the topic is subscribed with numpy_msg
+        self.person_scan = reduce_scan(msg.ranges, EnvConfig.SCAN_REDUCTION_SIZE,
+                                      EnvConfig.SCAN_REDUCER, EnvConfig.SCAN_REDUCER_PERCENTILE)
 
-    def create_obstacle_msg(self, name, pose):
+    def create_obstacle_msg(self):
         obstacle_msg = ObstacleMsg()
         obstacle_msg.id = 1
 
-        point = Point32()
-        point.x = pose.position.x
-        point.y = pose.position.y
-        point.z = pose.position.z
-
-        obstacle_msg.polygon.points.append(point)
+        obstacle_msg.polygon.points.append(Point32())
 
         # TODO probably needs some tweaking but works for regular cyn/box
         #   - I think the robot could be ok to get closer to the obstacles?
         # TODO polygon for box instead of using a circle
         obstacle_msg.radius = EnvConfig.OBSTACLE_SIZE/2
 
-        obstacle_msg.orientation.x = pose.orientation.x
-        obstacle_msg.orientation.y = pose.orientation.y
-        obstacle_msg.orientation.z = pose.orientation.z
-        obstacle_msg.orientation.w = pose.orientation.w
         obstacle_msg.velocities.twist.linear.x = 0
         obstacle_msg.velocities.twist.angular.z = 0
-        
+
         return obstacle_msg
 
-    def model_states_cb(self, states_msg):
+    def update_obstacle_msg(self, obstacle_msg, x, y, z, qx, qy, qz, qw):
+        """
+        Updates an obstacle message created by create_obstacle_msg in place
+        """
+        point = obstacle_msg.polygon.points[0]
+        point.x = x
+        point.y = y
+        point.z = z
+
+        obstacle_msg.orientation.x = qx
+        obstacle_msg.orientation.y = qy
+        obstacle_msg.orientation.z = qz
+        obstacle_msg.orientation.w = qw
+
+    def create_robot_obstacle_msg(self, header):
+        """
+        Obstacle message of a robot for the TEB planner of the other robot, a 5x5 grid of points around its position
+        """
+        obstacle_msg = ObstacleMsg()
+        obstacle_msg.id = 0
+        obstacle_msg.header = header
+        obstacle_msg.polygon.points = [Point32() for _ in range(25)]
+        return obstacle_msg
+
+    def update_robot_obstacle_msg(self, obstacle_msg, x, y, z, qx, qy, qz, qw, linear_x, linear_z):
+        """
+        Updates an obstacle message created by create_robot_obstacle_msg in place
+        """
+        for grid_x in range (5):
+            for grid_y in range (5):
+                point = obstacle_msg.polygon.points[grid_x * 5 + grid_y]
+                point.x = x + (grid_x-2)*0.1
+                point.y = y + (grid_y-2)*0.1
+                point.z = z
+        obstacle_msg.orientation.x = qx
+        obstacle_msg.orientation.y = qy
+        obstacle_msg.orientation.z = qz
+        obstacle_msg.orientation.w = qw
+        obstacle_msg.velocities.twist.linear.x = linear_x
+        obstacle_msg.velocities.twist.angular.z = linear_z
+
+    def update_model_indices(self, names):
+        """
+        Caches the index of the robots and obstacles in /gazebo/model_states and preallocates
+        the obstacle messages sent to the TEB planners. Only called when the list of models changes.
+        """
+        self.model_names_ = list(names)
 
         # Grab Obstacle Names for Agent
         if not self.obstacle_names:
-            for name in states_msg.name:
+            for name in names:
                 if "obstacle" in name:
                     for char in name:
                         if char.isdigit():
                             if int(char) == self.agent_num:
                                 self.obstacle_names.append(name)
 
-        obstacle_msg_array = ObstacleArrayMsg()
-        obstacle_msg_array.header.stamp = rospy.Time.now()
-        obstacle_msg_array.header.frame_id = "tb3_{}/odom".format(self.agent_num)
-
-        person_obs_msg_array = ObstacleArrayMsg()
-        person_obs_msg_array.header.stamp = rospy.Time.now()
-        person_obs_msg_array.header.frame_id = "person_{}/odom".format(self.agent_num)
-
-        for model_idx in range(len(states_msg.name)):
-            found = False
-            for robot in [self.robot, self.person]:
-                if states_msg.name[model_idx] == robot.name:
-                    found = True
-                    break
-                elif "obstacle" in states_msg.name[model_idx] and EnvConfig.SEND_TEB_OBSTACLES:
-                    obstacle_msg_array.obstacles.append(
-                        self.create_obstacle_msg(
-                            states_msg.name[model_idx], states_msg.pose[model_idx]
-                        )
-                    )
-                    person_obs_msg_array.obstacles.append(
-                        self.create_obstacle_msg(
-                            states_msg.name[model_idx], states_msg.pose[model_idx]
-                        )
-                    )
-            if not found:                
-                continue                
+        self.robot_model_indices_ = []
+        for robot in [self.robot, self.person]:
+            if robot.name in self.model_names_:
+                self.robot_model_indices_.append((self.model_names_.index(robot.name), robot))
 
-            pos = states_msg.pose[model_idx]
-            euler = Quaternion(w=pos.orientation.w, x=pos.orientation.x, y=pos.orientation.y, z=pos.orientation.z).to_euler()
+        self.allocate_obstacle_msgs([idx for idx, name in enumerate(self.model_names_) if "obstacle" in name])
 
-            if EnvConfig.PERSON_USE_MB:
-                orientation = euler[2]
+    def update_compact_indices(self, num_models):
+        """
+        Same as update_model_indices for the rows of a compact state from model_states_demux
+        """
+        self.num_compact_models_ = num_models
+        self.robot_model_indices_ = [(ROBOT_ROW, self.robot), (PERSON_ROW, self.person)]
+        self.allocate_obstacle_msgs(list(range(OBSTACLE_FIRST_ROW, num_models)))
+
+    def allocate_obstacle_msgs(self, obstacle_indices):
+        self.obstacle_msg_array_ = ObstacleArrayMsg()
+        self.obstacle_msg_array_.header.frame_id = "tb3_{}/odom".format(self.agent_num)
+        self.person_obs_msg_array_ = ObstacleArrayMsg()
+        self.person_obs_msg_array_.header.frame_id = "person_{}/odom".format(self.agent_num)
+
+        # (model index, obstacle message), the message is shared by both arrays
+        self.obstacle_model_msgs_ = []
+        if EnvConfig.SEND_TEB_OBSTACLES:
+            for model_idx in obstacle_indices:
+                obstacle_msg = self.create_obstacle_msg()
+                self.obstacle_msg_array_.obstacles.append(obstacle_msg)
+                self.person_obs_msg_array_.obstacles.append(obstacle_msg)
+                self.obstacle_model_msgs_.append((model_idx, obstacle_msg))
+
+        # robot name -> obstacle message of that robot in the array of the other robot, only for the robots in
+        # the model states, a missing one would stay a phantom obstacle at the origin
+        self.robot_obstacle_msgs_ = {}
+        if self.use_movebase:
+            other_arrays = {self.person.name: self.obstacle_msg_array_, self.robot.name: self.person_obs_msg_array_}
+            for _, robot in self.robot_model_indices_:
+                msg_array = other_arrays[robot.name]
+                robot_msg = self.create_robot_obstacle_msg(msg_array.header)
+                msg_array.obstacles.append(robot_msg)
+                self.robot_obstacle_msgs_[robot.name] = robot_msg
+
+    @staticmethod
+    def is_tick_due(now, prev_time, period):
+        # abs so a simulation time reset does not stall the updates
+        return prev_time is None or abs(now - prev_time) >= period
+
+    def get_state_ticks(self):
+        """
+        returns (update_states, publish_obstacles) for a model states message received now
+        """
+        now = rospy.get_time()
+        update_states = GazeborosEnv.is_tick_due(now, self.prev_state_update_time_, self.state_update_period_)
+        publish_obstacles = GazeborosEnv.is_tick_due(now, self.prev_obstacle_publish_time_, self.obstacle_publish_period_)
+        if update_states:
+            self.prev_state_update_time_ = now
+        if publish_obstacles:
+            self.prev_obstacle_publish_time_ = now
+        return now, update_states, publish_obstacles
+
+    def notify_state_update(self, stamp):
+        with self.state_cond_:
+            self.last_state_time_ = stamp
+            self.state_cond_.notify_all()
+
+    def wait_for_state(self, target_time, timeout=None):
+        """
+        Blocks until the robot states of ROS time target_time or later arrived
+        timeout: wall clock seconds, EnvConfig.STEP_TIMEOUT if None
+        returns False if it timed out
+        """
+        if timeout is None:
+            timeout = EnvConfig.STEP_TIMEOUT
+        with self.state_cond_:
+            is_fresh = self.state_cond_.wait_for(
+                lambda: self.last_state_time_ is not None and self.last_state_time_ >= target_time, timeout)
+        if not is_fresh:
+            rospy.logwarn("no state of time {:.3f} after {}s, last state {}".format(target_time, timeout, self.last_state_time_))
+        return is_fresh
+
+    def set_physics_paused(self, paused):
+        if EnvConfig.STEP_MODE != "lockstep":
+            return
+        try:
+            if paused:
+                self.pause_physics_sp()
             else:
-                # Preserve how Payam had it setup...
-                orientation = euler[0]
+                self.unpause_physics_sp()
+        except rospy.ServiceException as e:
+            rospy.logerr("failed to {} physics: {}".format("pause" if paused else "unpause", e))
 
-            fall_angle = np.deg2rad(90)
-            if abs(abs(euler[1]) - fall_angle)< 0.1 or abs(abs(euler[2]) - fall_angle)<0.1:
-                self.fallen = True
-            # get velocity
+    def wait_control_period(self, period, start_time=None):
+        """
+        Lets the simulation run for period seconds of ROS time, see EnvConfig.STEP_MODE
+        start_time: ROS time the period started at, now if None. Consecutive sub-periods of one step pass
+                    absolute start times so the waits for the next state update do not add up
+        """
+        if EnvConfig.STEP_MODE == "sleep":
+            rospy.sleep(period)
+            return
+        if start_time is None:
+            start_time = rospy.get_time()
+        # the states are decimated to STATE_UPDATE_RATE, the first update at or after the end of the period is fresh
+        target_time = start_time + period
+        self.set_physics_paused(False)
+        self.wait_for_state(target_time)
+        self.set_physics_paused(True)
+
+    def update_robot_state(self, robot, x, y, qx, qy, qz, qw, linear_vel, angular_vel, stamp):
+        euler = Quaternion(w=qw, x=qx, y=qy, z=qz).to_euler()
+
+        if EnvConfig.PERSON_USE_MB:
+            orientation = euler[2]
+        else:
+            # Preserve how Payam had it setup...
+            orientation = euler[0]
+
+        fall_angle = np.deg2rad(90)
+        if abs(abs(euler[1]) - fall_angle)< 0.1 or abs(abs(euler[2]) - fall_angle)<0.1:
+            self.fallen = True
+        state = {}
+        state["velocity"] = (linear_vel, angular_vel)
+        state["position"] = (x, y)
+        state["orientation"] = orientation
+
+        robot.set_state(state, stamp)
+
+    def publish_obstacle_msgs(self):
+        stamp = rospy.Time.now()
+        self.obstacle_msg_array_.header.stamp = stamp
+        self.person_obs_msg_array_.header.stamp = stamp
+        self.obstacle_pub_.publish(self.obstacle_msg_array_)
+        self.person_obstacle_pub_.publish(self.person_obs_msg_array_)
+
+    def model_states_cb(self, states_msg):
+        now, update_states, publish_obstacles = self.get_state_ticks()
+        if not update_states and not publish_obstacles:
+            return
+
+        if states_msg.name != self.model_names_:
+            self.update_model_indices(states_msg.name)
+
+        for model_idx, robot in self.robot_model_indices_:
+            pos = states_msg.pose[model_idx]
             twist = states_msg.twist[model_idx]
-            linear_vel = twist.linear.x
-            angular_vel = twist.angular.z
-            pos_x = pos.position.x
-            pos_y = pos.position.y
-            state = {}
-            state["velocity"] = (linear_vel, angular_vel)
-            state["position"] = (pos_x, pos_y)
-            state["orientation"] = orientation
-            
-            robot.set_state(state)
-            if self.use_movebase:
-                obstacle_msg = ObstacleMsg()
-                obstacle_msg.id = 0
-                for x in range (5):
-                    for y in range (5):
-                        point = Point32()
-                        point.x = pos.position.x + (x-2)*0.1
-                        point.y = pos.position.y + (y-2)*0.1
-                        point.z = pos.position.z
-                        obstacle_msg.polygon.points.append(point)
-                obstacle_msg.orientation.x = pos.orientation.x
-                obstacle_msg.orientation.y = pos.orientation.y
-                obstacle_msg.orientation.z = pos.orientation.z
-                obstacle_msg.orientation.w = pos.orientation.w
-                obstacle_msg.velocities.twist.linear.x = twist.linear.x
-                obstacle_msg.velocities.twist.angular.z = twist.linear.z
-                
-                if robot.name == self.person.name:
-                    obstacle_msg.header = obstacle_msg_array.header
-                    obstacle_msg_array.obstacles.append(obstacle_msg)
-                else:
-                    obstacle_msg.header = person_obs_msg_array.header
-                    person_obs_msg_array.obstacles.append(obstacle_msg)
-        self.obstacle_pub_.publish(obstacle_msg_array)
-        self.person_obstacle_pub_.publish(person_obs_msg_array)
+            if publish_obstacles and self.use_movebase:
+                self.update_robot_obstacle_msg(self.robot_obstacle_msgs_[robot.name],
+                                               pos.position.x, pos.position.y, pos.position.z,
+                                               pos.orientation.x, pos.orientation.y, pos.orientation.z, pos.orientation.w,
+                                               twist.linear.x, twist.linear.z)
+            if update_states:
+                self.update_robot_state(robot, pos.position.x, pos.position.y,
+                                        pos.orientation.x, pos.orientation.y, pos.orientation.z, pos.orientation.w,
+                                        twist.linear.x, twist.angular.z, now)
+
+        if publish_obstacles:
+            for model_idx, obstacle_msg in self.obstacle_model_msgs_:
+                pos = states_msg.pose[model_idx]
+                self.update_obstacle_msg(obstacle_msg, pos.position.x, pos.position.y, pos.position.z,
+                                         pos.orientation.x, pos.orientation.y, pos.orientation.z, pos.orientation.w)
+            self.publish_obstacle_msgs()
+
+        if update_states:
+            self.notify_state_update(now)
+
+    def compact_model_states_cb(self, msg):
+        """
+        Callback of the compact state published by model_states_demux, see EnvConfig.USE_MODEL_STATES_DEMUX
+        """
+        now, update_states, publish_obstacles = self.get_state_ticks()
+        if not update_states and not publish_obstacles:
+            return
+
+        rows = msg.data.reshape(-1, MODEL_FIELDS)
+        if len(rows) != self.num_compact_models_:
+            self.update_compact_indices(len(rows))
+        rows = rows.tolist()
+
+        for row_idx, robot in self.robot_model_indices_:
+            x, y, z, qx, qy, qz, qw, linear_x, linear_z, angular_z = rows[row_idx]
+            if publish_obstacles and self.use_movebase:
+                self.update_robot_obstacle_msg(self.robot_obstacle_msgs_[robot.name], x, y, z, qx, qy, qz, qw, linear_x, linear_z)
+            if update_states:
+                self.update_robot_state(robot, x, y, qx, qy, qz, qw, linear_x, angular_z, now)
+
+        if publish_obstacles:
+            for row_idx, obstacle_msg in self.obstacle_model_msgs_:
+                self.update_obstacle_msg(obstacle_msg, *rows[row_idx][:7])
+            self.publish_obstacle_msgs()
+
+        if update_states:
+            self.notify_state_update(now)
 
     def create_robots(self):
 
@@ -853,14 +1118,6 @@ class GazeborosEnv(gym.Env):
         self.robot = Robot('tb3_{}'.format(self.agent_num),
                             max_angular_speed=1.8, max_linear_speed=0.8, relative=relative, agent_num=self.agent_num, use_goal=self.use_goal, use_movebase=self.use_movebase ,use_jackal=self.use_jackal, window_size=self.window_size, is_testing=self.is_testing)
 
-    def find_random_point_in_circle(self, radious, min_distance, around_point):
-        max_r = 2
-        r = (radious - min_distance) * math.sqrt(random.random()) + min_distance
-        theta = random.random() * 2 * math.pi
-        x = around_point[0] + r * math.cos(theta)
-        y = around_point[1] + r * math.sin(theta)
-        return (x, y)
-
     def set_mode_person_based_on_episode_number(self, episode_number):
         if episode_number < 500:
             self.mode_person = 0
@@ -896,7 +1153,7 @@ class GazeborosEnv(gym.Env):
             x = random.uniform(-3,3)
             y = random.uniform(-3,3)
             init_pos_person = {"pos": (x, y), "orientation":random.uniform(0, math.pi)}
-            random_pos_robot = self.find_random_point_in_circle(1.5, 2.5, init_pos_person["pos"])
+            random_pos_robot = find_random_point_in_circle(1.5, 2.5, init_pos_person["pos"])
 
             init_pos_robot = {"pos": random_pos_robot, "orientation":random.uniform(0, math.pi)}
             
@@ -924,12 +1181,12 @@ class GazeborosEnv(gym.Env):
         elif not self.use_path:
             init_pos_person = {"pos": (0, 0), "orientation": random.random()*2*math.pi - math.pi}
             ahead_person = (init_pos_person['pos'][0] + math.cos(init_pos_person["orientation"]) * 2, init_pos_person['pos'][1] + math.sin(init_pos_person["orientation"]) * 2)
-            random_pos_robot = self.find_random_point_in_circle(1.5, 2.5, init_pos_person["pos"])
+            random_pos_robot = find_random_point_in_circle(1.5, 2.5, init_pos_person["pos"])
             init_pos_robot = {"pos": random_pos_robot,\
                               "orientation": init_pos_person["orientation"]}#random.random()*2*math.pi - math.pi}#self.calculate_angle_using_path(idx_start)}
         elif self.use_random_around_person_:
             init_pos_person = {"pos": self.path["points"][idx_start], "orientation": self.calculate_angle_using_path(idx_start)}
-            init_pos_robot = {"pos": self.find_random_point_in_circle(1.5, 1, self.path["points"][idx_start]),\
+            init_pos_robot = {"pos": find_random_point_in_circle(1.5, 1, self.path["points"][idx_start]),\
                               "orientation": random.random()*2*math.pi - math.pi}#self.calculate_angle_using_path(idx_start)}
         else:
             init_pos_person = {"pos": self.path["points"][idx_start], "orientation": self.calculate_angle_using_path(idx_start)}
@@ -957,10 +1214,9 @@ class GazeborosEnv(gym.Env):
         pose = {"pos": (xy[0], xy[1]), "orientation": 0}
         self.set_pos("marker",pose)        
 
-    def set_pos(self, name, pose):
+    def create_model_state_msg(self, name, pose):
         set_model_msg = ModelState()
         set_model_msg.model_name = name
-        self.prev_action = (0,0)
         quaternion_rotation = Quaternion.from_euler(0, pose["orientation"], 0)
 
 
@@ -977,94 +1233,58 @@ class GazeborosEnv(gym.Env):
             set_model_msg.pose.position.z = 2.6 * self.agent_num + 0.099
         set_model_msg.pose.position.x = pose["pos"][0]
         set_model_msg.pose.position.y = pose["pos"][1]
-        rospy.wait_for_service('/gazebo/set_model_state')
-        self.set_model_state_sp(set_model_msg)
+        return set_model_msg
 
-    def get_obstacle_init_pos(self, init_pos_robot, init_pos_person):
-        num_obstacles = len(self.obstacle_names)
-        
-        out_of_the_way_pose = {"pos": (15,15), "orientation":0}
-
-        if not self.use_obstacles:
-            return [out_of_the_way_pose for i in range(num_obstacles)]
-        elif self.obstacle_mode == 0:
-            # Place obstacles between robot and person
-
-            # Calculate distance between robots, subtract some buffer room
-            x_range = abs(init_pos_robot["pos"][0] - init_pos_person["pos"][0])
-            y_range = abs(init_pos_robot["pos"][1] - init_pos_person["pos"][1])
-
-            if x_range != 0:
-                x_range -= EnvConfig.OBSTACLE_SIZE
-            if y_range != 0:
-                y_range -= EnvConfig.OBSTACLE_SIZE
-
-            # Check if we have enough space for obstacles between robots
-            x_buffer_space = y_buffer_space = -1
-            num_obs_to_place = num_obstacles + 1
-            while x_buffer_space < 0 and y_buffer_space < 0:
-                num_obs_to_place -= 1
-                x_buffer_space = x_range - (EnvConfig.OBSTACLE_SIZE * num_obs_to_place)
-                y_buffer_space = y_range - ((EnvConfig.OBSTACLE_SIZE * num_obs_to_place))
-            
-            if num_obs_to_place == 0:
-                # No space for obstacles so put them away
-                rospy.logwarn("Not enough space for obstacles between robots.")
-                return [out_of_the_way_pose for i in range(num_obstacles)]
-
-            x_spacing = x_range / num_obs_to_place
-            y_spacing = y_range / num_obs_to_place
-
-            if init_pos_robot["pos"][0] < init_pos_person["pos"][0]:
-                base_x = init_pos_robot["pos"][0]
-            else:
-                base_x = init_pos_person["pos"][0]
-            
-            if init_pos_robot["pos"][1] < init_pos_person["pos"][1]:
-                base_y = init_pos_robot["pos"][1]
-            else:
-                base_y = init_pos_person["pos"][1]
-
-            # Place obstacles on line between robot and person
-            obstacle_positions = []
-            for i in range(num_obs_to_place):
-                base_x += x_spacing
-                base_y += y_spacing
-                obstacle_positions.append({"pos": (base_x, base_y), "orientation":0})
-            obstacle_positions.extend([out_of_the_way_pose for i in range(num_obstacles - num_obs_to_place)])
-
-            return obstacle_positions
-        
-        elif self.obstacle_mode == 1:
-            # Put obstacles randomly within area
-            obstacle_radius = EnvConfig.OBSTACLE_RADIUS_AWAY
-            min_distance_away_from_robot = EnvConfig.OBSTACLE_SIZE
-
-            obstacle_positions = []
-            for obs_idx in range(num_obstacles):
-                random_point = self.find_random_point_in_circle(obstacle_radius, min_distance_away_from_robot, init_pos_robot["pos"])
-                
-                random_point = self.prevent_overlap(init_pos_person["pos"], random_point, min_distance_away_from_robot)
+    def get_set_model_state_sp(self):
+        """
+        Persistent set_model_state proxy of the calling thread, a proxy must not be called by two threads at once
+        """
+        proxy = getattr(self.set_model_state_local_, "proxy", None)
+        if proxy is None:
+            proxy = rospy.ServiceProxy('/gazebo/set_model_state', SetModelState, persistent=True)
+            self.set_model_state_local_.proxy = proxy
+        return proxy
 
-                obstacle_positions.append({"pos": random_point, "orientation":0})
-            return obstacle_positions
+    def call_set_model_state(self, set_model_msg):
+        try:
+            self.get_set_model_state_sp()(set_model_msg)
+        except rospy.ServiceException as e:
+            # a persistent connection does not reconnect by itself, e.g. after gazebo restarted
+            rospy.logwarn("set_model_state of {} failed, reconnecting: {}".format(set_model_msg.model_name, e))
+            self.set_model_state_local_.proxy.close()
+            self.set_model_state_local_.proxy = None
+            rospy.wait_for_service('/gazebo/set_model_state')
+            self.get_set_model_state_sp()(set_model_msg)
+
+    def set_model_poses(self, name_poses):
+        """
+        Moves all the models of name_poses, a list of (name, pose), in one go, see EnvConfig.SET_MODEL_STATE_MODE
+        """
+        self.prev_action = (0,0)
+        set_model_msgs = [self.create_model_state_msg(name, pose) for name, pose in name_poses]
+        if EnvConfig.SET_MODEL_STATE_MODE == "topic":
+            for set_model_msg in set_model_msgs:
+                self.set_model_state_pub_.publish(set_model_msg)
+        elif self.set_model_state_executor_ is None or len(set_model_msgs) == 1:
+            for set_model_msg in set_model_msgs:
+                self.call_set_model_state(set_model_msg)
+        else:
+            # overlaps the round trips, list() waits for all of them and raises the first error
+            list(self.set_model_state_executor_.map(self.call_set_model_state, set_model_msgs))
 
-    # Prevent point b from overlapping point a
-    def prevent_overlap(self, point_a, point_b, min_distance):
-        x = point_b[0]
-        y = point_b[1]
+    def set_pos(self, name, pose):
+        self.set_model_poses([(name, pose)])
 
-        if abs(point_b[0] - point_a[0]) < min_distance:
-            x += min_distance
-        if abs(point_b[1] - point_a[1]) < min_distance:
-            y += min_distance
-        
-        return (x, y)
+    def get_obstacle_poses(self, init_pos_robot, init_pos_person):
+        """
+        returns the (name, pose) of every obstacle for a reset
+        """
+        obs_positions = get_obstacle_init_pos(len(self.obstacle_names), init_pos_robot, init_pos_person,
+                                              self.use_obstacles, self.obstacle_mode)
+        return list(zip(self.obstacle_names, obs_positions))
 
     def set_obstacle_pos(self, init_pos_robot, init_pos_person):
-        obs_positions = self.get_obstacle_init_pos(init_pos_robot, init_pos_person)       
-        for obs_idx in range(len(self.obstacle_names)):
-            self.set_pos(self.obstacle_names[obs_idx], obs_positions[obs_idx])
+        self.set_model_poses(self.get_obstacle_poses(init_pos_robot, init_pos_person))
         
     def init_simulator(self):
         self.number_of_steps = 0
@@ -1088,7 +1308,13 @@ class GazeborosEnv(gym.Env):
             self.robot.movebase_cancel_goals()
         if self.person_use_move_base:
             self.person.movebase_cancel_goals()
-        rospy.sleep(0.5)
+        if EnvConfig.RESET_CONVERGENCE:
+            # move_base keeps sending velocities until it processed the cancel
+            for robot in (self.robot, self.person):
+                if not robot.wait_goal_cancelled(EnvConfig.RESET_TIMEOUT):
+                    rospy.logwarn("{} move_base goal not cancelled after {}s".format(robot.name, EnvConfig.RESET_TIMEOUT))
+        else:
+            rospy.sleep(0.5)
         self.person.stop_robot()
         self.robot.stop_robot()
         # if self.use_movebase:
@@ -1099,17 +1325,20 @@ class GazeborosEnv(gym.Env):
         if EnvConfig.TRAIN_HINN:
             init_pos_robot = {"pos": (30,30), "orientation": 0}
 
-        # Set positions of robots and obstacles
-        self.set_pos(self.robot.name, init_pos_robot)
-        self.set_pos(self.person.name, init_pos_person)
-
+        # Set positions of robots and obstacles, all in one batch
         if EnvConfig.TRAIN_HINN:
-            self.set_obstacle_pos(init_pos_person, init_pos_robot)
+            obstacle_poses = self.get_obstacle_poses(init_pos_person, init_pos_robot)
         else:
-            self.set_obstacle_pos(init_pos_robot, init_pos_person)
+            obstacle_poses = self.get_obstacle_poses(init_pos_robot, init_pos_person)
+        self.set_model_poses([(self.robot.name, init_pos_robot), (self.person.name, init_pos_person)] + obstacle_poses)
+        if EnvConfig.RESET_CONVERGENCE:
+            # before the person starts walking, the histories are recreated after so they only hold states of the new pose
+            self.wait_teleported(init_pos_robot, init_pos_person)
 
         self.robot.update(init_pos_robot)
         self.person.update(init_pos_person)
+        self.init_pos_robot_ = init_pos_robot
+        self.init_pos_person_ = init_pos_person
 
         self.path_finished = False
         
@@ -1167,12 +1396,9 @@ class GazeborosEnv(gym.Env):
 
     @staticmethod
     def get_global_position(pos_goal, center):
-        while not center.is_current_state_ready():
-            if center.reset:
-                rospy.logwarn("reseting so return none in rel pos rel: {} center".format(relative.is_current_state_ready(), center.is_current_state_ready()))
-                return (None, None)
-            time.sleep(0.01)
-            rospy.logwarn ("waiting for observation to be ready")
+        if not center.wait_current_state("waiting for observation to be ready"):
+            rospy.logwarn("reseting so return none in global pos center: {}".format(center.is_current_state_ready()))
+            return (None, None)
         #relative_orientation = relative.state_['orientation']
         center_pos = np.asarray(center.state_['position'])
         center_orientation = center.state_['orientation']
@@ -1189,12 +1415,9 @@ class GazeborosEnv(gym.Env):
 
     @staticmethod
     def get_global_position_orientation(pos_goal, orientation_goal, center):
-        while not center.is_current_state_ready():
-            if center.reset:
-                rospy.logwarn("reseting so return none in rel pos rel: {} center".format(relative.is_current_state_ready(), center.is_current_state_ready()))
-                return (None, None)
-            time.sleep(0.01)
-            rospy.logwarn ("waiting for observation to be ready")
+        if not center.wait_current_state("waiting for observation to be ready"):
+            rospy.logwarn("reseting so return none in global pos center: {}".format(center.is_current_state_ready()))
+            return (None, None)
         #relative_orientation = relative.state_['orientation']
         center_pos = np.asarray(center.state_['position'])
         center_orientation = center.state_['orientation']
@@ -1224,43 +1447,27 @@ class GazeborosEnv(gym.Env):
 
     @staticmethod
     def get_relative_heading_position(relative, center):
-        while not relative.is_current_state_ready() or not center.is_current_state_ready():
-            if relative.reset:
-                rospy.logwarn("reseting so return none in rel pos rel: {} center".format(relative.is_current_state_ready(), center.is_current_state_ready()))
-                return (None, None)
-            time.sleep(0.1)
-            rospy.loginfo ("waiting for observation to be ready heading pos")
-        relative_orientation = relative.state_['orientation']
-        center_pos = np.asarray(center.state_['position'])
+        if not relative.wait_current_state("waiting for observation to be ready heading pos") or\
+           not center.wait_current_state("waiting for observation to be ready heading pos"):
+            rospy.logwarn("reseting so return none in rel pos rel: {} center {}".format(relative.is_current_state_ready(), center.is_current_state_ready()))
+            return (None, None)
         center_orientation = center.state_['orientation']
 
         # transform the relative to center coordinat
-        relative_pos = np.asarray(relative.state_['position'] - center_pos)
-        relative_pos2 = np.asarray((relative_pos[0] +math.cos(relative_orientation) , relative_pos[1] + math.sin(relative_orientation)))
-        rotation_matrix = np.asarray([[np.cos(-center_orientation), np.sin(-center_orientation)], [-np.sin(-center_orientation), np.cos(-center_orientation)]])
-        relative_pos = np.matmul(relative_pos, rotation_matrix)
-        relative_pos2 = np.matmul(relative_pos2, rotation_matrix)
-        angle_relative = np.arctan2(relative_pos2[1]-relative_pos[1], relative_pos2[0]-relative_pos[0])
+        relative_pos = to_frame(relative.state_['position'], center.state_['position'], center_orientation)
+        angle_relative = GazeborosEnv.wrap_pi_to_pi(relative.state_['orientation'] - center_orientation)
         return -angle_relative, relative_pos
 
     @staticmethod
     def get_relative_position(pos, center):
-        while not center.is_current_state_ready():
-            if center.reset:
-                rospy.loginfo("reseting so return none in rel pos rel: {} center".format(relative.is_current_state_ready(), center.is_current_state_ready()))
-                return (None, None)
-            time.sleep(0.01)
-            rospy.loginfo("waiting for observation to be ready relative pos")
-        #relative_orientation = relative.state_['orientation']
-        center_pos = np.asarray(center.state_['position'])
-        center_orientation = center.state_['orientation']
+        """
+        pos: a single point or an array of points of shape [N, 2]
+        """
+        if not center.wait_current_state("waiting for observation to be ready relative pos"):
+            rospy.loginfo("reseting so return none in rel pos center: {}".format(center.is_current_state_ready()))
+            return (None, None)
 
-        relative_pos = np.asarray(pos)
-        # transform the relative to center coordinat
-        relative_pos = np.asarray(relative_pos - center_pos)
-        rotation_matrix = np.asarray([[np.cos(-center_orientation), np.sin(-center_orientation)], [-np.sin(-center_orientation), np.cos(-center_orientation)]])
-        relative_pos = np.matmul(relative_pos, rotation_matrix)
-        return relative_pos
+        return to_frame(pos, center.state_['position'], center.state_['orientation'])
 
 
     def set_robot_to_auto(self):
@@ -1446,6 +1653,17 @@ class GazeborosEnv(gym.Env):
 
 
 
+    def wait_observation_ready(self):
+        """
+        Waits for the histories of the robot and person to be ready, returns False if they got reset meanwhile
+        """
+        for robot in (self.robot, self.person):
+            while not robot.wait_for(robot.is_observation_ready, 1.0):
+                rospy.logwarn("waiting for the {} history".format(robot.name))
+            if not robot.is_observation_ready():
+                return False
+        return True
+
     def get_observation(self):
         # got_laser = False
         # while not got_laser:
@@ -1455,47 +1673,16 @@ class GazeborosEnv(gym.Env):
         #     except Exception as e:
         #         rospy.logerr("laser_error reseting")
         #         # self.reset(reset_gazebo = True)
-        while self.robot.pos_history.avg_frame_rate is None or self.person.pos_history.avg_frame_rate is None or self.robot.velocity_history.avg_frame_rate is None or self.person.velocity_history.avg_frame_rate is None:
-            if self.is_reseting:
-                return None
-            time.sleep(0.001)
-        pos_his_robot = np.asarray(self.robot.pos_history.get_elemets())
-        heading_robot = self.robot.state_["orientation"]
-
-        pos_his_person = np.asarray(self.person.pos_history.get_elemets())
-        heading_person = self.person.state_["orientation"]
-
-        robot_vel = np.asarray(self.robot.get_velocity())
-        person_vel = np.asarray(self.person.get_velocity())
-        poses = np.concatenate((pos_his_robot, pos_his_person))
-        if self.use_noise:
-            poses += np.random.normal(loc=0, scale=0.1, size=poses.shape)
-            heading_robot += np.random.normal(loc=0, scale=0.2)
-            heading_person += np.random.normal(loc=0, scale=0.2)
-            robot_vel += np.random.normal(loc=0, scale=0.1, size=robot_vel.shape)
-            person_vel += np.random.normal(loc=0, scale=0.1, size=person_vel.shape)
-        heading_relative = GazeborosEnv.wrap_pi_to_pi(heading_robot-heading_person)/(math.pi)
-        pos_rel = []
-        for pos in (poses):
-            relative = GazeborosEnv.get_relative_position(pos, self.robot.relative)
-            pos_rel.append(relative)
-        pos_history = np.asarray(np.asarray(pos_rel)).flatten()/6.0
-        
-        
-        velocities = np.concatenate((person_vel, robot_vel))/self.robot.max_angular_vel
-        if self.use_orientation_in_observation:
-            velocities_heading = np.append(velocities, heading_relative)
-        else:
-            velocities_heading = velocities
-        final_ob =  np.append(np.append(pos_history, velocities_heading), self.prev_action)
-
-        if EnvConfig.RETURN_HINN_STATE:
-            final_ob = np.append(np.append(person_vel, heading_person), pos_his_person)
-
-            # if EnvConfig.USE_OBSTACLES:
-            final_ob = np.append(final_ob, self.person_scan)
-
-        return final_ob
+        if not self.wait_observation_ready():
+            return None
+        center = self.robot.relative
+        final_ob = build_observation(self.robot.pos_history.get_elemets()[None], self.person.pos_history.get_elemets()[None],
+                                     np.array([self.robot.state_["orientation"]]), np.array([self.person.state_["orientation"]]),
+                                     np.array([self.robot.get_velocity()]), np.array([self.person.get_velocity()]),
+                                     np.array([center.state_["position"]]), np.array([center.state_["orientation"]]),
+                                     np.array([self.prev_action]), self.person_scan[None], self.robot.max_angular_vel,
+                                     self.use_orientation_in_observation, np.random if self.use_noise else None)
+        return final_ob[0]
 
     def __del__(self):
         return
@@ -1507,10 +1694,8 @@ class GazeborosEnv(gym.Env):
         observation_image_gt = observation_image_gt.astype(np.uint8)
         observation_image.fill(255)
         observation_image_gt.fill(255)
-        while self.robot.pos_history.avg_frame_rate is None or self.person.pos_history.avg_frame_rate is None or self.robot.velocity_history.avg_frame_rate is None or self.person.velocity_history.avg_frame_rate is None:
-            if self.is_reseting:
-                return None
-            time.sleep(0.001)
+        if not self.wait_observation_ready():
+            return None
         pos_his_robot = self.robot.pos_history.get_elemets()
         heading_robot = self.robot.state_["orientation"]
 
@@ -1519,17 +1704,13 @@ class GazeborosEnv(gym.Env):
 
         heading_relative = GazeborosEnv.wrap_pi_to_pi(heading_robot-heading_person)/(math.pi)
         center_pos = pos_his_robot[-1]
-        for pos in pos_his_robot:
-            relative = GazeborosEnv.get_relative_position(pos, self.robot)
-            pos_rel = GazeborosEnv.to_image_coordinate(relative, (0, 0))
-            pos_gt = GazeborosEnv.to_image_coordinate(pos, center_pos)
+        rel_his_robot = GazeborosEnv.get_relative_position(pos_his_robot, self.robot)
+        rel_his_person = GazeborosEnv.get_relative_position(pos_his_person, self.robot)
+        for pos, relative in zip(pos_his_robot, rel_his_robot):
             observation_image = self.add_circle_observation_to_image(relative, (255, 0, 0), 10, center_pos=(0,0), image=observation_image)
             observation_image_gt = self.add_circle_observation_to_image(pos, (255, 0, 0), 10, center_pos=center_pos, image=observation_image_gt)
 
-        for pos in pos_his_person:
-            relative = GazeborosEnv.get_relative_position(pos, self.robot)
-            pos_rel = GazeborosEnv.to_image_coordinate(relative, (0, 0))
-            pos_gt = GazeborosEnv.to_image_coordinate(pos, center_pos)
+        for pos, relative in zip(pos_his_person, rel_his_person):
             observation_image = self.add_circle_observation_to_image(relative, (0, 255, 0), 10, image = observation_image, center_pos=(0,0))
             observation_image_gt = self.add_circle_observation_to_image(pos, (0, 255, 0), 10, image=observation_image_gt, center_pos=center_pos)
 
@@ -1587,16 +1768,14 @@ class GazeborosEnv(gym.Env):
         return (cv.circle(image , (pos_image[0], pos_image[1]), radious, color, 2))
 
     def get_supervised_action(self):
-        while not self.person.is_current_state_ready() and not self.is_reseting:
-            time.sleep(0.1)
+        self.person.wait_current_state("waiting for the person state")
         if self.is_reseting:
             return np.asarray([0,0])
 
         self.use_supervise_action = True
         pos = self.person.calculate_ahead(1.5)
         pos_person = self.person.get_pos()
-        pos_relative = GazeborosEnv.get_relative_position(pos, self.robot.relative)
-        pos_person_relative = GazeborosEnv.get_relative_position(pos_person, self.robot.relative)
+        pos_relative, pos_person_relative = GazeborosEnv.get_relative_position((pos, pos_person), self.robot.relative)
         pos_norm = GazeborosEnv.normalize(pos_relative, self.robot.max_rel_pos_range)
         orientation = GazeborosEnv.normalize(math.atan2(pos_relative[1] - pos_person_relative[1], pos_relative[0] - pos_person_relative[0]), math.pi)
         return np.asarray((pos_norm[0], pos_norm[1], orientation))
@@ -1646,11 +1825,13 @@ class GazeborosEnv(gym.Env):
 
     def take_action(self, action):
         self.prev_action = action[:2]
-        self.robot.take_action(action)
+        with self.step_timer.span("take_action"):
+            self.robot.take_action(action)
 
         if not self.person_use_move_base:
             if self.wait_observation_ <= 0:
-                self.update_observation_image()
+                with self.step_timer.span("update_observation_image"):
+                    self.update_observation_image()
                 self.wait_observation_ = 7
             self.color_index += 2
             if self.color_index >= len(self.colors_visualization):
@@ -1670,23 +1851,43 @@ class GazeborosEnv(gym.Env):
         else:
             return True
 
+    def set_step_timing(self, enabled):
+        self.step_timer.enabled = enabled
+
+    def get_timing_stats(self):
+        """
+        Wall clock durations of the stages of the last EnvConfig.STEP_TIMING_WINDOW steps, see StepTimer.get_stats.
+        Empty unless EnvConfig.STEP_TIMING or set_step_timing(True)
+        """
+        return self.step_timer.get_stats()
+
     def step(self, action):
+        with self.step_timer.span("step"):
+            return self.timed_step(action)
+
+    def timed_step(self, action):
         self.number_of_steps += 1
         self.take_action(action)
         # instead of one reward get all the reward during wait
         # rospy.sleep(0.4)
 
-        sleep_time = 0.10
+        sleep_time = EnvConfig.CONTROL_PERIOD
         rewards = []
         if sleep_time > 0.1:
+            start_time = rospy.get_time()
             for t in range (10):
-                rospy.sleep(sleep_time/10.)
-                rewards.append(self.get_reward())
+                with self.step_timer.span("wait"):
+                    self.wait_control_period(sleep_time/10., start_time + t * sleep_time/10.)
+                with self.step_timer.span("get_reward"):
+                    rewards.append(self.get_reward())
                 reward = np.mean(rewards)
         else:
-             rospy.sleep(sleep_time)
-             reward = self.get_reward()
-        ob = self.get_observation()
+             with self.step_timer.span("wait"):
+                 self.wait_control_period(sleep_time)
+             with self.step_timer.span("get_reward"):
+                 reward = self.get_reward()
+        with self.step_timer.span("get_observation"):
+            ob = self.get_observation()
 
         episode_over = False
 
@@ -1697,18 +1898,21 @@ class GazeborosEnv(gym.Env):
             if self.path_finished:
                 rospy.loginfo("path finished")
                 episode_over = True
-            if self.is_collided():
-                self.update_observation_image()
+            if self.is_collided(distance):
+                with self.step_timer.span("update_observation_image"):
+                    self.update_observation_image()
                 episode_over = True
                 rospy.loginfo('collision happened episode over')
                 reward -= 0.5 # maybe remove less when in start of leaning 
             elif distance > 5:
-                self.update_observation_image()
+                with self.step_timer.span("update_observation_image"):
+                    self.update_observation_image()
                 self.is_max_distance = True
                 episode_over = True
                 rospy.loginfo('max distance happened episode over')
             elif self.number_of_steps > self.max_numb_steps:
-                self.update_observation_image()
+                with self.step_timer.span("update_observation_image"):
+                    self.update_observation_image()
                 episode_over = True
             if self.fallen:
                 episode_over = True
@@ -1723,9 +1927,13 @@ class GazeborosEnv(gym.Env):
         #reward += 1
         return ob, reward, episode_over, {}
 
-    def is_collided(self):
-        rel_person = GazeborosEnv.get_relative_heading_position(self.robot, self.person)[1]
-        distance = math.hypot(rel_person[0], rel_person[1])
+    def is_collided(self, distance=None):
+        """
+        distance: robot person distance if it is already known, computed otherwise
+        """
+        if distance is None:
+            rel_person = GazeborosEnv.get_relative_heading_position(self.robot, self.person)[1]
+            distance = math.hypot(rel_person[0], rel_person[1])
         if distance < self.collision_distance or self.robot.is_collided:
             return True
         return False
@@ -1740,39 +1948,11 @@ class GazeborosEnv(gym.Env):
         return (GazeborosEnv.wrap_pi_to_pi(angle_robot_person))
 
     def get_reward(self):
-        reward = 0
-        angle_robot_person, pos_rel = GazeborosEnv.get_relative_heading_position(self.robot, self.person)
+        _, pos_rel = GazeborosEnv.get_relative_heading_position(self.robot, self.person)
         angle_robot_person = math.atan2(pos_rel[1], pos_rel[0])
         angle_robot_person = np.rad2deg(GazeborosEnv.wrap_pi_to_pi(angle_robot_person))
         distance = math.hypot(pos_rel[0], pos_rel[1])
-        # Negative reward for being behind the person
-        if self.is_collided():
-            reward -= 1
-        if distance < 0.5:
-            reward = -1.3
-        elif abs(distance - self.best_distance) < 0.5:
-            reward += 0.5 * (0.5 - abs(distance - self.best_distance))
-        elif distance >= self.best_distance+0.5:
-            reward -= 0.25 * (distance - (self.best_distance+0.5))
-        elif distance < self.best_distance-0.5:
-            reward -= (self.best_distance - 0.5 - distance)/(self.best_distance - 0.5)
-        if abs(angle_robot_person) < 25:
-            reward += 0.5 * (25 - abs(angle_robot_person)) / 25
-        else:
-            reward -= 0.25 * abs(angle_robot_person) / 180
-        if abs(distance - self.best_distance) < 0.5 and abs(angle_robot_person) < 25:
-            reward += 0.25
-
-        # if not 90 > angle_robot_person > 0:
-        #     reward -= distance/6.0
-        # elif self.min_distance < distance < self.max_distance:
-        #     reward += 0.1 + (90 - angle_robot_person) * 0.9 / 90
-        # elif distance < self.min_distance:
-        #     reward -= 1 - distance / self.min_distance
-        # else:
-        #     reward -= distance / 7.0
-        reward = min(max(reward, -1), 1)
-        return reward
+        return float(follow_ahead_reward(distance, angle_robot_person, self.is_collided(distance), self.best_distance))
 
     def save_log(self):
         pickle.dump({"person_history":self.person.log_history, "robot_history":self.robot.log_history}, self.log_file)
@@ -1787,6 +1967,8 @@ class GazeborosEnv(gym.Env):
         rospy.loginfo("trying to get the lock for reset")
         # if reset_gazebo:
         #     self.reset_gazebo()
+        # the reset waits in ROS time, it does not advance in lockstep mode while physics is paused
+        self.set_physics_paused(False)
         with self.lock:
 
             rospy.loginfo("got the lock")
@@ -1815,9 +1997,45 @@ class GazeborosEnv(gym.Env):
             rospy.loginfo("not init so run reset again")
             return (self.reset())
         else:
-            rospy.sleep(2)
+            if EnvConfig.RESET_CONVERGENCE:
+                self.wait_reset_converged()
+            else:
+                rospy.sleep(2)
+            self.set_physics_paused(True)
             return self.get_observation()
 
+    def wait_teleported(self, init_pos_robot, init_pos_person, timeout=None):
+        """
+        Waits for the robot and the person to report the pose they were teleported to by init_simulator,
+        within EnvConfig.RESET_POSE_TOLERANCE
+        timeout: wall clock seconds, EnvConfig.RESET_TIMEOUT if None
+        returns False if it timed out
+        """
+        if timeout is None:
+            timeout = EnvConfig.RESET_TIMEOUT
+        deadline = time.time() + timeout
+        for robot, init_pos in ((self.robot, init_pos_robot), (self.person, init_pos_person)):
+            if not robot.wait_at(init_pos["pos"], EnvConfig.RESET_POSE_TOLERANCE, max(deadline - time.time(), 0)):
+                rospy.logwarn("{} did not reach its reset pose within {}s, continuing".format(robot.name, timeout))
+                return False
+        return True
+
+    def wait_reset_converged(self, timeout=None):
+        """
+        Waits for the histories of the robot and the person to be primed, see History.is_primed
+        timeout: wall clock seconds on top of the time it takes to fill the histories, EnvConfig.RESET_TIMEOUT if None
+        returns False if it timed out
+        """
+        if timeout is None:
+            timeout = EnvConfig.RESET_TIMEOUT
+        timeout += self.robot.pos_history.window_duration()
+        deadline = time.time() + timeout
+        for robot in (self.robot, self.person):
+            if not robot.wait_for(robot.is_history_primed, max(deadline - time.time(), 0)):
+                rospy.logwarn("{} history not primed within {:.1f}s, continuing".format(robot.name, timeout))
+                return False
+        return True
+
     def save_current_path(self):
         all_pos_robot = self.robot.all_pose_
         all_pos_person = self.person.all_pose_
@@ -0,0 +1,616 @@
+"""
+Headless kinematic simulator of the follow ahead task, runs without ROS, Gazebo or move_base.
+
+The robot and the person are unicycles integrated in simulated time, move_base is replaced by the
+go_to_goal controller of Robot and the person follows the same modes as GazeborosEnv.path_follower
+and Robot.use_selected_person_mod. Observation, reward and obstacle placement are the functions of
+common shared with GazeborosEnv. Every array has a leading dimension of num_envs so many scenarios
+are stepped with one call, GazeborosSimEnv is the single env gym wrapper.
+"""
+
+import math
+import random
+
+import numpy as np
+
+import gym
+from gym.utils import seeding
+
+from gym_gazeboros_ac.envs.common import EnvConfig, wrap_angle, to_frame, from_frame, reduce_scan
+from gym_gazeboros_ac.envs.common import follow_ahead_reward, build_observation, find_random_point_in_circle, get_obstacle_init_pos
+
+ROBOT = 0
+PERSON = 1
+
+
+class FollowAheadSim():
+    # Time(seconds) between two actions, GazeborosEnv.step sleeps this long
+    CONTROL_PERIOD = 0.1
+    # Time(seconds) the person moves after a reset before the first observation, GazeborosEnv.reset sleeps this long
+    RESET_WARMUP = 2.0
+    ROBOT_RADIUS = 0.2
+    PERSON_RADIUS = 0.15
+    # Distance(meters) at which a goal counts as reached and the robot turns to the goal orientation
+    GOAL_TOLERANCE = 0.1
+    # Gains of the go_to_goal PID of Robot (proportional part only)
+    ANGULAR_GAIN = 2.5
+    LINEAR_GAIN = 2.5
+    MAX_PERSON_GOALS = EnvConfig.EPISODE_LEN
+
+    # Test settings of GazeborosEnv that do not need a recorded trajectory (person mode, init mode, name)
+    test_settings = {0:(0,0, "straight"), 1:(2,0, "right"), 2:(3,0, "left"),\
+            3:(1,4, "straight_Behind"), 4:(2,3, "right_behind"), 5:(3,3, "left_behind"),\
+            6:(2,1, "right_left"), 7:(2,2, "right_right"),\
+            8:(3,1, "left_left"), 9:(3,2, "left_right")\
+            }
+
+    def __init__(self, num_envs, is_evaluation=False):
+        self.num_envs = num_envs
+        self.is_evaluation_ = is_evaluation
+        self.is_testing = EnvConfig.USE_TESTING
+        self.is_use_test_setting = self.is_testing
+        self.test_setting_idx = 0
+        self.use_noise = not self.is_testing
+        self.use_orientation_in_observation = True
+        self.person_use_move_base = EnvConfig.PERSON_USE_MB
+        self.use_predifined_mode_person = True
+        self.use_obstacles = EnvConfig.USE_OBSTACLES
+        self.obstacle_mode = EnvConfig.OBSTACLE_MODE
+        self.num_obstacles = EnvConfig.SIM_NUM_OBSTACLES
+        self.person_mode = 0
+        self.mode_person = 0
+
+        self.collision_distance = 0.3
+        self.best_distance = 1.5
+        self.max_rel_pos_range = 5.0
+        self.max_numb_steps = 100 if self.is_use_test_setting and not self.is_evaluation_ else 80
+        self.dt = EnvConfig.SIM_TIME_STEP
+        self.substeps = max(1, int(round(self.CONTROL_PERIOD / self.dt)))
+
+        # [robot, person]
+        self.max_linear_vel = np.array([0.8, 0.6])
+        self.max_angular_vel = np.array([1.8, 1.0])
+
+        # History of GazeborosEnv: window_size samples saved at save_rate, read every skip_frames samples
+        self.window_size = 10
+        save_rate = 10
+        update_rate_states = 2.0
+        self.memory_size = int(math.ceil(save_rate/update_rate_states*self.window_size)+1)
+        self.window_offsets_ = np.arange(self.window_size) * int(math.ceil(save_rate/update_rate_states))
+        self.history_period = 1.0 / save_rate
+
+        self.np_random = np.random.default_rng()
+        self.py_random = random.Random()
+        self.allocate()
+
+    def allocate(self):
+        num_envs = self.num_envs
+        self.pos = np.zeros((num_envs, 2, 2))
+        self.orientation = np.zeros((num_envs, 2))
+        # commanded (linear, angular) velocity of the robot and person
+        self.cmd_vel = np.zeros((num_envs, 2, 2))
+        self.goal_pos = np.zeros((num_envs, 2, 2))
+        self.goal_orientation = np.zeros((num_envs, 2))
+        self.has_goal = np.zeros((num_envs, 2), dtype=bool)
+        self.pos_history = np.zeros((num_envs, 2, self.memory_size, 2))
+        self.history_idx = np.zeros(num_envs, dtype=np.int64)
+        self.prev_history_time = np.zeros(num_envs)
+        self.obstacles = np.full((num_envs, self.num_obstacles, 2), 15.0)
+        self.person_scan = np.full((num_envs, EnvConfig.SCAN_REDUCTION_SIZE), 1000.0)
+        self.prev_action = np.zeros((num_envs, 2))
+        self.number_of_steps = np.zeros(num_envs, dtype=np.int64)
+        self.time = np.zeros(num_envs)
+        self.is_max_distance = np.zeros(num_envs, dtype=bool)
+
+        # -1 when the person uses move base, the velocity mode of use_selected_person_mod otherwise
+        self.person_velocity_mode = np.full(num_envs, -1, dtype=np.int64)
+        # move base goals of path_follower, relative to the person position when the goal is sent
+        self.person_goal_times = np.full((num_envs, self.MAX_PERSON_GOALS), np.inf)
+        self.person_goal_deltas = np.zeros((num_envs, self.MAX_PERSON_GOALS, 2))
+        # nan to keep the orientation of the person
+        self.person_goal_orientations = np.full((num_envs, self.MAX_PERSON_GOALS), np.nan)
+        self.person_next_goal = np.zeros(num_envs, dtype=np.int64)
+
+        # distance to the center of an obstacle at which the robot and the person touch it
+        self.body_radius = np.array([self.ROBOT_RADIUS, self.PERSON_RADIUS])[None, :, None] + EnvConfig.OBSTACLE_SIZE/2
+        scan_angles = np.linspace(-math.pi, math.pi, EnvConfig.SIM_SCAN_RAYS, endpoint=False)
+        self.scan_cos = np.cos(scan_angles)
+        self.scan_sin = np.sin(scan_angles)
+        # radius of the obstacles and of the robot seen by the person scan
+        self.scan_radius = np.append(np.full(self.num_obstacles, EnvConfig.OBSTACLE_SIZE/2), self.ROBOT_RADIUS)
+
+    def seed(self, seed=None):
+        self.np_random = np.random.default_rng(seed)
+        self.py_random = random.Random(seed)
+
+    @staticmethod
+    def respect_orientation(xy, orientation):
+        x = math.cos(orientation) * xy[0] - math.sin(orientation) * xy[1]
+        y = math.sin(orientation) * xy[0] + math.cos(orientation) * xy[1]
+        return [x,y]
+
+    def get_init_pos_robot_person(self):
+        rng = self.py_random
+        if self.person_use_move_base:
+            x = rng.uniform(-3,3)
+            y = rng.uniform(-3,3)
+            init_pos_person = {"pos": (x, y), "orientation":rng.uniform(0, math.pi)}
+            random_pos_robot = find_random_point_in_circle(1.5, 2.5, init_pos_person["pos"], rng)
+            init_pos_robot = {"pos": random_pos_robot, "orientation":rng.uniform(0, math.pi)}
+        elif self.is_use_test_setting:
+            init_pos_person = {"pos": (0, 0), "orientation":0}
+            mode = self.test_settings[self.test_setting_idx][1]
+            if mode == 0:
+                orinetation_person_rob = 0
+            elif mode == 1:
+                orinetation_person_rob = -math.pi /4.
+            elif mode == 2:
+                orinetation_person_rob = math.pi /4.
+            elif mode == 3:
+                orinetation_person_rob = -math.pi
+            else:
+                orinetation_person_rob = math.pi/8*7
+            pos_robot = (1.5*math.cos(orinetation_person_rob), 1.5*math.sin(orinetation_person_rob))
+            init_pos_robot = {"pos": pos_robot, "orientation":0}
+        else:
+            # no recorded trajectories here, same as GazeborosEnv with use_path False
+            init_pos_person = {"pos": (0, 0), "orientation": rng.random()*2*math.pi - math.pi}
+            random_pos_robot = find_random_point_in_circle(1.5, 2.5, init_pos_person["pos"], rng)
+            init_pos_robot = {"pos": random_pos_robot, "orientation": init_pos_person["orientation"]}
+
+        if EnvConfig.TRAIN_HINN:
+            init_pos_robot = {"pos": (30,30), "orientation": 0}
+        return init_pos_robot, init_pos_person
+
+    def set_mode_person_based_on_episode_number(self, episode_number):
+        if episode_number < 500:
+            self.mode_person = 0
+        elif episode_number < 510:
+            self.mode_person = 1
+        elif episode_number < 700:
+            self.mode_person = 3
+        elif episode_number < 900:
+            self.mode_person = 5
+        elif episode_number < 1000:
+            self.mode_person = 6
+        else:
+            if self.py_random.random()>0.5:
+                self.mode_person = 7
+            else:
+                self.mode_person = self.py_random.randint(0, 6)
+
+    def get_person_velocity_mode(self):
+        if self.is_use_test_setting:
+            mode_person = self.test_settings[self.test_setting_idx][0]
+        elif self.is_evaluation_:
+            mode_person = 2
+        elif self.use_predifined_mode_person:
+            mode_person = self.mode_person
+        else:
+            mode_person = self.py_random.randint(0, 7)
+        if mode_person > 6:
+            # mode 7 walks a recorded trajectory, not available without the trajectory file
+            mode_person = self.py_random.randint(0, 6)
+        return mode_person
+
+    def set_person_goals(self, env_idx, person_init_pose):
+        """
+        Move base goals of GazeborosEnv.path_follower for the current person_mode
+        """
+        orientation = person_init_pose["orientation"]
+        goals = []
+        if self.person_mode == 1:
+            interval = 3
+            for i in range(math.floor(EnvConfig.EPISODE_LEN/interval)):
+                goals.append((i * interval, self.respect_orientation([0.5,i*0.5], orientation),
+                              orientation + i * math.pi/EnvConfig.EPISODE_LEN/2))
+        elif self.person_mode == 2:
+            interval = 3
+            for i in range(math.floor(EnvConfig.EPISODE_LEN/interval)):
+                goals.append((i * interval, self.respect_orientation([0.5,-i * 0.5], orientation),
+                              orientation - i * math.pi/EnvConfig.EPISODE_LEN/2))
+        elif self.person_mode == 3:
+            interval = 5
+            for i in range(math.floor(EnvConfig.EPISODE_LEN/interval)):
+                goals.append((i * interval, [self.py_random.uniform(-1,1), self.py_random.uniform(-1,1)], np.nan))
+        elif self.person_mode == 4:
+            y = 0.5
+            interval = 3
+            for i in range(math.floor(EnvConfig.EPISODE_LEN/interval)):
+                goals.append((i * interval, self.respect_orientation([1,y], orientation), orientation - y * math.pi/4))
+                y *= -1
+        else:
+            # 0/Default: Straight path
+            for i in range(EnvConfig.EPISODE_LEN):
+                goals.append((i, self.respect_orientation([2,0], orientation), np.nan))
+
+        self.person_goal_times[env_idx] = np.inf
+        for goal_idx, (goal_time, delta, goal_orientation) in enumerate(goals):
+            self.person_goal_times[env_idx, goal_idx] = goal_time
+            self.person_goal_deltas[env_idx, goal_idx] = delta
+            self.person_goal_orientations[env_idx, goal_idx] = goal_orientation
+        self.person_next_goal[env_idx] = 0
+
+    def reset_envs(self, env_indices=None):
+        """
+        Starts a new episode for env_indices (all the envs if None) and returns their observations
+        """
+        if env_indices is None:
+            env_indices = np.arange(self.num_envs)
+        env_indices = np.asarray(env_indices)
+        active = np.zeros(self.num_envs, dtype=bool)
+        active[env_indices] = True
+
+        for env_idx in env_indices:
+            init_pos_robot, init_pos_person = self.get_init_pos_robot_person()
+            if EnvConfig.TRAIN_HINN:
+                obstacle_positions = get_obstacle_init_pos(self.num_obstacles, init_pos_person, init_pos_robot,
+                                                           self.use_obstacles, self.obstacle_mode, self.py_random)
+            else:
+                obstacle_positions = get_obstacle_init_pos(self.num_obstacles, init_pos_robot, init_pos_person,
+                                                           self.use_obstacles, self.obstacle_mode, self.py_random)
+            self.obstacles[env_idx] = [obstacle["pos"] for obstacle in obstacle_positions]
+
+            self.pos[env_idx, ROBOT] = init_pos_robot["pos"]
+            self.orientation[env_idx, ROBOT] = init_pos_robot["orientation"]
+            self.pos[env_idx, PERSON] = init_pos_person["pos"]
+            self.orientation[env_idx, PERSON] = init_pos_person["orientation"]
+
+            if self.person_use_move_base:
+                self.person_velocity_mode[env_idx] = -1
+                self.set_person_goals(env_idx, init_pos_person)
+            else:
+                self.person_velocity_mode[env_idx] = self.get_person_velocity_mode()
+                self.person_goal_times[env_idx] = np.inf
+
+        self.cmd_vel[active] = 0
+        self.has_goal[active] = False
+        self.prev_action[active] = 0
+        self.number_of_steps[active] = 0
+        self.time[active] = 0
+        self.is_max_distance[active] = False
+        # a new history is filled with the first sample
+        self.pos_history[active] = self.pos[active][:, :, None, :]
+        self.prev_history_time[active] = 0
+
+        # only the envs being reset move, the others keep their state and do not draw random numbers
+        rows = slice(None) if active.all() else np.flatnonzero(active)
+        for _ in range(int(round(self.RESET_WARMUP / self.CONTROL_PERIOD))):
+            self.advance(rows)
+        return self.get_observation(env_indices)
+
+    def advance(self, rows=slice(None)):
+        """
+        Simulates CONTROL_PERIOD seconds of the envs at rows, an index array or a slice, the other envs are not touched
+        """
+        env_indices = np.arange(self.num_envs)[rows]
+        due = env_indices[self.person_next_goal[rows] < self.MAX_PERSON_GOALS]
+        due = due[self.time[due] >= self.person_goal_times[due, self.person_next_goal[due]]]
+        if len(due):
+            goal_idx = self.person_next_goal[due]
+            self.goal_pos[due, PERSON] = self.pos[due, PERSON] + self.person_goal_deltas[due, goal_idx]
+            goal_orientation = self.person_goal_orientations[due, goal_idx]
+            self.goal_orientation[due, PERSON] = np.where(np.isnan(goal_orientation), self.orientation[due, PERSON], goal_orientation)
+            self.has_goal[due, PERSON] = True
+            self.person_next_goal[due] += 1
+
+        for _ in range(self.substeps):
+            cmd_vel = self.update_cmd_vel(rows)
+            orientation = wrap_angle(self.orientation[rows] + cmd_vel[..., 1] * self.dt)
+            motion = (cmd_vel[..., 0] * self.dt)[..., None] * np.stack((np.cos(orientation), np.sin(orientation)), axis=-1)
+            self.orientation[rows] = orientation
+            self.pos[rows] = self.pos[rows] + self.slide_along_obstacles(motion, rows)
+        self.time[rows] += self.CONTROL_PERIOD
+
+        record = env_indices[self.time[rows] - self.prev_history_time[rows] >= self.history_period - 1e-9]
+        self.history_idx[record] = (self.history_idx[record] + 1) % self.memory_size
+        self.pos_history[record, :, self.history_idx[record]] = self.pos[record]
+        self.prev_history_time[record] = self.time[record]
+        self.update_person_scan(rows)
+
+    def slide_along_obstacles(self, motion, rows=slice(None)):
+        """
+        Obstacles block the robots like in Gazebo, the part of motion going into the closest touched obstacle is removed.
+        There is no planner around obstacles, a robot pushing straight into one stops.
+        motion: [len(rows), 2, 2] displacement of the robot and the person of the envs at rows
+        """
+        to_obstacle = self.obstacles[rows][:, None, :, :] - self.pos[rows][:, :, None, :]
+        obstacle_distance = np.linalg.norm(to_obstacle, axis=-1)
+        touching = obstacle_distance < self.body_radius + np.linalg.norm(motion, axis=-1)[..., None]
+        if not touching.any():
+            return motion
+        closest = np.argmin(np.where(touching, obstacle_distance, np.inf), axis=-1)
+        normal = np.take_along_axis(to_obstacle, closest[..., None, None], axis=2)[:, :, 0]
+        normal /= np.maximum(np.take_along_axis(obstacle_distance, closest[..., None], axis=2), 1e-9)
+        into_obstacle = np.maximum(np.sum(motion * normal, axis=-1), 0)
+        into_obstacle = np.where(touching.any(axis=-1), into_obstacle, 0)
+        return motion - into_obstacle[..., None] * normal
+
+    def update_cmd_vel(self, rows=slice(None)):
+        """
+        Updates the commanded velocities of the envs at rows and returns them
+        """
+        # go_to_goal of Robot, stands in for move base
+        pos = self.pos[rows]
+        orientation = self.orientation[rows]
+        has_goal = self.has_goal[rows]
+        diff = self.goal_pos[rows] - pos
+        distance = np.hypot(diff[..., 0], diff[..., 1])
+        diff_angle = wrap_angle(np.arctan2(diff[..., 1], diff[..., 0]) - orientation)
+        at_goal = distance < self.GOAL_TOLERANCE
+        angular = np.where(at_goal, wrap_angle(self.goal_orientation[rows] - orientation), diff_angle) * self.ANGULAR_GAIN
+        linear = np.minimum(self.LINEAR_GAIN * distance, self.max_linear_vel) * np.power((math.pi - np.abs(diff_angle))/math.pi, 1.5)
+        linear = np.where(at_goal | ~has_goal, 0, linear)
+        angular = np.where(has_goal, np.clip(angular, -self.max_angular_vel, self.max_angular_vel), 0)
+        cmd_vel = np.stack((linear, angular), axis=-1)
+        self.cmd_vel[rows] = cmd_vel
+
+        mode = self.person_velocity_mode[rows]
+        if (mode >= 0).any():
+            cmd_vel[mode >= 0, PERSON] = self.get_person_mode_cmd_vel(rows)[mode >= 0]
+            self.cmd_vel[rows] = cmd_vel
+        return cmd_vel
+
+    def get_person_mode_cmd_vel(self, rows=slice(None)):
+        """
+        Velocity of use_selected_person_mod for the envs at rows
+        """
+        mode = self.person_velocity_mode[rows]
+        max_linear_vel = self.max_linear_vel[PERSON]
+        max_angular_vel = self.max_angular_vel[PERSON]
+        reported_vel = self.get_velocity(rows)[:, PERSON]
+        random_linear = reported_vel[:, 0] - (reported_vel[:, 0] - (self.np_random.random(len(mode))/2 + 0.5))/2.
+        random_angular = reported_vel[:, 1] - (reported_vel[:, 1] - (self.np_random.random(len(mode))-0.5)*2)/2.
+
+        linear = np.select([mode == 0, mode == 1, (mode == 2) | (mode == 3), mode >= 4],
+                           [max_linear_vel, max_linear_vel * 0.35, max_linear_vel/2, random_linear], 0)
+        angular = np.select([(mode == 2) | (mode == 5), (mode == 3) | (mode == 4), mode == 6],
+                            [max_angular_vel/6, -max_angular_vel/6, random_angular], 0)
+        return np.stack((np.clip(linear, 0, max_linear_vel), np.clip(angular, -max_angular_vel, max_angular_vel)), axis=-1)
+
+    def get_velocity(self, rows=slice(None)):
+        """
+        Velocity as reported by /gazebo/model_states: twist.linear.x is in the world frame
+        """
+        cmd_vel = self.cmd_vel[rows]
+        return np.stack((cmd_vel[..., 0] * np.cos(self.orientation[rows]), cmd_vel[..., 1]), axis=-1)
+
+    def update_person_scan(self, rows=slice(None)):
+        """
+        Casts SIM_SCAN_RAYS rays from the person against the obstacles and the robot of the envs at rows
+        """
+        centers = np.concatenate((self.obstacles[rows], self.pos[rows, ROBOT][:, None, :]), axis=1)
+        # circles in the frame of the person so the ray directions are the same for every env
+        centers = to_frame(centers, self.pos[rows, PERSON][:, None, :], self.orientation[rows, PERSON][:, None])
+
+        # ray/circle intersection, [envs, rays, circles]
+        projection = centers[:, None, :, 0] * self.scan_cos[:, None] + centers[:, None, :, 1] * self.scan_sin[:, None]
+        discriminant = projection ** 2 - (np.sum(centers ** 2, axis=-1) - self.scan_radius ** 2)[:, None, :]
+        hit = projection - np.sqrt(np.maximum(discriminant, 0))
+        hit = np.where((discriminant >= 0) & (hit > 0), hit, np.inf)
+        self.person_scan[rows] = reduce_scan(hit.min(axis=-1), EnvConfig.SCAN_REDUCTION_SIZE,
+                                               EnvConfig.SCAN_REDUCER, EnvConfig.SCAN_REDUCER_PERCENTILE)
+
+    def get_history_windows(self, env_indices=slice(None)):
+        """
+        returns [envs, 2, window_size, 2] position windows of the robot and person, latest first
+        """
+        indices = (self.history_idx[env_indices, None] - self.window_offsets_) % self.memory_size
+        return np.take_along_axis(self.pos_history[env_indices], indices[:, None, :, None], axis=2)
+
+    def get_relative_robot_position(self):
+        return to_frame(self.pos[:, ROBOT], self.pos[:, PERSON], self.orientation[:, PERSON])
+
+    def get_angle_person_robot(self):
+        pos_rel = self.get_relative_robot_position()
+        return np.arctan2(pos_rel[:, 1], pos_rel[:, 0])
+
+    def is_collided(self, distance):
+        return distance < self.collision_distance
+
+    def get_observation(self, env_indices=None):
+        """
+        returns the observations of env_indices (all the envs if None)
+        """
+        if env_indices is None:
+            env_indices = slice(None)
+        windows = self.get_history_windows(env_indices)
+        velocity = self.get_velocity()[env_indices]
+        pos = self.pos[env_indices]
+        orientation = self.orientation[env_indices]
+        return build_observation(windows[:, ROBOT], windows[:, PERSON], orientation[:, ROBOT], orientation[:, PERSON],
+                                 velocity[:, ROBOT], velocity[:, PERSON], pos[:, PERSON], orientation[:, PERSON],
+                                 self.prev_action[env_indices], self.person_scan[env_indices], self.max_angular_vel[ROBOT],
+                                 self.use_orientation_in_observation, self.np_random if self.use_noise else None)
+
+    def is_successful(self):
+        distance = np.hypot(*self.get_relative_robot_position().T)
+        return ~(self.is_collided(distance) | self.is_max_distance)
+
+    def step(self, actions):
+        """
+        actions: [num_envs, 2] relative goal of the robot in the frame of the person, normalized to [-1, 1]
+        returns observations [num_envs, obs_dim], rewards [num_envs], dones [num_envs]
+        """
+        actions = np.asarray(actions, dtype=np.float64).reshape(self.num_envs, -1)
+        self.number_of_steps += 1
+        self.prev_action = actions[:, :2].copy()
+        self.goal_pos[:, ROBOT] = from_frame(actions[:, :2] * self.max_rel_pos_range, self.pos[:, PERSON], self.orientation[:, PERSON])
+        self.goal_orientation[:, ROBOT] = self.orientation[:, ROBOT]
+        self.has_goal[:, ROBOT] = True
+
+        self.advance()
+
+        pos_rel = self.get_relative_robot_position()
+        distance = np.hypot(pos_rel[:, 0], pos_rel[:, 1])
+        angle_robot_person = np.rad2deg(np.arctan2(pos_rel[:, 1], pos_rel[:, 0]))
+        collided = self.is_collided(distance)
+        rewards = follow_ahead_reward(distance, angle_robot_person, collided, self.best_distance)
+        observations = self.get_observation()
+
+        dones = np.zeros(self.num_envs, dtype=bool)
+        if not EnvConfig.RETURN_HINN_STATE:
+            self.is_max_distance |= ~collided & (distance > 5)
+            rewards = np.where(collided, rewards - 0.5, rewards)
+            dones = collided | (distance > 5) | (self.number_of_steps > self.max_numb_steps)
+        rewards = np.clip(rewards, -1, 1)
+        return observations, rewards, dones
+
+
+def get_spaces(use_orientation_in_observation):
+    """
+    returns (observation_space, action_space) of a single env, same as GazeborosEnv
+    """
+    observation_dimensions = 46
+    if use_orientation_in_observation:
+        observation_dimensions += 1
+    if EnvConfig.RETURN_HINN_STATE:
+        observation_dimensions = 23
+        observation_dimensions += EnvConfig.SCAN_REDUCTION_SIZE
+
+    observation_space = gym.spaces.Box(low=-1, high=1, shape=(observation_dimensions,))
+    action_space = gym.spaces.Box(low=np.array([-1.0, -1.0]), high=np.array([1.0, 1.0]), dtype=np.float32)
+    return observation_space, action_space
+
+
+class GazeborosSimEnv(gym.Env):
+    """
+    Drop in replacement of GazeborosEnv backed by FollowAheadSim, registered as gazeborosSim-v0
+    """
+
+    def __init__(self, is_evaluation=False):
+        self.sim = FollowAheadSim(1, is_evaluation)
+        self.agent_num = 0
+        self.observation_space, self.action_space = get_spaces(self.sim.use_orientation_in_observation)
+        self.reward_range = [-1, 1]
+        self.current_obsevation_image_ = None
+
+    def seed(self, seed=None):
+        self.np_random, seed = seeding.np_random(seed)
+        self.sim.seed(seed)
+        return [seed]
+
+    def set_agent(self, agent_num):
+        self.agent_num = agent_num
+
+    def use_test_setting(self):
+        self.sim.is_use_test_setting = True
+
+    def get_test_path_number(self):
+        return self.sim.test_settings[self.sim.test_setting_idx][2]
+
+    def next_setting(self):
+        self.sim.test_setting_idx += 1
+
+    def is_finish(self):
+        return self.sim.test_setting_idx >= len(self.sim.test_settings)-1
+
+    def set_person_mode(self, setting):
+        self.sim.person_mode = setting
+
+    def set_use_obstacles(self, setting):
+        self.sim.use_obstacles = setting
+
+    def set_mode_person_based_on_episode_number(self, episode_number):
+        self.sim.set_mode_person_based_on_episode_number(episode_number)
+
+    def get_person_pos(self):
+        xy = self.sim.pos[0, PERSON]
+        return [xy[0], xy[1], self.sim.orientation[0, PERSON]]
+
+    def get_angle_person_robot(self):
+        return self.sim.get_angle_person_robot()[0]
+
+    def get_current_observation_image(self):
+        # nothing is drawn without Gazebo, same blank image as GazeborosEnv in move base mode
+        if self.current_obsevation_image_ is None:
+            self.current_obsevation_image_ = np.full([2000,2000,3], 255.0)
+        return self.current_obsevation_image_
+
+    def resume_simulator(self):
+        return
+
+    def is_skip_run(self):
+        return False
+
+    def is_successful(self):
+        return bool(self.sim.is_successful()[0])
+
+    def reset(self):
+        return self.sim.reset_envs()[0]
+
+    def step(self, action):
+        observations, rewards, dones = self.sim.step(np.asarray(action)[None])
+        return observations[0], float(rewards[0]), bool(dones[0]), {}
+
+    def render(self, mode='human', close=False):
+        """ Viewer only supports human mode currently. """
+        return
+
+
+class VectorGazeborosEnv():
+    """
+    num_envs scenarios of FollowAheadSim stepped together with stacked arrays, for agents running a batched policy.
+    A scenario is reset as soon as it is done, step returns the first observation of its next episode and the
+    last observation of the finished one in infos[i]["terminal_observation"].
+    """
+
+    def __init__(self, num_envs, max_episode_steps=None, is_evaluation=False):
+        """
+        max_episode_steps: scenarios are also reset after this many steps, infos[i]["truncated"] is then True
+        """
+        self.num_envs = num_envs
+        self.max_episode_steps = max_episode_steps
+        self.sim = FollowAheadSim(num_envs, is_evaluation)
+        self.observation_space, self.action_space = get_spaces(self.sim.use_orientation_in_observation)
+        self.reward_range = [-1, 1]
+
+    def seed(self, seed=None):
+        self.sim.seed(seed)
+        return [seed]
+
+    def set_agent(self, agent_num):
+        return
+
+    def set_person_mode(self, setting):
+        self.sim.person_mode = setting
+
+    def set_use_obstacles(self, setting):
+        self.sim.use_obstacles = setting
+
+    def set_mode_person_based_on_episode_number(self, episode_number):
+        self.sim.set_mode_person_based_on_episode_number(episode_number)
+
+    def get_angle_person_robot(self):
+        return self.sim.get_angle_person_robot()
+
+    def reset(self):
+        """
+        returns observations [num_envs, obs_dim]
+        """
+        return self.sim.reset_envs()
+
+    def step(self, actions):
+        """
+        actions: [num_envs, action_dim]
+        returns observations [num_envs, obs_dim], rewards [num_envs], dones [num_envs], infos
+        """
+        observations, rewards, dones = self.sim.step(actions)
+        truncated = np.zeros(self.num_envs, dtype=bool)
+        if self.max_episode_steps is not None:
+            truncated = ~dones & (self.sim.number_of_steps >= self.max_episode_steps)
+        finished = np.flatnonzero(dones | truncated)
+
+        infos = [{} for _ in range(self.num_envs)]
+        if len(finished):
+            successful = self.sim.is_successful()
+            for env_idx in finished:
+                infos[env_idx]["terminal_observation"] = observations[env_idx].copy()
+                infos[env_idx]["truncated"] = bool(truncated[env_idx])
+                infos[env_idx]["is_successful"] = bool(successful[env_idx])
+            observations[finished] = self.sim.reset_envs(finished)
+        return observations, rewards, dones | truncated, infos
+
+    def render(self, mode='human', close=False):
+        """ Viewer only supports human mode currently. """
+        return
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Parses /gazebo/model_states once per message and republishes the compact state of every agent
+on COMPACT_MODEL_STATES_TOPIC, so each GazeborosEnv does not have to deserialize the full
+message of the world (see EnvConfig.USE_MODEL_STATES_DEMUX).
+
+The compact state is a Float64MultiArray of shape [models, MODEL_FIELDS]:
+    row 0: robot tb3_{agent}
+    row 1: person person_{agent}
+    row 2..: every model with "obstacle" in its name
+Each row holds the fields in the order of MODEL_FIELD_NAMES.
+
+Usage (after sourcing the workspace):
+    python -m gym_gazeboros_ac.envs.model_states_demux _num_agents:=3
+"""
+
+import numpy as np
+
+import rospy
+from rospy.numpy_msg import numpy_msg
+from gazebo_msgs.msg import ModelStates
+from std_msgs.msg import Float64MultiArray
+from std_msgs.msg import MultiArrayDimension
+
+COMPACT_MODEL_STATES_TOPIC = "/agent_{}/model_states_compact"
+
+MODEL_FIELD_NAMES = ("x", "y", "z", "qx", "qy", "qz", "qw", "linear_x", "linear_z", "angular_z")
+MODEL_FIELDS = len(MODEL_FIELD_NAMES)
+
+# Rows of the agent robots in a compact state, the obstacles follow
+ROBOT_ROW = 0
+PERSON_ROW = 1
+OBSTACLE_FIRST_ROW = 2
+
+
+def model_fields(pose, twist):
+    return (pose.position.x, pose.position.y, pose.position.z,
+            pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w,
+            twist.linear.x, twist.linear.z, twist.angular.z)
+
+
+class ModelStatesDemux(object):
+    def __init__(self, num_agents, publish_rate=None):
+        """
+        num_agents: number of agents in the world, agent n owns the models tb3_n and person_n
+        publish_rate: maximum rate(Hz) of the compact states, None to publish on every message
+        """
+        self.num_agents = num_agents
+        self.publish_period = 1.0 / publish_rate if publish_rate else 0
+        self.prev_publish_time = None
+        self.model_names_ = None
+        self.publishers = [rospy.Publisher(COMPACT_MODEL_STATES_TOPIC.format(agent_num), numpy_msg(Float64MultiArray), queue_size=1)
+                           for agent_num in range(num_agents)]
+        self.model_states_sub = rospy.Subscriber("/gazebo/model_states", ModelStates, self.model_states_cb, queue_size=1)
+
+    def update_model_indices(self, names):
+        """
+        Caches which models are needed and the rows of every agent, only called when the list of models changes
+        """
+        self.model_names_ = list(names)
+        obstacle_indices = [idx for idx, name in enumerate(self.model_names_) if "obstacle" in name]
+
+        # models parsed per message, and for every agent its rows in self.fields_
+        self.needed_indices_ = []
+        self.agent_rows_ = []
+        for agent_num in range(self.num_agents):
+            robot_name = "tb3_{}".format(agent_num)
+            person_name = "person_{}".format(agent_num)
+            if robot_name not in self.model_names_ or person_name not in self.model_names_:
+                self.agent_rows_.append(None)
+                continue
+            rows = []
+            for model_idx in [self.model_names_.index(robot_name), self.model_names_.index(person_name)]:
+                rows.append(len(self.needed_indices_))
+                self.needed_indices_.append(model_idx)
+            self.agent_rows_.append(rows)
+
+        obstacle_rows = list(range(len(self.needed_indices_), len(self.needed_indices_) + len(obstacle_indices)))
+        self.needed_indices_.extend(obstacle_indices)
+        self.agent_rows_ = [None if rows is None else np.asarray(rows + obstacle_rows) for rows in self.agent_rows_]
+        self.fields_ = np.zeros((len(self.needed_indices_), MODEL_FIELDS), dtype=np.float64)
+
+        self.msgs_ = []
+        for rows in self.agent_rows_:
+            msg = Float64MultiArray()
+            if rows is not None:
+                msg.layout.dim = [MultiArrayDimension(label="models", size=len(rows), stride=len(rows) * MODEL_FIELDS),
+                                  MultiArrayDimension(label="fields", size=MODEL_FIELDS, stride=MODEL_FIELDS)]
+                msg.data = np.zeros(len(rows) * MODEL_FIELDS, dtype=np.float64)
+            self.msgs_.append(msg)
+
+    def model_states_cb(self, states_msg):
+        now = rospy.get_time()
+        if self.prev_publish_time is not None and abs(now - self.prev_publish_time) < self.publish_period:
+            return
+        self.prev_publish_time = now
+
+        if states_msg.name != self.model_names_:
+            self.update_model_indices(states_msg.name)
+
+        for row, model_idx in enumerate(self.needed_indices_):
+            self.fields_[row] = model_fields(states_msg.pose[model_idx], states_msg.twist[model_idx])
+
+        for rows, msg, publisher in zip(self.agent_rows_, self.msgs_, self.publishers):
+            if rows is None:
+                continue
+            np.take(self.fields_, rows, axis=0, out=msg.data.reshape(len(rows), MODEL_FIELDS))
+            publisher.publish(msg)
+
+
+def main():
+    rospy.init_node('model_states_demux')
+    num_agents = rospy.get_param("~num_agents", 1)
+    publish_rate = rospy.get_param("~publish_rate", None)
+    ModelStatesDemux(num_agents, publish_rate)
+    rospy.spin()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Wall clock timing of the stages of an env step and of the subscriber callbacks. Nothing in here depends on ROS.
+"""
+
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+# Edges(milliseconds) of the bins of the duration histograms, the last bin collects everything slower
+HISTOGRAM_EDGES_MS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, float("inf"))
+
+
+class _NullSpan(object):
+    """Span of a disabled StepTimer, does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, durations):
+        self.durations = durations
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.durations.append(time.monotonic() - self.start)
+        return False
+
+
+class StepTimer(object):
+    """
+    Keeps the durations of the last window spans of every stage, e.g.
+        with self.step_timer.span("get_reward"):
+            reward = self.get_reward()
+    A disabled timer returns the same no-op span for every stage and records nothing.
+    """
+
+    def __init__(self, enabled=False, window=1000):
+        self.enabled = enabled
+        self.window = window
+        self.durations = {}
+
+    def span(self, stage):
+        if not self.enabled:
+            return _NULL_SPAN
+        durations = self.durations.get(stage)
+        if durations is None:
+            durations = self.durations[stage] = deque(maxlen=self.window)
+        return _Span(durations)
+
+    def reset(self):
+        self.durations = {}
+
+    def get_stats(self):
+        """
+        returns {stage: {"count", "mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms", "total_ms",
+                         "histogram": {"edges_ms", "counts"}}} over the last window spans of every stage
+        """
+        stats = {}
+        for stage, durations in list(self.durations.items()):
+            if len(durations) == 0:
+                continue
+            durations_ms = np.array(durations) * 1000.
+            counts, _ = np.histogram(durations_ms, bins=HISTOGRAM_EDGES_MS)
+            stats[stage] = {
+                "count": len(durations_ms),
+                "mean_ms": float(durations_ms.mean()),
+                "p50_ms": float(np.percentile(durations_ms, 50)),
+                "p90_ms": float(np.percentile(durations_ms, 90)),
+                "p99_ms": float(np.percentile(durations_ms, 99)),
+                "max_ms": float(durations_ms.max()),
+                "total_ms": float(durations_ms.sum()),
+                "histogram": {"edges_ms": list(HISTOGRAM_EDGES_MS), "counts": counts.tolist()},
+            }
+        return stats
+
+
+def _latency_stats_ms(values_ms, prefix):
+    if len(values_ms) == 0:
+        return {}
+    return {
+        prefix + "_mean_ms": float(values_ms.mean()),
+        prefix + "_p99_ms": float(np.percentile(values_ms, 99)),
+        prefix + "_max_ms": float(values_ms.max()),
+    }
+
+
+class CallbackProfiler(object):
+    """
+    Statistics of the last window calls of one subscriber callback: duration, interval between the arrivals
+    and its jitter (standard deviation), lag of the message (receive time - header stamp) and the number of
+    messages dropped before reaching the callback (gaps in header seq), the last two only for messages with a header.
+    record() runs on the callback thread, get_stats() can be called from any thread.
+    """
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.durations = deque(maxlen=window)
+        self.intervals = deque(maxlen=window)
+        self.lags = deque(maxlen=window)
+        self.prev_arrival = None
+        self.prev_seq = None
+        self.num_calls = 0
+        self.num_dropped = 0
+
+    def record(self, arrival, duration, lag=None, seq=None):
+        """
+        arrival: time.monotonic() when the callback started, duration: seconds the callback took
+        lag: seconds between the header stamp and the arrival, seq: header seq
+        """
+        with self.lock:
+            self.num_calls += 1
+            self.durations.append(duration)
+            if self.prev_arrival is not None:
+                self.intervals.append(arrival - self.prev_arrival)
+            self.prev_arrival = arrival
+            if lag is not None:
+                self.lags.append(lag)
+            if seq is not None:
+                if self.prev_seq is not None and seq > self.prev_seq + 1:
+                    self.num_dropped += seq - self.prev_seq - 1
+                self.prev_seq = seq
+
+    def get_stats(self):
+        """
+        returns {"calls", "dropped" (totals), "rate_hz", "duration_*_ms", "interval_mean_ms", "jitter_ms", "lag_*_ms"}
+        """
+        with self.lock:
+            durations_ms = np.array(self.durations) * 1000.
+            intervals_ms = np.array(self.intervals) * 1000.
+            lags_ms = np.array(self.lags) * 1000.
+            stats = {"calls": self.num_calls, "dropped": self.num_dropped}
+        stats.update(_latency_stats_ms(durations_ms, "duration"))
+        if len(intervals_ms) > 0:
+            stats["interval_mean_ms"] = float(intervals_ms.mean())
+            stats["jitter_ms"] = float(intervals_ms.std())
+            if intervals_ms.mean() > 0:
+                stats["rate_hz"] = float(1000. / intervals_ms.mean())
+        stats.update(_latency_stats_ms(lags_ms, "lag"))
+        return stats
@@ -0,0 +1,329 @@
+"""
+Throughput benchmark of the D4PG learner pipeline with synthetic transitions, no simulator needed.
+
+Measures the replay buffers (add and sample), the critic target projections and the learner updates fed
+either through the replay queue and sampler_worker (with the uniform or the prioritized buffer) or through
+the shared replay memory, and saves the results as JSON. With --baseline the results are compared to an earlier JSON.
+
+    python benchmark.py --device cpu --num-threads 8 --output results/benchmark_cpu.json
+    python benchmark.py --device cpu --num-threads 8 --baseline results/benchmark_cpu.json
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import queue
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+import torch.multiprocessing as torch_mp
+import yaml
+
+from models.d4pg.engine import sampler_worker
+from models.d4pg.d4pg import LearnerD4PG, L2Projection, CategoricalProjection
+from models.d4pg.networks import PolicyNetwork
+from models.d4pg.replay_buffer import ReplayBuffer, PrioritizedReplayBuffer, create_shared_replay_buffer
+from models.d4pg.shared_parameters import SharedParameters
+
+STATE_DIM = 47
+ACTION_DIM = 2
+
+
+def load_config(args):
+    """Config of the real runs with the shapes of the follow ahead task, without creating the environment. """
+    with open(args.config, 'r') as ymlfile:
+        config = yaml.safe_load(ymlfile)
+    config['state_dims'] = config['state_dim'] = STATE_DIM
+    config['action_dims'] = config['action_dim'] = ACTION_DIM
+    config['num_atoms'] = args.num_atoms
+    config['batch_size'] = args.batch_size
+    config['device'] = args.device
+    config['num_threads'] = args.num_threads
+    config['replay_memory_prioritized'] = 0
+    config['run_name'] = "benchmark"
+    config['test'] = False
+    # keep the learner from loading or overwriting the weights of the real runs
+    config['results_path'] = args.results_dir
+    config['value_weights'] = config['policy_weights'] = f"{args.results_dir}/"
+    config['value_weights_best'] = config['policy_weights_best'] = ""
+    return config
+
+
+def synthetic_transitions(num_samples, rng):
+    """(states, actions, rewards, next_states, dones, gammas) like the batches of NStepAccumulator"""
+    return (rng.standard_normal((num_samples, STATE_DIM)).astype(np.float32),
+            rng.uniform(-1, 1, (num_samples, ACTION_DIM)).astype(np.float32),
+            rng.uniform(-1, 0, num_samples),
+            rng.standard_normal((num_samples, STATE_DIM)).astype(np.float32),
+            (rng.random(num_samples) < 0.02).astype(np.float32),
+            np.full(num_samples, 0.99 ** 5))
+
+
+def latency_stats(times):
+    """times in seconds, returns the statistics in milliseconds"""
+    times_ms = np.asarray(times) * 1000.
+    return {
+        "mean_ms": float(times_ms.mean()),
+        "p50_ms": float(np.percentile(times_ms, 50)),
+        "p90_ms": float(np.percentile(times_ms, 90)),
+        "p99_ms": float(np.percentile(times_ms, 99)),
+        "max_ms": float(times_ms.max()),
+    }
+
+
+def depth_stats(depths):
+    depths = np.asarray(depths)
+    return {"mean": float(depths.mean()), "max": int(depths.max()), "zero_fraction": float((depths == 0).mean())}
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def bench_replay(config, num_samples, rng):
+    """add_batch and sample of every replay buffer kind filled to replay_mem_size"""
+    size = config['replay_mem_size']
+    batch_size = config['batch_size']
+    buffers = {
+        "uniform": ReplayBuffer(size),
+        "prioritized": PrioritizedReplayBuffer(size, alpha=config['priority_alpha']),
+        "shared": create_shared_replay_buffer(config, num_writers=2),
+    }
+    results = {}
+    for name, replay_buffer in buffers.items():
+        if name == "shared":
+            writer = replay_buffer.writer(0)
+            add_batch = writer.put_batch
+        else:
+            add_batch = replay_buffer.add_batch
+        chunk = 64
+        add_times = []
+        for _ in range(max(size // chunk, 1)):
+            transitions = synthetic_transitions(chunk, rng)
+            start = time.perf_counter()
+            add_batch(*transitions)
+            add_times.append(time.perf_counter() - start)
+
+        sample_times = []
+        update_times = []
+        for _ in range(num_samples):
+            start = time.perf_counter()
+            if name == "prioritized":
+                batch = replay_buffer.sample(batch_size, beta=config['priority_beta_start'])
+            else:
+                batch = replay_buffer.sample(batch_size)
+            sample_times.append(time.perf_counter() - start)
+            if name == "prioritized":
+                start = time.perf_counter()
+                replay_buffer.update_priorities(batch[-1], rng.random(batch_size) + 1e-4)
+                update_times.append(time.perf_counter() - start)
+
+        results[name] = {
+            "add_transitions_per_s": chunk * len(add_times) / sum(add_times),
+            "sample": latency_stats(sample_times),
+        }
+        if update_times:
+            results[name]["update_priorities"] = latency_stats(update_times)
+    return results
+
+
+def bench_projection(config, repeats, rng):
+    device = torch.device(config['device'])
+    z_atoms = torch.linspace(config['v_min'], config['v_max'], config['num_atoms'], device=device)
+    batch_size = config['batch_size']
+    reward = torch.as_tensor(rng.uniform(-1, 0, (batch_size, 1)), dtype=torch.float32, device=device)
+    done = torch.as_tensor(rng.random((batch_size, 1)) < 0.02, dtype=torch.float32, device=device)
+    probs = torch.softmax(torch.randn(batch_size, config['num_atoms'], device=device), dim=1)
+    target_z_atoms = reward + (1. - done) * config['discount_rate'] * z_atoms[None, :]
+
+    results = {}
+    for name, project in (("l2", L2Projection(z_atoms)), ("categorical", CategoricalProjection(z_atoms))):
+        project(target_z_atoms, probs)
+        synchronize(device)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            project(target_z_atoms, probs)
+            synchronize(device)
+            times.append(time.perf_counter() - start)
+        results[name] = latency_stats(times)
+    return results
+
+
+def transition_producer(replay, training_on, chunk, rate, seed):
+    """
+    Stands for the exploration agents, puts batches of chunk synthetic transitions to the replay queue
+    or writes them to the shared replay memory, rate transitions per second at most (0: no limit)
+    """
+    rng = np.random.default_rng(seed)
+    period = chunk / rate if rate > 0 else 0.
+    while training_on.value:
+        start = time.time()
+        transitions = synthetic_transitions(chunk, rng)
+        if hasattr(replay, 'put_batch'):
+            replay.put_batch(*transitions)
+        else:
+            try:
+                replay.put(transitions, timeout=0.1)
+            except queue.Full:
+                pass
+        remaining = period - (time.time() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+def bench_learner(config, mode, num_updates, warmup, chunk, rate):
+    """
+    Runs LearnerD4PG.ddpg_update fed like LearnerD4PG.run
+    mode: "queue" (producer -> replay queue -> sampler_worker -> batch queue), "prioritized" (same with the
+          prioritized buffer, the learner sends the priorities back to sampler_worker) or "shared" (shared replay memory)
+    """
+    if mode == "prioritized":
+        config = dict(config, replay_memory_prioritized=1)
+    training_on = torch_mp.Value('i', 1)
+    update_step = torch_mp.Value('i', 0)
+    global_episode = torch_mp.Value('i', 0)
+    replay_queue = torch_mp.Queue(maxsize=256)
+    batch_queue = torch_mp.Queue(maxsize=config['batch_queue_size'])
+    replay_priorities_queue = torch_mp.Queue(maxsize=256)
+    log_dir = f"{config['results_path']}/{mode}"
+
+    if mode == "shared":
+        shared_replay_buffer = create_shared_replay_buffer(config, num_writers=1)
+        producer_replay = shared_replay_buffer.writer(0)
+    else:
+        shared_replay_buffer = None
+        producer_replay = replay_queue
+
+    # built before the processes are started so a failing constructor does not leave them running
+    target_policy_net = PolicyNetwork(config['state_dims'], config['action_dims'], config['dense_size'],
+                                      device=config['device'])
+    policy_net = copy.deepcopy(target_policy_net)
+    learner = LearnerD4PG(config, policy_net, target_policy_net, SharedParameters(policy_net), log_dir=log_dir)
+    prefetcher = learner.create_prefetcher(batch_queue, shared_replay_buffer)
+
+    processes = []
+    if mode != "shared":
+        processes.append(torch_mp.Process(target=sampler_worker,
+                                          args=(config, replay_queue, batch_queue, replay_priorities_queue,
+                                                training_on, global_episode, update_step, log_dir)))
+    processes.append(torch_mp.Process(target=transition_producer,
+                                      args=(producer_replay, training_on, chunk, rate, config['random_seed'])))
+
+    wait_times = []
+    update_times = []
+    replay_queue_depths = []
+    batch_queue_depths = []
+    try:
+        for p in processes:
+            p.start()
+        for step in range(warmup + num_updates):
+            start = time.perf_counter()
+            batch = prefetcher.get()
+            synchronize(learner.device)
+            got_batch = time.perf_counter()
+            learner.ddpg_update(batch, replay_priorities_queue, update_step)
+            synchronize(learner.device)
+            done = time.perf_counter()
+            update_step.value += 1
+            if step < warmup:
+                continue
+            wait_times.append(got_batch - start)
+            update_times.append(done - got_batch)
+            replay_queue_depths.append(replay_queue.qsize())
+            batch_queue_depths.append(batch_queue.qsize())
+    finally:
+        training_on.value = 0
+        for p in processes:
+            if p.is_alive():
+                p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+
+    total_time = sum(wait_times) + sum(update_times)
+    results = {
+        "updates_per_s": num_updates / total_time,
+        "stage_time_s": {"batch_wait": sum(wait_times), "ddpg_update": sum(update_times)},
+        "batch_wait": latency_stats(wait_times),
+        "ddpg_update": latency_stats(update_times),
+    }
+    if mode != "shared":
+        results["replay_queue_depth"] = depth_stats(replay_queue_depths)
+        results["batch_queue_depth"] = depth_stats(batch_queue_depths)
+    return results
+
+
+def compare(results, baseline):
+    """Prints the ratio of the main metrics to the ones of the baseline, > 1 is faster"""
+    rows = [(f"learner/{mode}/updates_per_s",
+             results["learner"][mode]["updates_per_s"] / baseline["learner"][mode]["updates_per_s"])
+            for mode in results["learner"] if mode in baseline.get("learner", {})]
+    rows += [(f"replay/{name}/sample_p50", baseline["replay"][name]["sample"]["p50_ms"] /
+              results["replay"][name]["sample"]["p50_ms"])
+             for name in results["replay"] if name in baseline.get("replay", {})]
+    rows += [(f"projection/{name}_p50", baseline["projection"][name]["p50_ms"] / results["projection"][name]["p50_ms"])
+             for name in results["projection"] if name in baseline.get("projection", {})]
+    for name, ratio in rows:
+        print(f"{name:40s} x{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default="configs/follow_rl.yml")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--num-threads", type=int, default=0, help="torch.set_num_threads, 0 keeps the torch default")
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--num-atoms", type=int, default=51)
+    parser.add_argument("--updates", type=int, default=200, help="measured learner updates per mode")
+    parser.add_argument("--warmup", type=int, default=20, help="learner updates before measuring")
+    parser.add_argument("--samples", type=int, default=200, help="measured replay samples and projections")
+    parser.add_argument("--modes", default="queue,prioritized,shared",
+                        help="learner feeding modes to run: queue, prioritized, shared")
+    parser.add_argument("--chunk", type=int, default=64, help="transitions per put of the synthetic agent")
+    parser.add_argument("--rate", type=float, default=0, help="transitions per second of the synthetic agent, 0: no limit")
+    parser.add_argument("--results-dir", default=f"results/benchmark-{datetime.now():%Y-%m-%d_%H:%M:%S}")
+    parser.add_argument("--output", default=None, help="JSON file, <results-dir>/benchmark.json by default")
+    parser.add_argument("--baseline", default=None, help="earlier JSON output to compare to")
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    os.makedirs(args.results_dir, exist_ok=True)
+    config = load_config(args)
+    rng = np.random.default_rng(config['random_seed'])
+
+    results = {
+        "date": f"{datetime.now():%Y-%m-%d %H:%M:%S}",
+        "host": platform.node(),
+        "torch": torch.__version__,
+        "device": args.device,
+        "num_threads": torch.get_num_threads(),
+        "shapes": {"state_dim": STATE_DIM, "action_dim": ACTION_DIM, "num_atoms": args.num_atoms,
+                   "batch_size": args.batch_size, "replay_mem_size": config['replay_mem_size']},
+    }
+    print("Benchmarking replay buffers...")
+    results["replay"] = bench_replay(config, args.samples, rng)
+    print("Benchmarking projections...")
+    results["projection"] = bench_projection(config, args.samples, rng)
+    results["learner"] = {}
+    for mode in args.modes.split(','):
+        print(f"Benchmarking learner fed by {mode}...")
+        results["learner"][mode] = bench_learner(config, mode, args.updates, args.warmup, args.chunk, args.rate)
+
+    output = args.output or f"{args.results_dir}/benchmark.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Saved to {output}")
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ import time
 
 from utils.utils import OUNoise
 from utils.logger import Logger
+from utils.torch_utils import soft_update
 from utils.reward_plot import plot_rewards
 from .networks import ValueNetwork, PolicyNetwork
 
@@ -86,15 +87,8 @@ class LearnerD3PG(object):
         self.policy_optimizer.step()
 
         # Soft update
-        for target_param, param in zip(self.target_value_net.parameters(), self.value_net.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - self.tau) + param.data * self.tau
-            )
-
-        for target_param, param in zip(self.target_policy_net.parameters(), self.policy_net.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - self.tau) + param.data * self.tau
-            )
+        soft_update(self.target_value_net, self.value_net, self.tau)
+        soft_update(self.target_policy_net, self.policy_net, self.tau)
 
         # Send updated learner to the queue
         if not self.learner_w_queue.full():
@@ -45,7 +45,7 @@ def sampler_worker(config, replay_queue, batch_queue, training_on,
         n = replay_queue.qsize()
         for _ in range(n):
             replay = replay_queue.get()
-            replay_buffer.add(*replay)
+            replay_buffer.add_batch(*replay)
 
         # (2) Transfer batch of replay from buffer to the batch_queue
         if len(replay_buffer) < batch_size:
@@ -26,6 +26,17 @@ class ReplayBuffer(object):
 		self.ptr = (self.ptr + 1) % self.max_size
 		self.size = min(self.size + 1, self.max_size)
 
+	def add_batch(self, state, action, reward, next_state, done, *args):
+		ind = (self.ptr + np.arange(len(reward))) % self.max_size
+		self.state[ind] = state
+		self.action[ind] = action
+		self.next_state[ind] = next_state
+		self.reward[ind, 0] = reward
+		self.not_done[ind, 0] = 1. - np.asarray(done)
+
+		self.ptr = (self.ptr + len(reward)) % self.max_size
+		self.size = min(self.size + len(reward), self.max_size)
+
 	def sample(self, batch_size):
 		ind = np.random.randint(0, self.size, size=batch_size)
 		return (
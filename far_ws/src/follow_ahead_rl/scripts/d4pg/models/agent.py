@@ -3,12 +3,12 @@ import math
 import numpy as np
 import os
 import time
-from collections import deque
 import matplotlib.pyplot as plt
 import torch
 
-from utils.utils import OUNoise, make_gif
+from utils.utils import OUNoise, NStepAccumulator, put_transitions, make_gif
 from utils.logger import Logger
+from .d4pg.shared_parameters import SharedParameters
 from .env.utils import create_env_wrapper
 
 
@@ -33,10 +33,14 @@ class Agent(object):
             print("set agent {}".format(n_agent))
         except:
             print("\n\n\nERROR: cannot do env.set_agent()\n\n\n")
+        self.log_step_timing = config.get('log_step_timing', 0) and hasattr(self.env_wrapper.env, 'get_timing_stats')
+        if self.log_step_timing:
+            self.env_wrapper.env.set_step_timing(True)
         self.ou_noise = OUNoise(dim=config["action_dim"], low=config["action_low"], high=config["action_high"])
         self.ou_noise.reset()
 
         self.actor = policy
+        self.weights_version = 0
 
         # Logger
         log_path = f"{log_dir}/agent-{n_agent}"
@@ -48,6 +52,13 @@ class Agent(object):
 
     def update_actor_learner(self, learner_w_queue):
         """Update local actor to the actor from learner. """
+        if learner_w_queue is None:
+            # the policy is served by the inference server
+            return
+        if isinstance(learner_w_queue, SharedParameters):
+            # only copies when the learner published new weights
+            self.weights_version = learner_w_queue.copy_to(self.actor, self.weights_version)
+            return
         if learner_w_queue.empty():
             return
         source = learner_w_queue.get()
@@ -58,8 +69,8 @@ class Agent(object):
 
     # Payam's 
     # def run(self, training_on, replay_queue, learner_w_queue, update_step):
-        # Initialise deque buffer to store experiences for N-step returns
-        self.exp_buffer = deque()
+        # Accumulates the N-step returns of the experiences of the episode
+        self.n_step_acc = NStepAccumulator(self.config['n_step_returns'], self.config['discount_rate'])
 
         best_reward = -float("inf")
         rewards = []
@@ -78,7 +89,7 @@ class Agent(object):
             num_steps = 0
             self.local_episode += 1
             self.global_episode.value += 1
-            self.exp_buffer.clear()
+            self.n_step_acc.reset()
             if self.local_episode % 100 == 0:
                 print(f"Agent: {self.n_agent}  episode {self.local_episode}")
 
@@ -113,44 +124,25 @@ class Agent(object):
                 state = self.env_wrapper.normalise_state(state)
                 reward = self.env_wrapper.normalise_reward(reward)
 
+                episode_end = done or (not self.config["test"] and num_steps == self.max_steps)
+                skip_run = episode_end and hasattr(self.env_wrapper.env, 'is_skip_run') and self.env_wrapper.env.is_skip_run()
                 if not self.config["test"]:
-                    self.exp_buffer.append((state, action, reward))
+                    # the N-step experiences completed by this step, all the remaining ones at the end of the episode
+                    transitions = self.n_step_acc.add(state, action, reward, next_state, done, episode_end)
+                    if not skip_run:
+                        put_transitions(replay_queue, transitions)
                 else:
                     self.logger.scalar_summary("reward", reward_avg[-1], len(reward_avg))
                     self.logger.scalar_summary("distance", distance_avg[-1], len(reward_avg))
                     self.logger.scalar_summary("heading", heading_avg[-1], len(reward_avg))
 
-                # We need at least N steps in the experience buffer before we can compute Bellman
-                # rewards and add an N-step experience to replay memory
-                if len(self.exp_buffer) >= self.config['n_step_returns']:
-                    state_0, action_0, reward_0 = self.exp_buffer.popleft()
-                    discounted_reward = reward_0
-                    gamma = self.config['discount_rate']
-                    for (_, _, r_i) in self.exp_buffer:
-                        discounted_reward += r_i * gamma
-                        gamma *= self.config['discount_rate']
-                    if not replay_queue.full():
-                        replay_queue.put([state_0, action_0, discounted_reward, next_state, done, gamma])
-
                 state = next_state
 
-                if done or (not self.config["test"] and num_steps == self.max_steps):
-                    if hasattr(self.env_wrapper.env, 'is_skip_run') and self.env_wrapper.env.is_skip_run():
+                if episode_end:
+                    if skip_run:
                         print("skiping this run as it is not useful")
-                        skip_run = True
                         break
                     print ("agent {} done steps: {}/{} episode reward: {}".format(self.n_agent, num_steps, self.max_steps, episode_reward))
-                    # add rest of experiences remaining in buffer
-                    while len(self.exp_buffer) != 0:
-                        #print("agent {} exp_buffer_len {}".format(self.n_agent, len(self.exp_buffer)))
-                        state_0, action_0, reward_0 = self.exp_buffer.popleft()
-                        discounted_reward = reward_0
-                        gamma = self.config['discount_rate']
-                        for (_, _, r_i) in self.exp_buffer:
-                            #print("agent {} exp_buffer_len {}".format(self.n_agent, len(self.exp_buffer)))
-                            discounted_reward += r_i * gamma
-                            gamma *= self.config['discount_rate']
-                        replay_queue.put([state_0, action_0, discounted_reward, next_state, done, gamma])
                     break
 
                 num_steps += 1
@@ -220,8 +212,8 @@ class Agent(object):
     
     # Original 
     def run(self, training_on, replay_queue, learner_w_queue, update_step):
-        # Initialise deque buffer to store experiences for N-step returns
-        self.exp_buffer = deque()
+        # Accumulates the N-step returns of the experiences of the episode
+        self.n_step_acc = NStepAccumulator(self.config['n_step_returns'], self.config['discount_rate'])
 
         best_reward = -float("inf")
         rewards = []
@@ -230,7 +222,7 @@ class Agent(object):
             num_steps = 0
             self.local_episode += 1
             self.global_episode.value += 1
-            self.exp_buffer.clear()
+            self.n_step_acc.reset()
 
             if self.local_episode % 100 == 0:
                 print(f"Agent: {self.n_agent}  episode {self.local_episode}")
@@ -253,40 +245,17 @@ class Agent(object):
                 state = self.env_wrapper.normalise_state(state)
                 reward = self.env_wrapper.normalise_reward(reward)
 
-                self.exp_buffer.append((state, action, reward))
-
-                # We need at least N steps in the experience buffer before we can compute Bellman
-                # rewards and add an N-step experience to replay memory
-                if len(self.exp_buffer) >= self.config['n_step_returns']:
-                    state_0, action_0, reward_0 = self.exp_buffer.popleft()
-                    discounted_reward = reward_0
-                    gamma = self.config['discount_rate']
-                    for (_, _, r_i) in self.exp_buffer:
-                        discounted_reward += r_i * gamma
-                        gamma *= self.config['discount_rate']
-                    # We want to fill buffer only with form explorator
-                    if self.agent_type == "exploration":
-                        try:
-                            replay_queue.put_nowait([state_0, action_0, discounted_reward, next_state, done, gamma])
-                        except:
-                            pass
+                # We need at least N steps before we can compute Bellman rewards, the accumulator returns
+                # the N-step experiences completed by this step and all the remaining ones at the end of the episode
+                episode_end = done or num_steps == self.max_steps
+                transitions = self.n_step_acc.add(state, action, reward, next_state, done, episode_end)
+                # We want to fill buffer only with form explorator
+                if self.agent_type == "exploration":
+                    put_transitions(replay_queue, transitions)
 
                 state = next_state
 
-                if done or num_steps == self.max_steps:
-                    # add rest of experiences remaining in buffer
-                    while len(self.exp_buffer) != 0:
-                        state_0, action_0, reward_0 = self.exp_buffer.popleft()
-                        discounted_reward = reward_0
-                        gamma = self.config['discount_rate']
-                        for (_, _, r_i) in self.exp_buffer:
-                            discounted_reward += r_i * gamma
-                            gamma *= self.config['discount_rate']
-                        if self.agent_type == "exploration":
-                            try:
-                                replay_queue.put_nowait([state_0, action_0, discounted_reward, next_state, done, gamma])
-                            except:
-                               pass
+                if episode_end:
                     break
 
                 num_steps += 1
@@ -295,6 +264,8 @@ class Agent(object):
             step = update_step.value
             self.logger.scalar_summary("agent/reward", episode_reward, step)
             self.logger.scalar_summary("agent/episode_timing", time.time() - ep_start_time, step)
+            if self.log_step_timing:
+                self.log_timing_stats(step)
 
             # Saving agent
             reward_outperformed = episode_reward - best_reward > self.config["save_reward_threshold"]
@@ -306,7 +277,7 @@ class Agent(object):
 
             rewards.append(episode_reward)
             if self.agent_type == "exploration" and self.local_episode % self.config['update_agent_ep'] == 0:
-                self.update_actor_learner(learner_w_queue, training_on)
+                self.update_actor_learner(learner_w_queue)
 
         empty_torch_queue(replay_queue)
         print(f"Agent {self.n_agent} done.")
@@ -326,6 +297,12 @@ class Agent(object):
         model_fn = f"{last_path}/best.pt"
         torch.save(self.actor, model_fn)
 
+    def log_timing_stats(self, step):
+        """Logs the durations of the env step stages, e.g. timing/get_observation_p90_ms """
+        for stage, stats in self.env_wrapper.env.get_timing_stats().items():
+            for key in ("mean_ms", "p90_ms", "p99_ms", "max_ms"):
+                self.logger.scalar_summary(f"timing/{stage}_{key}", stats[key], step)
+
     def save_replay_gif(self):
         dir_name = "replay_render"
         if not os.path.exists(dir_name):
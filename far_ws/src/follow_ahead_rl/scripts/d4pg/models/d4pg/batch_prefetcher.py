@@ -0,0 +1,83 @@
+import queue
+import threading
+
+import numpy as np
+import torch
+
+
+class BatchPrefetcher(object):
+    """
+    Assembles the next batches in a background thread while the learner runs its update.
+    Every batch is copied into one of num_slots preallocated host tensors (pinned when the device is cuda),
+    get() then starts a non_blocking copy into preallocated device tensors and returns them.
+    The returned tensors are only valid until the next get().
+    """
+
+    def __init__(self, get_batch, batch_size, state_dim, action_dim, device, num_slots=3):
+        """
+        get_batch: blocking callable returning the next batch
+            [state, action, reward, next_state, done, gamma, weights, inds] like ReplayBuffer.sample
+        """
+        self.get_batch = get_batch
+        self.device = torch.device(device)
+        self.use_pinned = self.device.type == 'cuda'
+        shapes = ((batch_size, state_dim), (batch_size, action_dim), (batch_size,), (batch_size, state_dim),
+                  (batch_size,), (batch_size,), (batch_size,))
+        self.slots = [[torch.empty(shape, dtype=torch.float32, pin_memory=self.use_pinned) for shape in shapes]
+                      for _ in range(num_slots)]
+        self.slot_inds = [None] * num_slots
+        self.copy_done = [None] * num_slots
+        if self.use_pinned:
+            self.device_tensors = [torch.empty(shape, dtype=torch.float32, device=self.device) for shape in shapes]
+
+        self.free_slots = queue.Queue()
+        for slot_idx in range(num_slots):
+            self.free_slots.put(slot_idx)
+        self.ready_slots = queue.Queue()
+        self.current_slot = None
+        # exception of the background thread, raised by get()
+        self.error = None
+
+        self.thread = threading.Thread(target=self.fill_slots, daemon=True)
+        self.thread.start()
+
+    def fill_slots(self):
+        while True:
+            slot_idx = self.free_slots.get()
+            if self.copy_done[slot_idx] is not None:
+                # the device copy of the previous batch of this slot has to finish before it is overwritten
+                self.copy_done[slot_idx].synchronize()
+            try:
+                batch = self.get_batch()
+                for tensor, values in zip(self.slots[slot_idx], batch):
+                    tensor.copy_(torch.from_numpy(np.asarray(values)))
+                self.slot_inds[slot_idx] = np.asarray(batch[7]).flatten()
+            except Exception as e:
+                # the learner is blocked in get(), hand the error over instead of dying silently
+                self.error = e
+                self.ready_slots.put(None)
+                return
+            self.ready_slots.put(slot_idx)
+
+    def get(self):
+        """
+        Blocks until the next batch is ready, raises a RuntimeError if the background thread failed to assemble it
+        returns (state, action, reward, next_state, done, gamma, weights) float32 tensors on the device and inds as numpy array
+        """
+        if self.current_slot is not None:
+            self.free_slots.put(self.current_slot)
+            self.current_slot = None
+        slot_idx = self.ready_slots.get()
+        if slot_idx is None:
+            # every later call fails the same way
+            self.ready_slots.put(None)
+            raise RuntimeError("BatchPrefetcher failed to assemble a batch") from self.error
+        self.current_slot = slot_idx
+        tensors = self.slots[slot_idx]
+        if self.use_pinned:
+            for device_tensor, tensor in zip(self.device_tensors, tensors):
+                device_tensor.copy_(tensor, non_blocking=True)
+            self.copy_done[slot_idx] = torch.cuda.Event()
+            self.copy_done[slot_idx].record()
+            tensors = self.device_tensors
+        return tuple(tensors) + (self.slot_inds[slot_idx],)
@@ -10,8 +10,10 @@ import os
 from utils.utils import OUNoise
 from utils.reward_plot import plot_rewards
 from utils.logger import Logger
+from utils.torch_utils import soft_update
 
 from .networks import PolicyNetwork, ValueNetwork
+from .batch_prefetcher import BatchPrefetcher
 
 def _l2_project(z_p, p, z_q):
     """Projects distribution (z_p, p) onto support z_q under L2-metric over CDFs.
@@ -37,8 +39,6 @@ def _l2_project(z_p, p, z_q):
     # Adapted for PyTorch from: https://github.com/deepmind/trfl/blob/master/trfl/dist_value_ops.py
     # Projects the target distribution onto the support of the original network [Vmin, Vmax]
 
-    z_p = torch.tensor(z_p).float()
-
     # Extract vmin and vmax and construct helper tensors from z_q
     vmin, vmax = z_q[0], z_q[-1]
 
@@ -53,8 +53,8 @@ def _l2_project(z_p, p, z_q):
     d_neg = (z_q - d_neg)[None, :, None]
     z_q = z_q[None, :, None]
 
-    d_neg = torch.where(d_neg>0, 1./d_neg, torch.zeros(d_neg.shape))
-    d_pos = torch.where(d_pos>0, 1./d_pos, torch.zeros(d_pos.shape))
+    d_neg = torch.where(d_neg>0, 1./d_neg, torch.zeros_like(d_neg))
+    d_pos = torch.where(d_pos>0, 1./d_pos, torch.zeros_like(d_pos))
 
     delta_qp = z_p - z_q
     d_sign = (delta_qp >= 0).type(p.dtype)
@@ -64,10 +64,56 @@ def _l2_project(z_p, p, z_q):
     return torch.sum(torch.clamp(1. - delta_hat, 0., 1.) * p, -1)
 
 
+class L2Projection(object):
+    """
+    _l2_project onto a fixed support z_q. The helper tensors are built once on the device of z_q
+    and the [batch_size, Kq, Kp] intermediate is updated in place, call it under torch.no_grad().
+    """
+
+    def __init__(self, z_q):
+        self.vmin, self.vmax = z_q[0].item(), z_q[-1].item()
+        d_pos = torch.cat([z_q, z_q[:1]], 0)[1:] - z_q
+        d_neg = z_q - torch.cat([z_q[-1:], z_q], 0)[:-1]
+        # delta_hat = delta_qp * d_pos where delta_qp >= 0 and -delta_qp * d_neg elsewhere
+        self.d_pos = torch.where(d_pos > 0, 1. / d_pos, torch.zeros_like(d_pos))[None, :, None]
+        self.minus_d_neg = -torch.where(d_neg > 0, 1. / d_neg, torch.zeros_like(d_neg))[None, :, None]
+        self.z_q = z_q[None, :, None]
+
+    def __call__(self, z_p, p):
+        delta_qp = torch.clamp(z_p, self.vmin, self.vmax)[:, None, :] - self.z_q
+        delta_qp.mul_(torch.where(delta_qp >= 0, self.d_pos, self.minus_d_neg))
+        return delta_qp.neg_().add_(1.).clamp_(0., 1.).mul_(p[:, None, :]).sum(-1)
+
+
+class CategoricalProjection(object):
+    """
+    Categorical (C51) projection of (z_p, p) onto an evenly spaced support z_q. Every atom of z_p splits its
+    probability between its two neighbours on z_q with scatter_add, O(batch_size * Kp) instead of the
+    O(batch_size * Kq * Kp) of L2Projection. Equal to the L2 projection for evenly spaced supports.
+    """
+
+    def __init__(self, z_q):
+        self.vmin, self.vmax = z_q[0].item(), z_q[-1].item()
+        self.num_atoms = len(z_q)
+        self.delta_z = (self.vmax - self.vmin) / (self.num_atoms - 1)
+
+    def __call__(self, z_p, p):
+        # position of every atom on the support in units of delta_z
+        b = (torch.clamp(z_p, self.vmin, self.vmax) - self.vmin) / self.delta_z
+        lower = b.floor()
+        upper_weight = b - lower
+        lower = lower.long()
+        upper = torch.clamp(lower + 1, max=self.num_atoms - 1)
+        projected = torch.zeros(p.shape[0], self.num_atoms, dtype=p.dtype, device=p.device)
+        projected.scatter_add_(1, lower, p * (1. - upper_weight))
+        projected.scatter_add_(1, upper, p * upper_weight)
+        return projected
+
+
 class LearnerD4PG(object):
     """Policy and value network update routine. """
 
-    def __init__(self, config, policy_net, target_policy_net, learner_w_queue, log_dir=''):
+    def __init__(self, config, policy_net, target_policy_net, shared_weights, log_dir=''):
         hidden_dim = config['dense_size']
         state_dim = config['state_dims']
         action_dim = config['action_dims']
@@ -82,15 +128,18 @@ class LearnerD4PG(object):
         self.run_name = config['run_name']
         num_atoms = config['num_atoms']
         self.counter = 0
-        self.device = config['device']
+        self.device = torch.device(config['device'])
         self.max_steps = config['max_ep_length']
         self.num_train_steps = config['num_steps_train']
         self.batch_size = config['batch_size']
+        self.state_dim = state_dim
+        self.action_dim = action_dim
         self.tau = config['tau']
         self.gamma = config['discount_rate']
         self.log_dir = log_dir
         self.prioritized_replay = config['replay_memory_prioritized']
-        self.learner_w_queue = learner_w_queue
+        self.shared_weights = shared_weights
+        self.weights_publish_interval = config.get('weights_publish_interval', 1)
 
         self.logger = Logger(f"{log_dir}/learner", name="{}/learner".format(self.run_name), project_name=config["project_name"])
         self.path_weight_run = self.logger.get_log_dir()
@@ -104,7 +153,7 @@ class LearnerD4PG(object):
         self.value_net = ValueNetwork(state_dim, action_dim, hidden_dim, v_min, v_max, num_atoms, device=self.device)
         self.target_value_net = ValueNetwork(state_dim, action_dim, hidden_dim, v_min, v_max, num_atoms, device=self.device)
         if os.path.exists(config['value_weights_best']):
-            self.value_net.load_state_dict(torch.load(config['value_weights_best']))
+            self.value_net.load_state_dict(torch.load(config['value_weights_best'], map_location=self.device))
             self.target_value_net = copy.deepcopy(self.value_net)
         else:
             print("cannot load value_net: {}".format(config['value_weights_best']))
@@ -123,65 +172,49 @@ class LearnerD4PG(object):
 
         self.value_criterion = nn.BCELoss(reduction='none')
 
+        # Support of the critic distribution and its discounted template for the targets, kept on the device
+        self.z_atoms = torch.as_tensor(self.value_net.z_atoms, dtype=torch.float32, device=self.device)
+        self.discounted_z_atoms = self.gamma * self.z_atoms[None, :]
+        if config.get('critic_projection', 'l2') == 'categorical':
+            self.project = CategoricalProjection(self.z_atoms)
+        else:
+            self.project = L2Projection(self.z_atoms)
+
     def ddpg_update(self, batch, replay_priority_queue, update_step, min_value=-np.inf, max_value=np.inf):
         update_time = time.time()
 
+        # tensors on self.device from BatchPrefetcher
         state, action, reward, next_state, done, gamma, weights, inds = batch
-
-        state = np.asarray(state)
-        action = np.asarray(action)
-        reward = np.asarray(reward)
-        next_state = np.asarray(next_state)
-        done = np.asarray(done)
-        weights = np.asarray(weights)
-        inds = np.asarray(inds).flatten()
-
-        state = torch.from_numpy(state).float().to(self.device)
-        next_state = torch.from_numpy(next_state).float().to(self.device)
-        action = torch.from_numpy(action).float().to(self.device)
-        reward = torch.from_numpy(reward).float().unsqueeze(1).to(self.device)
-        done = torch.from_numpy(done).float().unsqueeze(1).to(self.device)
+        reward = reward.unsqueeze(1)
+        done = done.unsqueeze(1)
 
         # ------- Update critic -------
 
-        # Predict next actions with target policy network
-        next_action = self.target_policy_net(next_state)
-
-        # Predict Z distribution with target value network
-        target_value = self.target_value_net.get_probs(next_state, next_action.detach())
-        target_z_atoms = self.value_net.z_atoms
+        with torch.no_grad():
+            # Predict next actions with target policy network
+            next_action = self.target_policy_net(next_state)
 
-        # Batch of z-atoms
-        target_Z_atoms = np.repeat(np.expand_dims(target_z_atoms, axis=0), self.batch_size,
-                                   axis=0)  # [batch_size x n_atoms]
-        # Value of terminal states is 0 by definition
+            # Predict Z distribution with target value network
+            target_value = self.target_value_net.get_probs(next_state, next_action)
 
-        target_Z_atoms *= (done.cpu().int().numpy() == 0)
-
-        # Apply bellman update to each atom (expected value)
-        reward = reward.cpu().float().numpy()
-        target_Z_atoms = reward + (target_Z_atoms * self.gamma)
-        target_z_projected = _l2_project(torch.from_numpy(target_Z_atoms).cpu().float(),
-                                         target_value.cpu().float(),
-                                         torch.from_numpy(self.value_net.z_atoms).cpu().float())
+            # Batch of z-atoms [batch_size x n_atoms], value of terminal states is 0 by definition
+            # Apply bellman update to each atom (expected value)
+            target_Z_atoms = reward + (1. - done) * self.discounted_z_atoms
+            target_z_projected = self.project(target_Z_atoms, target_value)
 
         critic_value = self.value_net.get_probs(state, action)#self.value_net(state, action)
 
-        critic_value = critic_value.to(self.device)
-
-        value_loss = self.value_criterion(critic_value,
-                                     torch.autograd.Variable(target_z_projected, requires_grad=False).cuda())
+        value_loss = self.value_criterion(critic_value, target_z_projected)
 
         value_loss = value_loss.mean(axis=1)
 
         # Update priorities in buffer
-        td_error = value_loss.cpu().detach().numpy().flatten()
-
         priority_epsilon = 1e-4
         if self.prioritized_replay:
+            td_error = value_loss.cpu().detach().numpy().flatten()
             weights_update = np.abs(td_error) + priority_epsilon
             replay_priority_queue.put((inds, weights_update))
-            value_loss = value_loss * torch.tensor(weights).cuda().float()
+            value_loss = value_loss * weights
 
         value_loss = value_loss.mean()
 
@@ -192,7 +225,7 @@ class LearnerD4PG(object):
         # -------- Update actor -----------
 
         policy_loss = self.value_net.get_probs(state, self.policy_net(state))
-        policy_loss = policy_loss * torch.tensor(self.value_net.z_atoms).float().cuda()
+        policy_loss = policy_loss * self.z_atoms
         policy_loss = torch.sum(policy_loss, dim=1)
         policy_loss = -policy_loss.mean()
 
@@ -200,20 +233,12 @@ class LearnerD4PG(object):
         policy_loss.backward()
         self.policy_optimizer.step()
 
-        for target_param, param in zip(self.target_value_net.parameters(), self.value_net.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - self.tau) + param.data * self.tau
-            )
-
-        for target_param, param in zip(self.target_policy_net.parameters(), self.policy_net.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - self.tau) + param.data * self.tau
-            )
+        soft_update(self.target_value_net, self.value_net, self.tau)
+        soft_update(self.target_policy_net, self.policy_net, self.tau)
 
-        # Send updated learner to the queue
-        if not self.learner_w_queue.full():
-            params = [p.data.cpu().detach().numpy() for p in self.policy_net.parameters()]
-            self.learner_w_queue.put(params)
+        # Publish the updated policy to the agents
+        if self.counter % self.weights_publish_interval == 0:
+            self.shared_weights.publish(self.policy_net)
 
         # Logging
         step = update_step.value
@@ -242,12 +267,25 @@ class LearnerD4PG(object):
             self.logger.save_model("{}_policy.pt".format(self.counter))
             self.logger.save_model("{}_value.pt".format(self.counter))
 
-    def run(self, training_on, batch_queue, replay_priority_queue, update_step):
-        while update_step.value < self.num_train_steps:
-            if batch_queue.empty():
-                continue
+    def create_prefetcher(self, batch_queue, shared_replay_buffer=None):
+        """
+        BatchPrefetcher of the batches of sampler_worker from batch_queue, or sampled from shared_replay_buffer if given
+        """
+        if shared_replay_buffer is not None:
+            # the agents write to the shared replay memory, sample it here instead of getting the sampler batches
+            def get_batch():
+                while len(shared_replay_buffer) < self.batch_size:
+                    time.sleep(0.01)
+                return shared_replay_buffer.sample(self.batch_size)
+        else:
+            get_batch = batch_queue.get
+        return BatchPrefetcher(get_batch, self.batch_size, self.state_dim, self.action_dim, self.device)
+
+    def run(self, training_on, batch_queue, replay_priority_queue, update_step, shared_replay_buffer=None):
+        prefetcher = self.create_prefetcher(batch_queue, shared_replay_buffer)
 
-            batch = batch_queue.get()
+        while update_step.value < self.num_train_steps:
+            batch = prefetcher.get()
             self.ddpg_update(batch, replay_priority_queue, update_step)
             update_step.value += 1
 
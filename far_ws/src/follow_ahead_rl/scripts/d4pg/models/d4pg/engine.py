@@ -11,11 +11,14 @@ import os
 
 import torch
 from models.agent import Agent
+from models.vector_agent import VectorAgent
 from utils.logger import Logger
 
 from .d4pg import LearnerD4PG
 from .networks import PolicyNetwork
-from .replay_buffer import create_replay_buffer
+from .replay_buffer import create_replay_buffer, create_shared_replay_buffer
+from .shared_parameters import SharedParameters
+from .inference_server import InferenceServer, inference_worker
 
 
 def sampler_worker(config, replay_queue, batch_queue, replay_priorities_queue, training_on,
@@ -32,6 +35,9 @@ def sampler_worker(config, replay_queue, batch_queue, replay_priorities_queue, t
         log_dir:
     """
     batch_size = config['batch_size']
+    beta_start = config['priority_beta_start']
+    beta_end = config['priority_beta_end']
+    num_steps_train = config['num_steps_train']
 
     # Logger
     run_name = config["run_name"]
@@ -45,7 +51,7 @@ def sampler_worker(config, replay_queue, batch_queue, replay_priorities_queue, t
         n = replay_queue.qsize()
         for _ in range(n):
             replay = replay_queue.get()
-            replay_buffer.add(*replay)
+            replay_buffer.add_batch(*replay)
 
         # (2) Transfer batch of replay from buffer to the batch_queue
         if len(replay_buffer) < batch_size:
@@ -56,7 +62,9 @@ def sampler_worker(config, replay_queue, batch_queue, replay_priorities_queue, t
             replay_buffer.update_priorities(inds, weights)
 
         if not batch_queue.full():
-            batch = replay_buffer.sample(batch_size)
+            # importance sampling exponent of the prioritized buffer annealed linearly over the training
+            beta = beta_start + (beta_end - beta_start) * min(update_step.value / num_steps_train, 1.)
+            batch = replay_buffer.sample(batch_size, beta=beta)
             batch_queue.put(batch)
 
         #if update_step.value % 1000 == 0:
@@ -72,21 +80,26 @@ def sampler_worker(config, replay_queue, batch_queue, replay_priorities_queue, t
     print("Stop sampler worker.")
 
 
-def learner_worker(config, training_on, policy, target_policy_net, learner_w_queue, replay_priority_queue,
-                   batch_queue, update_step, experiment_dir):
-    learner = LearnerD4PG(config, policy, target_policy_net, learner_w_queue, log_dir=experiment_dir)
-    learner.run(training_on, batch_queue, replay_priority_queue, update_step)
+def learner_worker(config, training_on, policy, target_policy_net, shared_weights, replay_priority_queue,
+                   batch_queue, update_step, experiment_dir, shared_replay_buffer=None):
+    if config.get('num_threads', 0) > 0:
+        # several learners on one CPU node would otherwise all use every core
+        torch.set_num_threads(config['num_threads'])
+    learner = LearnerD4PG(config, policy, target_policy_net, shared_weights, log_dir=experiment_dir)
+    learner.run(training_on, batch_queue, replay_priority_queue, update_step, shared_replay_buffer)
 
 
-def agent_worker(config, policy, learner_w_queue, global_episode, i, agent_type,
+def agent_worker(config, policy, shared_weights, global_episode, i, agent_type,
                  experiment_dir, training_on, replay_queue, update_step):
-    agent = Agent(config,
-                  policy=policy,
-                  global_episode=global_episode,
-                  n_agent=i,
-                  agent_type=agent_type,
-                  log_dir=experiment_dir)
-    agent.run(training_on, replay_queue, learner_w_queue, update_step)
+    # Several headless scenarios per process with a batched policy instead of one env per process
+    agent_class = VectorAgent if config.get('num_envs_per_agent', 1) > 1 else Agent
+    agent = agent_class(config,
+                        policy=policy,
+                        global_episode=global_episode,
+                        n_agent=i,
+                        agent_type=agent_type,
+                        log_dir=experiment_dir)
+    agent.run(training_on, replay_queue, shared_weights, update_step)
 
 
 class Engine(object):
@@ -112,29 +125,41 @@ class Engine(object):
         training_on = torch_mp.Value('i', 1)
         update_step = torch_mp.Value('i', 0)
         global_episode = torch_mp.Value('i', 0)
-        learner_w_queue = torch_mp.Queue(maxsize=n_agents)
         replay_priorities_queue = torch_mp.Queue(maxsize=256)
 
         # Data sampler
         batch_queue = torch_mp.Queue(maxsize=batch_queue_size)
-        p = torch_mp.Process(target=sampler_worker,
-                             args=(config, replay_queue, batch_queue, replay_priorities_queue, training_on,
-                                   global_episode, update_step, experiment_dir))
-        processes.append(p)
+        # With the shared replay memory the exploration agents write to it and the learner samples it,
+        # there is no sampler process. Agent 0 only exploits, agent i writes with writer i-1.
+        # Prioritized replay needs the sampler to own the priorities.
+        shared_replay_buffer = None
+        if config.get('replay_shared_memory', 0):
+            if config['replay_memory_prioritized']:
+                print("replay_shared_memory does not support replay_memory_prioritized, using the replay queue")
+            else:
+                shared_replay_buffer = create_shared_replay_buffer(config, num_writers=max(n_agents - 1, 1))
+        if shared_replay_buffer is None:
+            p = torch_mp.Process(target=sampler_worker,
+                                 args=(config, replay_queue, batch_queue, replay_priorities_queue, training_on,
+                                       global_episode, update_step, experiment_dir))
+            processes.append(p)
 
         # Learner (neural net training process)
         target_policy_net = PolicyNetwork(config['state_dims'], config['action_dims'],
                                           config['dense_size'], device=config['device'])
         if os.path.exists(config.get("policy_weights_best", "location_not_found")):
-            target_policy_net.load_state_dict(torch.load(config["policy_weights_best"]))
+            target_policy_net.load_state_dict(torch.load(config["policy_weights_best"], map_location=config['device']))
         else:
             print(f"cannot load policy")
         policy_net = copy.deepcopy(target_policy_net)
 
         target_policy_net.share_memory()
+        # The learner publishes its policy here, the exploration agents load it when it changed
+        shared_weights = SharedParameters(policy_net)
 
-        p = torch_mp.Process(target=learner_worker, args=(config, training_on, policy_net, target_policy_net, learner_w_queue,
-                                                          replay_priorities_queue, batch_queue, update_step, experiment_dir))
+        p = torch_mp.Process(target=learner_worker, args=(config, training_on, policy_net, target_policy_net, shared_weights,
+                                                          replay_priorities_queue, batch_queue, update_step, experiment_dir,
+                                                          shared_replay_buffer))
         processes.append(p)
 
         p = torch_mp.Process(target=agent_worker,
@@ -146,16 +171,31 @@ class Engine(object):
         if self.use_supervisor:
             n_agents -= 1
 
+        # With the inference server the exploration agents have no policy of their own, the server batches
+        # their requests and is the only one loading the weights of the learner
+        inference_server = None
+        if config.get('inference_server', 0) and n_agents > 1:
+            inference_server = InferenceServer(config, num_clients=n_agents - 1, training_on=training_on)
+            p = torch_mp.Process(target=inference_worker,
+                                 args=(config, inference_server, policy_net, shared_weights, update_step, experiment_dir))
+            processes.append(p)
+
         for i in range(1, n_agents):
+            agent_replay = replay_queue if shared_replay_buffer is None else shared_replay_buffer.writer(i - 1)
+            if inference_server is None:
+                agent_policy, agent_weights = policy_net, shared_weights
+            else:
+                agent_policy, agent_weights = inference_server.client(i - 1), None
             p = torch_mp.Process(target=agent_worker,
-                                 args=(config, policy_net, learner_w_queue, global_episode, i, "exploration", experiment_dir,
-                                       training_on, replay_queue, update_step))
+                                 args=(config, agent_policy, agent_weights, global_episode, i, "exploration", experiment_dir,
+                                       training_on, agent_replay, update_step))
             processes.append(p)
 
         if self.use_supervisor:
+            agent_replay = replay_queue if shared_replay_buffer is None else shared_replay_buffer.writer(i)
             p = torch_mp.Process(target=agent_worker,
-                                 args=(config, target_policy_net, learner_w_queue, global_episode, i+1, "supervisor", experiment_dir,
-                                       training_on, replay_queue, update_step))
+                                 args=(config, target_policy_net, shared_weights, global_episode, i+1, "supervisor", experiment_dir,
+                                       training_on, agent_replay, update_step))
             processes.append(p)
 
 
@@ -185,24 +225,24 @@ class Engine(object):
         training_on = torch_mp.Value('i', 1)
         update_step = torch_mp.Value('i', 0)
         global_episode = torch_mp.Value('i', 0)
-        learner_w_queue = torch_mp.Queue(maxsize=n_agents)
         replay_priorities_queue = torch_mp.Queue(maxsize=256)
 
         # Learner (neural net training process)
         target_policy_net = PolicyNetwork(config['state_dims'], config['action_dims'],
                                           config['dense_size'], device=config['device'])
         if os.path.exists(config["policy_weights_best"]):
-            target_policy_net.load_state_dict(torch.load(config["policy_weights_best"]))
+            target_policy_net.load_state_dict(torch.load(config["policy_weights_best"], map_location=config['device']))
         else:
             print("cannot load policy {}".format(config["policy_weights_best"]))
         policy_net = copy.deepcopy(target_policy_net)
 
         target_policy_net.share_memory()
+        shared_weights = SharedParameters(target_policy_net)
 
         # Single agent for exploitation
         if config["use_base_line"] == 1:
             p = torch_mp.Process(target=agent_worker,
-                                 args=(config, target_policy_net, learner_w_queue, global_episode, 0, "supervisor", experiment_dir,
+                                 args=(config, target_policy_net, shared_weights, global_episode, 0, "supervisor", experiment_dir,
                                        training_on, replay_queue, update_step))
         else:
             p = torch_mp.Process(target=agent_worker,
@@ -0,0 +1,121 @@
+import copy
+import queue
+import time
+
+import torch
+import torch.multiprocessing as torch_mp
+
+from utils.logger import Logger
+
+
+class InferenceServer(object):
+    """
+    Batched policy inference for the exploration agents. The agents write their states to a shared memory
+    slot and put their index in the request queue, the server process waits at most max_latency after the
+    first request for the others, runs one forward pass for all of them on its device and writes the actions back.
+    Only the server keeps a copy of the policy, it loads the weights the learner publishes in SharedParameters.
+    """
+
+    def __init__(self, config, num_clients, training_on):
+        """
+        Args:
+            config: inference_device and inference_max_latency (seconds), a slot has num_envs_per_agent states
+            num_clients (int): number of agents using the server
+            training_on: the server stops and releases the waiting agents when it is 0
+        """
+        self.num_clients = num_clients
+        self.num_rows = config.get('num_envs_per_agent', 1)
+        self.max_latency = config.get('inference_max_latency', 0.002)
+        self.device = config.get('inference_device', config['device'])
+        self.training_on = training_on
+        self.states = torch.zeros(num_clients, self.num_rows, config['state_dims']).share_memory_()
+        self.actions = torch.zeros(num_clients, self.num_rows, config['action_dims']).share_memory_()
+        self.request_queue = torch_mp.Queue()
+        self.events = [torch_mp.Event() for _ in range(num_clients)]
+
+    def client(self, client_idx):
+        return InferenceClient(self, client_idx)
+
+    def collect_requests(self):
+        """
+        returns the (client_idx, num_states) requests received within max_latency of the first one
+        """
+        try:
+            requests = [self.request_queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.time() + self.max_latency
+        while len(requests) < self.num_clients:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                requests.append(self.request_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return requests
+
+    def serve(self, policy, shared_weights, update_step, logger=None):
+        # private copy on the inference device, the policy given to the process may share storage with the learner
+        policy = copy.deepcopy(policy).to(self.device)
+        policy.device = self.device
+        policy.eval()
+        weights_version = 0
+        num_batches = 0
+        num_requests = 0
+        while self.training_on.value:
+            requests = self.collect_requests()
+            if len(requests) == 0:
+                continue
+            weights_version = shared_weights.copy_to(policy, weights_version)
+
+            states = torch.cat([self.states[client_idx, :num_states] for client_idx, num_states in requests])
+            with torch.no_grad():
+                actions = policy.get_action(states).cpu()
+            start = 0
+            for client_idx, num_states in requests:
+                self.actions[client_idx, :num_states] = actions[start:start + num_states]
+                start += num_states
+                self.events[client_idx].set()
+
+            num_batches += 1
+            num_requests += len(requests)
+            if logger is not None and num_batches % 1000 == 0:
+                logger.scalar_summary("inference/requests_per_batch", num_requests / 1000, update_step.value)
+                num_requests = 0
+
+        # wake up the agents still waiting
+        for event in self.events:
+            event.set()
+
+
+class InferenceClient(object):
+    """Stands for the policy of an agent, get_action asks the InferenceServer. """
+
+    def __init__(self, server, client_idx):
+        self.server = server
+        self.client_idx = client_idx
+
+    def get_action(self, state):
+        """
+        state: a single state or a batch of states [N, num_states], the action is always batched [N, num_actions]
+        """
+        state = torch.as_tensor(state, dtype=torch.float32)
+        if state.dim() == 1:
+            state = state.unsqueeze(0)
+        num_states = state.shape[0]
+        event = self.server.events[self.client_idx]
+        event.clear()
+        self.server.states[self.client_idx, :num_states] = state
+        self.server.request_queue.put((self.client_idx, num_states))
+        while not event.wait(1.0):
+            if not self.server.training_on.value:
+                break
+        return self.server.actions[self.client_idx, :num_states].clone()
+
+
+def inference_worker(config, server, policy, shared_weights, update_step, log_dir=''):
+    run_name = config["run_name"]
+    logger = Logger(f"{log_dir}/inference", name=f"{run_name}/inference", project_name=config["project_name"])
+    server.serve(policy, shared_weights, update_step, logger)
+    print("Stop inference worker.")
@@ -79,6 +79,11 @@ class PolicyNetwork(nn.Module):
         return x
 
     def get_action(self, state):
-        state = torch.tensor(state).float().unsqueeze(0).to(self.device)
+        """
+        state: a single state or a batch of states [N, num_states], the action is always batched [N, num_actions]
+        """
+        state = torch.as_tensor(state, dtype=torch.float32, device=self.device)
+        if state.dim() == 1:
+            state = state.unsqueeze(0)
         action = self.forward(state)
         return action
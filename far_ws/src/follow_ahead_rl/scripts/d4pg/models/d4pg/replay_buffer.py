@@ -9,8 +9,7 @@
 '''
 
 import numpy as np
-import random
-import operator
+import torch
 
 class SegmentTree(object):
     def __init__(self, capacity, operation, neutral_element):
@@ -23,22 +22,25 @@ class SegmentTree(object):
             b) user has access to an efficient ( O(log segment size) )
                `reduce` operation which reduces `operation` over
                a contiguous subsequence of items in the array.
+        The nodes are stored in a numpy array (root at 1, leaves at capacity...2*capacity-1)
+        and every operation also accepts arrays of indices to work on a whole batch at once.
         Paramters
         ---------
         capacity: int
             Total size of the array - must be a power of two.
-        operation: lambda obj, obj -> obj
-            and operation for combining elements (eg. sum, max)
+        operation: numpy ufunc
+            and operation for combining elements (eg. np.add, np.maximum)
             must form a mathematical group together with the set of
             possible values for array elements (i.e. be associative)
-        neutral_element: obj
+        neutral_element: float
             neutral element for the operation above. eg. float('-inf')
             for max and 0 for sum.
         """
         assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
         self._capacity = capacity
+        self._depth = capacity.bit_length() - 1
         self.neutral_element = neutral_element
-        self._value = [neutral_element for _ in range(2 * capacity)]
+        self._value = np.full(2 * capacity, neutral_element, dtype=np.float64)
         self._operation = operation
 
     def _reduce_helper(self, start, end, node, node_start, node_end):
@@ -75,43 +77,46 @@ class SegmentTree(object):
             end = self._capacity
         if end < 0:
             end += self._capacity
+        if start == 0 and end == self._capacity:
+            # the root already holds the reduction of the whole array
+            return self._value[1]
         end -= 1
         return self._reduce_helper(start, end, 1, 0, self._capacity - 1)
 
     def __setitem__(self, idx, val):
-        # index of the leaf
-        idx += self._capacity
-        self._value[idx] = val
-        idx //= 2
-        while idx >= 1:
-            self._value[idx] = self._operation(
-                self._value[2 * idx],
-                self._value[2 * idx + 1]
-            )
+        """idx and val can be arrays, the parents of all the leaves are then recomputed level by level"""
+        if np.ndim(idx) == 0:
+            # single leaf, cheaper without the unique of every level
+            idx = int(idx) + self._capacity
+            self._value[idx] = val
             idx //= 2
+            while idx >= 1:
+                self._value[idx] = self._operation(self._value[2 * idx], self._value[2 * idx + 1])
+                idx //= 2
+            return
+        # index of the leaves
+        idx = np.asarray(idx, dtype=np.int64) + self._capacity
+        self._value[idx] = val
+        idx = np.unique(idx // 2)
+        for _ in range(self._depth):
+            self._value[idx] = self._operation(self._value[2 * idx], self._value[2 * idx + 1])
+            idx = np.unique(idx // 2)
 
     def __getitem__(self, idx):
-        assert 0 <= idx < self._capacity
+        idx = np.asarray(idx, dtype=np.int64)
+        assert np.all((0 <= idx) & (idx < self._capacity))
         return self._value[self._capacity + idx]
 
-    def remove_items(self, num_items):
-        """Removes num_items leaf nodes from the tree and appends num_items leaf nodes of neutral_element value (0 or inf) to end of tree,
-           effectively left shifting remaining leaf nodes by num_items"""
-        del self._value[self._capacity:(self._capacity + num_items)]
-        neutral_elements = [self.neutral_element for _ in range(num_items)]
-        self._value += neutral_elements
-        for idx in range(self._capacity - 1, 0, -1):
-            self._value[idx] = self._operation(
-                self._value[2 * idx],
-                self._value[2 * idx + 1]
-            )
+    def clear_items(self, idxes):
+        """Sets the leaves idxes back to neutral_element, the ring buffer eviction of the replay memory"""
+        self[idxes] = self.neutral_element
 
 
 class SumSegmentTree(SegmentTree):
     def __init__(self, capacity):
         super(SumSegmentTree, self).__init__(
             capacity=capacity,
-            operation=operator.add,
+            operation=np.add,
             neutral_element=0.0
         )
 
@@ -125,23 +130,25 @@ class SumSegmentTree(SegmentTree):
         if array values are probabilities, this function
         allows to sample indexes according to the discrete
         probability efficiently.
+        All the prefix sums of a batch descend the tree together, one level per iteration.
         Parameters
         ----------
-        perfixsum: float
+        perfixsum: float or np.array
             upperbound on the sum of array prefix
         Returns
         -------
-        idx: int
+        idx: int or np.array
             highest index satisfying the prefixsum constraint
         """
-        assert 0 <= prefixsum <= self.sum() + 1e-5
-        idx = 1
-        while idx < self._capacity:  # while non-leaf
-            if self._value[2 * idx] > prefixsum:
-                idx = 2 * idx
-            else:
-                prefixsum -= self._value[2 * idx]
-                idx = 2 * idx + 1
+        prefixsum = np.array(prefixsum, dtype=np.float64)
+        assert np.all((0 <= prefixsum) & (prefixsum <= self.sum() + 1e-5))
+        idx = np.ones(prefixsum.shape, dtype=np.int64)
+        for _ in range(self._depth):  # until the leaves
+            left = 2 * idx
+            left_value = self._value[left]
+            go_right = left_value <= prefixsum
+            prefixsum -= np.where(go_right, left_value, 0.0)
+            idx = left + go_right
         return idx - self._capacity
 
 
@@ -149,7 +156,7 @@ class MinSegmentTree(SegmentTree):
     def __init__(self, capacity):
         super(MinSegmentTree, self).__init__(
             capacity=capacity,
-            operation=min,
+            operation=np.minimum,
             neutral_element=float('inf')
         )
 
@@ -160,47 +167,74 @@ class MinSegmentTree(SegmentTree):
 
 
 class ReplayBuffer(object):
+    # Names of the transition fields, in the order of add() and of the sampled batch
+    COLUMNS = ("obs_t", "action", "reward", "obs_tp1", "done", "gamma")
+
     def __init__(self, size):
         """
         Create replay buffer.
+        The transitions are stored column wise in preallocated float32 arrays written with a circular pointer,
+        sampling is one fancy index gather per column. The arrays are allocated on the first add since the
+        observation and action sizes are only known then.
         Args:
             size (int): max number of transitions to store in the buffer. When the buffer
             overflows the old memories are dropped.
         """
-        self._storage = []
         self._maxsize = size
         self._next_idx = 0
+        self._size = 0
+        self._columns = None
 
     def __len__(self):
-        return len(self._storage)
+        return self._size
 
-    def add(self, obs_t, action, reward, obs_tp1, done, gamma):
-        data = (obs_t, action, reward, obs_tp1, done, gamma)
+    def _allocate(self, obs_t, action):
+        obs_shape = np.shape(obs_t)
+        action_shape = np.shape(action)
+        shapes = (obs_shape, action_shape, (), obs_shape, (), ())
+        self._columns = [np.zeros((self._maxsize,) + shape, dtype=np.float32) for shape in shapes]
 
-        if len(self._storage) < self._maxsize:
-            self._storage.append(data)
-        else:
-            self._storage[self._next_idx] = data
+    def add(self, obs_t, action, reward, obs_tp1, done, gamma):
+        if self._columns is None:
+            self._allocate(obs_t, action)
+        idx = self._next_idx
+        for column, value in zip(self._columns, (obs_t, action, reward, obs_tp1, done, gamma)):
+            column[idx] = value
 
+        self._size = min(self._size + 1, self._maxsize)
         self._next_idx = (self._next_idx + 1) % self._maxsize
 
+    def add_batch(self, obs_t, action, reward, obs_tp1, done, gamma):
+        """
+        Adds N transitions at once, every argument has the N transitions stacked on the first axis
+        returns the indices the transitions were written to
+        """
+        num_samples = len(reward)
+        if self._columns is None:
+            self._allocate(obs_t[0], action[0])
+        idxes = (self._next_idx + np.arange(num_samples)) % self._maxsize
+        for column, values in zip(self._columns, (obs_t, action, reward, obs_tp1, done, gamma)):
+            column[idxes] = values
+
+        self._size = min(self._size + num_samples, self._maxsize)
+        self._next_idx = (self._next_idx + num_samples) % self._maxsize
+        return idxes
+
+    def _oldest_idx(self):
+        return (self._next_idx - self._size) % self._maxsize
+
     def remove(self, num_samples):
-        del self._storage[:num_samples]
-        self._next_idx = len(self._storage)
+        """
+        Drops the num_samples oldest transitions, the valid transitions stay a ring ending at _next_idx so nothing is moved
+        returns the indices of the removed transitions
+        """
+        num_samples = min(num_samples, self._size)
+        idxes = (self._oldest_idx() + np.arange(num_samples)) % self._maxsize
+        self._size -= num_samples
+        return idxes
 
     def _encode_sample(self, idxes):
-        obses_t, actions, rewards, obses_tp1, dones, gammas = [], [], [], [], [], []
-        for i in idxes:
-            data = self._storage[i]
-            obs_t, action, reward, obs_tp1, done, gamma = data
-            obses_t.append(np.array(obs_t, copy=False))
-            actions.append(np.array(action, copy=False))
-            rewards.append(reward)
-            obses_tp1.append(np.array(obs_tp1, copy=False))
-            dones.append(done)
-            gammas.append(gamma)
-        return [np.array(obses_t), np.array(actions), np.array(rewards), np.array(obses_tp1), np.array(dones), np.array(
-            gammas)]
+        return [column[idxes] for column in self._columns]
 
     def sample(self, batch_size, **kwags):
         """Sample a batch of experiences.
@@ -224,7 +258,7 @@ class ReplayBuffer(object):
         gammas: np.array
             product of gammas for N-step returns
         """
-        idxes = [random.randint(0, len(self._storage) - 1) for _ in range(batch_size)]
+        idxes = (self._oldest_idx() + np.random.randint(0, self._size, size=batch_size)) % self._maxsize
         weights = np.zeros(len(idxes))
         inds = np.zeros(len(idxes))
         return self._encode_sample(idxes) + [weights, inds]
@@ -250,7 +284,7 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         self._alpha = alpha
 
         self.it_capacity = 1
-        while self.it_capacity < size * 2:  # We use double the soft capacity of the PER for the segment trees to allow for any overflow over the soft capacity limit before samples are removed
+        while self.it_capacity < size:  # The trees have one leaf per slot of the ring buffer
             self.it_capacity *= 2
 
         self._it_sum = SumSegmentTree(self.it_capacity)
@@ -259,26 +293,28 @@ class PrioritizedReplayBuffer(ReplayBuffer):
 
     def add(self, *args, **kwargs):
         idx = self._next_idx
-        assert idx < self.it_capacity, "Number of samples in replay memory exceeds capacity of segment trees. Please increase capacity of segment trees or increase the frequency at which samples are removed from the replay memory"
-
         super().add(*args, **kwargs)
         self._it_sum[idx] = self._max_priority ** self._alpha
         self._it_min[idx] = self._max_priority ** self._alpha
 
+    def add_batch(self, *args, **kwargs):
+        idxes = super().add_batch(*args, **kwargs)
+        self._it_sum[idxes] = self._max_priority ** self._alpha
+        self._it_min[idxes] = self._max_priority ** self._alpha
+        return idxes
+
     def remove(self, num_samples):
-        super().remove(num_samples)
-        self._it_sum.remove_items(num_samples)
-        self._it_min.remove_items(num_samples)
+        idxes = super().remove(num_samples)
+        self._it_sum.clear_items(idxes)
+        self._it_min.clear_items(idxes)
+        return idxes
 
     def _sample_proportional(self, batch_size):
-        res = []
-        p_total = self._it_sum.sum(0, len(self._storage) - 1)
+        # one uniform sample in each of batch_size equal ranges of the total priority
+        p_total = self._it_sum.sum()
         every_range_len = p_total / batch_size
-        for i in range(batch_size):
-            mass = random.random() * every_range_len + i * every_range_len
-            idx = self._it_sum.find_prefixsum_idx(mass)
-            res.append(idx)
-        return res
+        mass = (np.random.random(batch_size) + np.arange(batch_size)) * every_range_len
+        return self._it_sum.find_prefixsum_idx(mass)
 
     def sample(self, batch_size, beta):
         """Sample a batch of experiences.
@@ -318,15 +354,12 @@ class PrioritizedReplayBuffer(ReplayBuffer):
 
         idxes = self._sample_proportional(batch_size)
 
-        weights = []
-        p_min = self._it_min.min() / self._it_sum.sum()
-        max_weight = (p_min * len(self._storage)) ** (-beta)
+        p_total = self._it_sum.sum()
+        p_min = self._it_min.min() / p_total
+        max_weight = (p_min * len(self)) ** (-beta)
 
-        for idx in idxes:
-            p_sample = self._it_sum[idx] / self._it_sum.sum()
-            weight = (p_sample * len(self._storage)) ** (-beta)
-            weights.append(weight / max_weight)
-        weights = np.array(weights)
+        p_sample = self._it_sum[idxes] / p_total
+        weights = (p_sample * len(self)) ** (-beta) / max_weight
         encoded_sample = self._encode_sample(idxes)
         return tuple(list(encoded_sample) + [weights, idxes])
 
@@ -343,14 +376,120 @@ class PrioritizedReplayBuffer(ReplayBuffer):
             transitions at the sampled idxes denoted by
             variable `idxes`.
         """
+        idxes = np.asarray(idxes, dtype=np.int64)
+        priorities = np.asarray(priorities, dtype=np.float64)
         assert len(idxes) == len(priorities)
-        for idx, priority in zip(idxes, priorities):
-            assert priority > 0
-            assert 0 <= idx < len(self._storage)
-            self._it_sum[idx] = priority ** self._alpha
-            self._it_min[idx] = priority ** self._alpha
+        assert np.all(priorities > 0)
+        assert np.all((0 <= idxes) & (idxes < self._maxsize))
+        self._it_sum[idxes] = priorities ** self._alpha
+        self._it_min[idxes] = priorities ** self._alpha
 
-            self._max_priority = max(self._max_priority, priority)
+        self._max_priority = max(self._max_priority, priorities.max())
+
+
+class SharedReplayBuffer(object):
+    def __init__(self, size, state_dim, action_dim, num_writers):
+        """
+        Uniform replay memory in shared memory that the agents write to directly, instead of going through
+        the replay queue and the sampler process. The learner samples index arrays into it, nothing is pickled.
+        Every writer (agent) owns a ring of size // num_writers transitions and is the only process writing
+        its cursor, so no lock is needed. A transition overwritten while it is sampled can be read half updated.
+        Args:
+            size (int): max number of transitions of all the writers together
+            num_writers (int): number of agents writing, see writer()
+        """
+        assert size >= num_writers > 0
+        self._segment_size = size // num_writers
+        self._num_writers = num_writers
+        num_slots = self._segment_size * num_writers
+        shapes = ((state_dim,), (action_dim,), (), (state_dim,), (), ())
+        self._tensors = [torch.zeros((num_slots,) + shape, dtype=torch.float32).share_memory_() for shape in shapes]
+        # number of transitions every writer added so far, its ring cursor is num_added % segment_size
+        self._num_added = torch.zeros(num_writers, dtype=torch.int64).share_memory_()
+        self._columns = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # numpy views are not shared when pickled, every process recreates them from the shared tensors
+        state['_columns'] = None
+        return state
+
+    def _views(self):
+        if self._columns is None:
+            self._columns = [tensor.numpy() for tensor in self._tensors]
+            self._num_added_np = self._num_added.numpy()
+        return self._columns, self._num_added_np
+
+    def __len__(self):
+        _, num_added = self._views()
+        return int(np.minimum(num_added, self._segment_size).sum())
+
+    def writer(self, writer_idx):
+        assert 0 <= writer_idx < self._num_writers
+        return SharedReplayWriter(self, writer_idx)
+
+    def add(self, writer_idx, obs_t, action, reward, obs_tp1, done, gamma):
+        columns, num_added = self._views()
+        count = int(num_added[writer_idx])
+        idx = writer_idx * self._segment_size + count % self._segment_size
+        for column, value in zip(columns, (obs_t, action, reward, obs_tp1, done, gamma)):
+            column[idx] = value
+        # published after the data so a sampler never picks a slot that was not written yet
+        num_added[writer_idx] = count + 1
+
+    def add_batch(self, writer_idx, obs_t, action, reward, obs_tp1, done, gamma):
+        columns, num_added = self._views()
+        count = int(num_added[writer_idx])
+        num_samples = len(reward)
+        # only the last segment_size transitions of a larger batch fit, the others would be overwritten anyway
+        num_kept = min(num_samples, self._segment_size)
+        start = count + num_samples - num_kept
+        idxes = writer_idx * self._segment_size + (start + np.arange(num_kept)) % self._segment_size
+        for column, values in zip(columns, (obs_t, action, reward, obs_tp1, done, gamma)):
+            column[idxes] = values[num_samples - num_kept:]
+        num_added[writer_idx] = count + num_samples
+
+    def sample(self, batch_size, **kwags):
+        """Sample a batch of experiences uniformly over the transitions of all the writers, same output as ReplayBuffer.sample"""
+        columns, num_added = self._views()
+        sizes = np.minimum(num_added, self._segment_size)
+        ends = np.cumsum(sizes)
+        assert ends[-1] > 0, "cannot sample from an empty SharedReplayBuffer"
+        flat_idxes = np.random.randint(0, ends[-1], size=batch_size)
+        writers = np.searchsorted(ends, flat_idxes, side='right')
+        idxes = writers * self._segment_size + flat_idxes - (ends[writers] - sizes[writers])
+        weights = np.zeros(batch_size)
+        inds = np.zeros(batch_size)
+        return [column[idxes] for column in columns] + [weights, inds]
+
+
+class SharedReplayWriter(object):
+    """
+    Writes the transitions of one agent to a SharedReplayBuffer. It has the put, put_nowait and full
+    of the replay queue so the agents use it in place of the queue unchanged.
+    """
+
+    def __init__(self, replay_buffer, writer_idx):
+        self.replay_buffer = replay_buffer
+        self.writer_idx = writer_idx
+
+    def put(self, replay, block=True, timeout=None):
+        self.replay_buffer.add(self.writer_idx, *replay)
+
+    def put_nowait(self, replay):
+        self.put(replay)
+
+    def put_batch(self, obs_t, action, reward, obs_tp1, done, gamma):
+        self.replay_buffer.add_batch(self.writer_idx, obs_t, action, reward, obs_tp1, done, gamma)
+
+    def full(self):
+        return False
+
+    def empty(self):
+        return True
+
+    def qsize(self):
+        return 0
 
 
 def create_replay_buffer(config):
@@ -359,3 +498,7 @@ def create_replay_buffer(config):
         alpha = config['priority_alpha']
         return PrioritizedReplayBuffer(size=size, alpha=alpha)
     return ReplayBuffer(size)
+
+
+def create_shared_replay_buffer(config, num_writers):
+    return SharedReplayBuffer(config['replay_mem_size'], config['state_dims'], config['action_dims'], num_writers)
@@ -0,0 +1,44 @@
+import torch
+
+
+class SharedParameters(object):
+    """
+    Parameters of a network in one flat float32 tensor in shared memory with a version counter.
+    The learner publishes into it every few updates and the agents copy from it only when the version changed,
+    instead of pickling the weights through a queue. The version is odd while a publication is written
+    (seqlock) so a reader never loads half updated weights, it keeps its weights and tries again later.
+    Only one process may publish.
+    """
+
+    def __init__(self, network):
+        params = [param.detach().cpu() for param in network.parameters()]
+        self.numels = [param.numel() for param in params]
+        self.block = torch.cat([param.reshape(-1).float() for param in params]).share_memory_()
+        self.version = torch.zeros(1, dtype=torch.int64).share_memory_()
+
+    def get_version(self):
+        return int(self.version[0])
+
+    def publish(self, network):
+        with torch.no_grad():
+            flat = torch.cat([param.detach().reshape(-1) for param in network.parameters()])
+            self.version += 1
+            self.block.copy_(flat)
+            self.version += 1
+
+    def copy_to(self, network, known_version):
+        """
+        Copies the published weights into network if they are newer than known_version
+        returns the version of the weights network has now
+        """
+        version = self.get_version()
+        if version == known_version or version % 2 == 1:
+            return known_version
+        flat = self.block.clone()
+        if self.get_version() != version:
+            # published again while copying
+            return known_version
+        with torch.no_grad():
+            for param, values in zip(network.parameters(), flat.split(self.numels)):
+                param.copy_(values.view_as(param))
+        return version
@@ -0,0 +1,126 @@
+import numpy as np
+import os
+import time
+import torch
+
+from gym_gazeboros_ac.envs import VectorGazeborosEnv
+
+from utils.utils import OUNoise, NStepAccumulator, put_transitions
+from utils.logger import Logger
+
+
+class VectorAgent(object):
+    """
+    Agent running config['num_envs_per_agent'] headless follow ahead scenarios (gazeborosSim-v0) in one process.
+    Every step is one batched forward pass of the policy for all the scenarios.
+    """
+
+    def __init__(self, config, policy, global_episode, n_agent=0, agent_type='exploration', log_dir=''):
+        print(f"Initializing vector agent {n_agent}...")
+        self.config = config
+        self.n_agent = n_agent
+        self.agent_type = agent_type
+        self.max_steps = config['max_ep_length']
+        self.num_envs = config['num_envs_per_agent']
+        self.num_episode_save = config['num_episode_save']
+        self.global_episode = global_episode
+        self.local_episode = 0
+        self.log_dir = log_dir
+
+        # Create environments
+        self.env = VectorGazeborosEnv(self.num_envs, max_episode_steps=self.max_steps)
+        self.env.seed(config['random_seed'] + n_agent)
+        self.ou_noise = OUNoise(dim=(self.num_envs, config["action_dim"]), low=config["action_low"], high=config["action_high"])
+        self.ou_noise.reset()
+
+        self.actor = policy
+        self.weights_version = 0
+
+        # Logger
+        log_path = f"{log_dir}/agent-{n_agent}"
+        run_name = config["run_name"]
+        self.logger = Logger(log_path, name = f"{run_name}/agent-{n_agent}", project_name=config["project_name"])
+
+    def update_actor_learner(self, shared_weights):
+        """Update local actor to the actor from learner, only copies when the learner published new weights. """
+        if shared_weights is None:
+            # the policy is served by the inference server
+            return
+        self.weights_version = shared_weights.copy_to(self.actor, self.weights_version)
+
+    def run(self, training_on, replay_queue, shared_weights, update_step):
+        # One accumulator per scenario for the N-step returns
+        n_step_accs = [NStepAccumulator(self.config['n_step_returns'], self.config['discount_rate'])
+                       for _ in range(self.num_envs)]
+        episode_rewards = np.zeros(self.num_envs)
+        num_steps = np.zeros(self.num_envs, dtype=np.int64)
+        ep_start_times = np.full(self.num_envs, time.time())
+        best_reward = -float("inf")
+
+        states = self.env.reset()
+        while training_on.value:
+            with torch.no_grad():
+                actions = self.actor.get_action(states)
+            if self.agent_type == "exploration":
+                actions = self.ou_noise.get_action(actions, num_steps[:, None])
+            else:
+                actions = actions.cpu().numpy()
+            next_states, rewards, dones, infos = self.env.step(actions)
+            episode_rewards += rewards
+            num_steps += 1
+
+            for env_idx in range(self.num_envs):
+                next_state = infos[env_idx].get("terminal_observation", next_states[env_idx])
+                # a scenario stopped by max_ep_length is not a terminal state
+                done = bool(dones[env_idx]) and not infos[env_idx].get("truncated", False)
+                # the N-step experiences completed by this step, all the remaining ones when the scenario ends
+                transitions = n_step_accs[env_idx].add(states[env_idx], actions[env_idx], rewards[env_idx],
+                                                       next_state, done, episode_end=bool(dones[env_idx]))
+                # We want to fill buffer only with form explorator
+                if self.agent_type == "exploration":
+                    put_transitions(replay_queue, transitions)
+
+                if dones[env_idx]:
+                    self.end_episode(episode_rewards[env_idx], num_steps[env_idx], time.time() - ep_start_times[env_idx],
+                                     best_reward, update_step, shared_weights)
+                    best_reward = max(best_reward, episode_rewards[env_idx])
+                    episode_rewards[env_idx] = 0
+                    num_steps[env_idx] = 0
+                    ep_start_times[env_idx] = time.time()
+                    self.ou_noise.reset(env_idx)
+
+            states = next_states
+
+        print(f"Agent {self.n_agent} done.")
+
+    def end_episode(self, episode_reward, num_steps, episode_time, best_reward, update_step, shared_weights):
+        self.local_episode += 1
+        self.global_episode.value += 1
+        self.env.set_mode_person_based_on_episode_number(self.global_episode.value)
+
+        # Log metrics
+        step = update_step.value
+        self.logger.scalar_summary("agent/reward", episode_reward, step)
+        self.logger.scalar_summary("agent/episode_step", num_steps, step)
+        self.logger.scalar_summary("agent/episode_timing", episode_time, step)
+
+        # Saving agent
+        reward_outperformed = episode_reward - best_reward > self.config["save_reward_threshold"]
+        time_to_save = self.local_episode % self.num_episode_save == 0
+        if self.n_agent == 0 and (time_to_save or reward_outperformed):
+            self.save(f"local_episode_{self.local_episode}_reward_{max(episode_reward, best_reward):4f}")
+
+        if self.agent_type == "exploration" and self.local_episode % self.config['update_agent_ep'] == 0:
+            self.update_actor_learner(shared_weights)
+
+    def save(self, checkpoint_name):
+        last_path = f"{self.log_dir}"
+        process_dir = f"{self.log_dir}/agent_{self.n_agent}"
+        if not os.path.exists(process_dir):
+            os.makedirs(process_dir)
+        if not os.path.exists(last_path):
+            os.makedirs(last_path)
+        model_fn = f"{process_dir}/{checkpoint_name}.pt"
+        torch.save(self.actor, model_fn)
+        model_fn = f"{last_path}/best.pt"
+        torch.save(self.actor, model_fn)
@@ -0,0 +1,64 @@
+import unittest
+from collections import deque
+
+import numpy as np
+
+from utils.utils import NStepAccumulator
+
+
+def deque_n_step(episode, n_step, discount_rate):
+    """The N-step returns of the deque loop Agent.run used before NStepAccumulator"""
+    exp_buffer = deque()
+    transitions = []
+
+    def pop_transition(next_state, done):
+        state_0, action_0, reward_0 = exp_buffer.popleft()
+        discounted_reward = reward_0
+        gamma = discount_rate
+        for (_, _, r_i) in exp_buffer:
+            discounted_reward += r_i * gamma
+            gamma *= discount_rate
+        transitions.append((state_0, action_0, discounted_reward, next_state, done, gamma))
+
+    for step, (state, action, reward, next_state, done) in enumerate(episode):
+        exp_buffer.append((state, action, reward))
+        if len(exp_buffer) >= n_step:
+            pop_transition(next_state, done)
+        if step == len(episode) - 1:
+            while len(exp_buffer) != 0:
+                pop_transition(next_state, done)
+    return transitions
+
+
+class TestsNStepAccumulator(unittest.TestCase):
+
+    def random_episode(self, rng, num_steps, done):
+        states = rng.standard_normal((num_steps + 1, 4)).astype(np.float32)
+        actions = rng.uniform(-1, 1, (num_steps, 2)).astype(np.float32)
+        rewards = rng.uniform(-1, 1, num_steps)
+        return [(states[i], actions[i], rewards[i], states[i + 1], done and i == num_steps - 1) for i in range(num_steps)]
+
+    def test_same_as_deque_loop(self):
+        rng = np.random.default_rng(0)
+        discount_rate = 0.99
+        for n_step in (1, 2, 5):
+            accumulator = NStepAccumulator(n_step, discount_rate)
+            for num_steps in range(1, 13):
+                for done in (True, False):
+                    episode = self.random_episode(rng, num_steps, done)
+                    accumulator.reset()
+                    batches = []
+                    for step, transition in enumerate(episode):
+                        batch = accumulator.add(*transition, episode_end=step == len(episode) - 1)
+                        if batch is not None:
+                            batches.append(batch)
+                    columns = [np.concatenate(column) for column in zip(*batches)]
+
+                    expected = deque_n_step(episode, n_step, discount_rate)
+                    self.assertEqual(len(columns[0]), len(expected), (n_step, num_steps))
+                    for column, expected_column in zip(columns, zip(*expected)):
+                        np.testing.assert_allclose(column, np.array(expected_column, dtype=np.float64), rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
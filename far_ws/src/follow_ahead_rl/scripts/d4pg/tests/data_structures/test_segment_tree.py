@@ -0,0 +1,127 @@
+import unittest
+
+import numpy as np
+
+from models.d4pg.replay_buffer import SumSegmentTree, MinSegmentTree, PrioritizedReplayBuffer
+
+
+class TestsSegmentTree(unittest.TestCase):
+    """The vectorized trees against a plain array of the leaves"""
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.capacity = 64
+        self.sum_tree = SumSegmentTree(self.capacity)
+        self.min_tree = MinSegmentTree(self.capacity)
+        self.sums = np.zeros(self.capacity)
+        self.mins = np.full(self.capacity, np.inf)
+
+    def set_items(self, idxes, values):
+        self.sum_tree[idxes] = values
+        self.min_tree[idxes] = values
+        # duplicated indices keep the last value, like the sequential assignments
+        for idx, value in zip(np.atleast_1d(idxes), np.broadcast_to(values, np.shape(np.atleast_1d(idxes)))):
+            self.sums[idx] = value
+            self.mins[idx] = value
+
+    def check_tree(self):
+        # integer priorities so the sums are exact
+        self.assertEqual(self.sum_tree.sum(), self.sums.sum())
+        self.assertEqual(self.min_tree.min(), self.mins.min())
+        for start, end in self.rng.integers(0, self.capacity, (20, 2)):
+            start, end = min(start, end), max(start, end) + 1
+            self.assertEqual(self.sum_tree.sum(start, end), self.sums[start:end].sum())
+            self.assertEqual(self.min_tree.min(start, end), self.mins[start:end].min())
+        np.testing.assert_array_equal(self.sum_tree[np.arange(self.capacity)], self.sums)
+
+        # half integer prefix sums never fall on a boundary of the cumulative sum
+        prefixsums = self.rng.integers(0, int(self.sums.sum()), 100) + 0.5
+        expected = np.searchsorted(np.cumsum(self.sums), prefixsums, side='right')
+        np.testing.assert_array_equal(self.sum_tree.find_prefixsum_idx(prefixsums), expected)
+        self.assertEqual(self.sum_tree.find_prefixsum_idx(prefixsums[0]), expected[0])
+
+    def test_batched_updates(self):
+        for _ in range(50):
+            idxes = self.rng.integers(0, self.capacity, self.rng.integers(1, 20))
+            self.set_items(idxes, self.rng.integers(1, 100, len(idxes)).astype(np.float64))
+            self.check_tree()
+
+    def test_duplicate_indices(self):
+        self.set_items(np.arange(self.capacity), np.ones(self.capacity))
+        self.set_items(np.array([3, 3, 7, 3, 7]), np.array([10., 20., 30., 40., 50.]))
+        self.assertEqual(self.sums[3], 40.)
+        self.check_tree()
+
+    def test_single_updates(self):
+        for idx in self.rng.integers(0, self.capacity, 50):
+            self.set_items(int(idx), float(self.rng.integers(1, 100)))
+            self.check_tree()
+
+    def test_clear_items(self):
+        self.set_items(np.arange(self.capacity), self.rng.integers(1, 100, self.capacity).astype(np.float64))
+        idxes = np.array([0, 5, 63])
+        self.sum_tree.clear_items(idxes)
+        self.min_tree.clear_items(idxes)
+        self.sums[idxes] = 0.
+        self.mins[idxes] = np.inf
+        self.check_tree()
+
+
+class TestsPrioritizedReplayBuffer(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.size = 10
+        self.alpha = 0.6
+        self.buffer = PrioritizedReplayBuffer(self.size, alpha=self.alpha)
+        self.priorities = {}
+        self.num_added = 0
+
+    def add(self, num_samples):
+        self.buffer.add_batch(np.zeros((num_samples, 3)), np.zeros((num_samples, 2)), np.arange(num_samples),
+                              np.zeros((num_samples, 3)), np.zeros(num_samples), np.ones(num_samples))
+        for i in range(num_samples):
+            self.priorities[(self.num_added + i) % self.size] = self.buffer._max_priority
+        self.num_added += num_samples
+
+    def check_trees(self):
+        leaves = np.zeros(self.buffer.it_capacity)
+        for idx, priority in self.priorities.items():
+            leaves[idx] = priority ** self.alpha
+        np.testing.assert_allclose(self.buffer._it_sum[np.arange(self.buffer.it_capacity)], leaves)
+        np.testing.assert_allclose(self.buffer._it_sum.sum(), leaves.sum())
+        np.testing.assert_allclose(self.buffer._it_min.min(), min(leaves[list(self.priorities)]))
+        self.assertEqual(len(self.buffer), len(self.priorities))
+        idxes = self.buffer.sample(32, beta=0.4)[-1]
+        self.assertTrue(set(idxes.tolist()) <= set(self.priorities))
+
+    def test_ring_wrap(self):
+        self.add(7)
+        self.check_trees()
+        # wraps around the end of the ring and overwrites the oldest transitions
+        self.add(6)
+        self.check_trees()
+        idxes = np.array([0, 2, 9])
+        priorities = np.array([3., 0.5, 2.])
+        self.buffer.update_priorities(idxes, priorities)
+        self.priorities.update(zip(idxes.tolist(), priorities.tolist()))
+        self.check_trees()
+        # new transitions get the max priority seen so far
+        self.add(1)
+        self.assertEqual(self.priorities[3], 3.)
+        self.check_trees()
+
+    def test_remove(self):
+        self.add(13)
+        # the oldest transitions are at 3, 4 and 5 after the wrap
+        removed = self.buffer.remove(3)
+        np.testing.assert_array_equal(removed, [3, 4, 5])
+        for idx in removed:
+            del self.priorities[idx]
+        self.check_trees()
+        self.add(2)
+        self.check_trees()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+import numpy as np
+
+from models.d4pg.replay_buffer import SharedReplayBuffer
+
+
+class TestsSharedReplayBuffer(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        # 2 writers of 4 transitions each
+        self.buffer = SharedReplayBuffer(8, state_dim=3, action_dim=2, num_writers=2)
+
+    def put_batch(self, writer, rewards):
+        num_samples = len(rewards)
+        rewards = np.asarray(rewards, dtype=np.float32)
+        writer.put_batch(np.repeat(rewards[:, None], 3, axis=1), np.zeros((num_samples, 2)), rewards,
+                         np.zeros((num_samples, 3)), np.zeros(num_samples), np.ones(num_samples))
+
+    def segment_rewards(self, writer_idx):
+        return self.buffer._tensors[2][writer_idx * 4:(writer_idx + 1) * 4].tolist()
+
+    def test_empty(self):
+        self.assertEqual(len(self.buffer), 0)
+        with self.assertRaises(AssertionError):
+            self.buffer.sample(4)
+
+    def test_ring_wrap(self):
+        writer = self.buffer.writer(1)
+        self.put_batch(writer, [1, 2, 3])
+        self.assertEqual(len(self.buffer), 3)
+        self.put_batch(writer, [4, 5])
+        self.assertEqual(len(self.buffer), 4)
+        self.assertEqual(self.segment_rewards(1), [5, 2, 3, 4])
+        # the other writer is untouched and its empty segment is never sampled
+        self.assertEqual(self.segment_rewards(0), [0, 0, 0, 0])
+        batch = self.buffer.sample(64)
+        self.assertEqual(set(batch[2].tolist()), {2, 3, 4, 5})
+        np.testing.assert_array_equal(batch[0][:, 0], batch[2])
+
+    def test_oversized_batch(self):
+        writer = self.buffer.writer(0)
+        self.put_batch(writer, [1])
+        # only the last 4 transitions fit, at the ring positions they would have reached
+        self.put_batch(writer, [2, 3, 4, 5, 6, 7])
+        self.assertEqual(self.segment_rewards(0), [5, 6, 7, 4])
+        self.assertEqual(int(self.buffer._num_added[0]), 7)
+        self.assertEqual(len(self.buffer), 4)
+        self.put_batch(writer, [8])
+        self.assertEqual(self.segment_rewards(0), [5, 6, 7, 8])
+
+    def test_writers(self):
+        self.put_batch(self.buffer.writer(0), [1, 2])
+        self.put_batch(self.buffer.writer(1), [3])
+        self.assertEqual(len(self.buffer), 3)
+        self.assertEqual(set(self.buffer.sample(64)[2].tolist()), {1, 2, 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+import torch
+
+
+def soft_update(target, source, tau):
+    """
+    Polyak averaging of the parameters of target towards source, target = (1 - tau) * target + tau * source.
+    Fused and in place with the foreach ops instead of a loop allocating two temporaries per parameter.
+    Args:
+        target (nn.Module): network updated in place
+        source (nn.Module): network with the same parameters as target
+        tau (float): 1 copies source into target
+    """
+    with torch.no_grad():
+        target_params = [param.data for param in target.parameters()]
+        source_params = [param.data for param in source.parameters()]
+        if tau == 1:
+            for target_param, source_param in zip(target_params, source_params):
+                target_param.copy_(source_param)
+        elif hasattr(torch, '_foreach_lerp_'):
+            torch._foreach_lerp_(target_params, source_params, tau)
+        else:
+            torch._foreach_mul_(target_params, 1.0 - tau)
+            torch._foreach_add_(target_params, source_params, alpha=tau)
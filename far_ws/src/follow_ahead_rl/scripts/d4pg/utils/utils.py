@@ -1,4 +1,5 @@
 import numpy as np
+import queue
 import gym
 import imageio
 from glob import glob
@@ -21,22 +22,103 @@ class OUNoise(object):
         self.low = low
         self.high = high
 
-    def reset(self):
-        self.state = np.ones(self.action_dim) * self.mu
+    def reset(self, idx=None):
+        """
+        idx: rows to reset when dim is (num_envs, action_dim), all of them if None
+        """
+        if idx is None:
+            self.state = np.ones(self.action_dim) * self.mu
+        else:
+            self.state[idx] = self.mu
 
     def evolve_state(self):
         x = self.state
-        dx = self.theta * (self.mu - x) + self.sigma * np.random.randn(self.action_dim)
+        dx = self.theta * (self.mu - x) + self.sigma * np.random.standard_normal(x.shape)
         self.state = x + dx
         return self.state
 
     def get_action(self, action, t=0):
         ou_state = self.evolve_state()
-        self.sigma = self.max_sigma - (self.max_sigma - self.min_sigma) * min(1.0, t/self.decay_period)
+        # t can be an array of the step of every env, e.g. [num_envs, 1]
+        self.sigma = self.max_sigma - (self.max_sigma - self.min_sigma) * np.minimum(1.0, t/self.decay_period)
         action = action.cpu().detach().numpy()
         return np.clip(action + ou_state, self.low, self.high)
 
 
+class NStepAccumulator(object):
+    """
+    Incremental N-step returns of one episode stream. The last n_step (state, action) are kept in a ring
+    with the discounted sum of the rewards received since each of them, a new reward is added to all
+    of those sums in one vectorized update instead of summing the whole buffer again for every transition.
+    The completed transitions are returned as a batch (states, actions, rewards, next_states, dones, gammas),
+    gammas being discount_rate^k for the k rewards summed, the same as the deque loop of Agent.run gave.
+    """
+
+    def __init__(self, n_step, discount_rate):
+        self.n_step = n_step
+        self.discounts = discount_rate ** np.arange(n_step + 1)
+        self.offsets = np.arange(n_step)
+        self.states = None
+        self.head = 0
+        self.size = 0
+
+    def reset(self):
+        self.head = 0
+        self.size = 0
+
+    def add(self, state, action, reward, next_state, done, episode_end=False):
+        """
+        episode_end: returns all the pending transitions, they end in next_state
+        returns the completed transitions or None
+        """
+        if self.states is None:
+            # allocated on the first add since the state and action sizes are only known then
+            self.states = np.zeros((self.n_step,) + np.shape(state), dtype=np.float32)
+            self.actions = np.zeros((self.n_step,) + np.shape(action), dtype=np.float32)
+            self.returns = np.zeros(self.n_step, dtype=np.float64)
+        slot = (self.head + self.size) % self.n_step
+        self.states[slot] = state
+        self.actions[slot] = action
+        self.returns[slot] = 0.
+        self.size += 1
+
+        # the transition added k steps ago gets discount_rate^k * reward
+        pending = (self.head + self.offsets[:self.size]) % self.n_step
+        self.returns[pending] += self.discounts[self.size - 1::-1] * reward
+
+        if episode_end:
+            num_ready = self.size
+        elif self.size >= self.n_step:
+            num_ready = 1
+        else:
+            return None
+        ready = pending[:num_ready]
+        transitions = (self.states[ready], self.actions[ready], self.returns[ready],
+                       np.repeat(np.asarray(next_state, dtype=np.float32)[None], num_ready, axis=0),
+                       np.full(num_ready, float(done), dtype=np.float32),
+                       self.discounts[self.size - self.offsets[:num_ready]])
+        self.head = (self.head + num_ready) % self.n_step
+        self.size -= num_ready
+        return transitions
+
+
+def put_transitions(replay_queue, transitions):
+    """
+    Puts a batch of transitions from NStepAccumulator in one go. A SharedReplayWriter writes them directly,
+    a replay queue gets them as one item that the sampler adds with add_batch.
+    The batch is dropped if the queue is full, like the single transitions were.
+    """
+    if transitions is None:
+        return
+    if hasattr(replay_queue, 'put_batch'):
+        replay_queue.put_batch(*transitions)
+        return
+    try:
+        replay_queue.put_nowait(transitions)
+    except queue.Full:
+        pass
+
+
 def make_gif(source_dir, output):
     """
     Make gif file from set of .jpeg images.
@@ -27,6 +27,8 @@ import os
 import gym
 import gym_gazeboros_ac
 import numpy as np
+
+from d4pg.utils.torch_utils import soft_update
 # from logger import Logger
 
 
@@ -293,35 +295,9 @@ class Agent():
         if tau is None:
             tau = self.tau
 
-        actor_params = self.actor.named_parameters()
-        critic_1_params = self.critic_1.named_parameters()
-        critic_2_params = self.critic_2.named_parameters()
-        target_actor_params = self.target_actor.named_parameters()
-        target_critic_1_params = self.target_critic_1.named_parameters()
-        target_critic_2_params = self.target_critic_2.named_parameters()
-
-        critic_1 = dict(critic_1_params)
-        critic_2 = dict(critic_2_params)
-        actor = dict(actor_params)
-        target_actor = dict(target_actor_params)
-        target_critic_1 = dict(target_critic_1_params)
-        target_critic_2 = dict(target_critic_2_params)
-
-        for name in critic_1:
-            critic_1[name] = tau*critic_1[name].clone() + \
-                (1-tau)*target_critic_1[name].clone()
-
-        for name in critic_2:
-            critic_2[name] = tau*critic_2[name].clone() + \
-                (1-tau)*target_critic_2[name].clone()
-
-        for name in actor:
-            actor[name] = tau*actor[name].clone() + \
-                (1-tau)*target_actor[name].clone()
-
-        self.target_critic_1.load_state_dict(critic_1)
-        self.target_critic_2.load_state_dict(critic_2)
-        self.target_actor.load_state_dict(actor)
+        soft_update(self.target_critic_1, self.critic_1, tau)
+        soft_update(self.target_critic_2, self.critic_2, tau)
+        soft_update(self.target_actor, self.actor, tau)
 
     def save_models(self):
         self.actor.save_checkpoint()